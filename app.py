@@ -1,11 +1,211 @@
 import streamlit as st
 import pandas as pd
 from PIL import Image
-from io import StringIO, BytesIO
+from io import StringIO, BytesIO, TextIOWrapper
+import argparse
 import random
+import re
+import json
+import gzip
+import logging
+import os
+import tempfile
+import asyncio
+import bisect
+import copy
+import hashlib
+import heapq
+import hmac
+import html
+import inspect
+import mmap
+import pickle
+import shutil
+import smtplib
+import string
+import sys
+import time
+import atexit
+import weakref
+import threading
+import warnings
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from email.message import EmailMessage
+from functools import wraps
+from itertools import combinations, islice
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping, Sequence
 from datetime import datetime, date, timedelta
 import matplotlib.pyplot as plt
 import numpy as np
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+LOGGER = logging.getLogger('skinova')  # Failures in background threads, which have no page to show them on
+
+# --- 0. SESSION TRACES & HEADLESS REPLAY (the recorder is in 3.18) ---
+
+# Defined ahead of everything else so `python app.py --replay TRACE` exits before any module
+# side effect (data store, journal and index threads, the notification outbox) has run.
+RECORD_DIR_ENV = 'SKINOVA_RECORD_DIR'
+TRACE_STATE_KEYS = ('current_page', 'logged_in', 'user_email', 'onboarding_complete', 'skin_score', 'routine_streak')
+REPLAY_SPEEDUP = 20.0           # Recorded think time between interactions is compressed 20x (0 = no waiting)
+
+def trace_value(value):
+    """JSON form of a widget value. Dates and tuples are tagged so the replayer can restore them;
+    values that cannot be replayed (uploads) keep only their type."""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, datetime):
+        return {'$datetime': value.isoformat()}
+    if isinstance(value, date):
+        return {'$date': value.isoformat()}
+    if isinstance(value, tuple):
+        return {'$tuple': [trace_value(item) for item in value]}
+    if isinstance(value, list):
+        return [trace_value(item) for item in value]
+    return {'$opaque': type(value).__name__}
+
+def restore_trace_value(value):
+    if isinstance(value, list):
+        return [restore_trace_value(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if '$datetime' in value:
+        return datetime.fromisoformat(value['$datetime'])
+    if '$date' in value:
+        return date.fromisoformat(value['$date'])
+    if '$tuple' in value:
+        return tuple(restore_trace_value(item) for item in value['$tuple'])
+    raise ValueError(f"{value['$opaque']} values cannot be replayed")
+
+def trace_state(session_state, redact=None):
+    """Compact digest of the session state compared step by step between a recording and its replay.
+    The recorder passes `redact` so the email is stored as the same pseudonym as the login inputs."""
+    digest = {key: trace_value(session_state[key]) if key in session_state else None for key in TRACE_STATE_KEYS}
+    if redact and digest['user_email']:
+        digest['user_email'] = redact(digest['user_email'])
+    progress = session_state['daily_progress'] if 'daily_progress' in session_state else {}
+    digest['today_progress'] = progress.get(date.today().strftime("%Y-%m-%d"))
+    return digest
+
+def load_trace_interactions(path):
+    """Groups a trace into interactions. Runs without widget changes (st.rerun continuations) are
+    folded into the interaction that caused them, so recorded latency covers the whole response."""
+    interactions = []
+    with open(path, encoding='utf-8') as trace_file:
+        for line in trace_file:
+            event = json.loads(line) if line.strip() else None
+            if event is None or event.get('kind') != 'step':
+                continue
+            if event['changes'] or not interactions:
+                interactions.append({'step': event['n'], 'dt': event['dt'], 'page': event['page'],
+                                     'changes': event['changes'], 'recorded_ms': event['ms'], 'state': event['state']})
+            else:
+                interactions[-1]['recorded_ms'] += event['ms']
+                interactions[-1]['state'] = event['state']
+    return interactions
+
+def _trace_widgets(node):
+    for child in getattr(node, 'children', {}).values():
+        if getattr(child, 'id', None):
+            yield child
+        yield from _trace_widgets(child)
+
+def replay_trace(path, app_path=None, speedup=REPLAY_SPEEDUP, timeout=60):
+    """Re-drives the app headlessly through a recorded session.
+
+    Returns one report row per interaction: recorded vs replayed script latency (the replay records a
+    trace of its own, so both sides are measured the same way), the harness wall time, the widgets that
+    could not be replayed and the state digest keys that differ from the recording. Replay against a
+    copy of the data the session was recorded on (see Data Backup), otherwise logins and lists diverge.
+    """
+    from streamlit.testing.v1 import AppTest
+
+    replay_dir = tempfile.mkdtemp(prefix='skinova-replay-')
+    previous_dir = os.environ.get(RECORD_DIR_ENV)
+    os.environ[RECORD_DIR_ENV] = replay_dir
+    app = AppTest.from_file(app_path or os.path.abspath(__file__), default_timeout=timeout)
+    report, replay_offset = [], 0
+    try:
+        for interaction in load_trace_interactions(path):
+            if speedup:
+                time.sleep(interaction['dt'] / speedup)
+            widgets = ({widget.id: widget for root in (app.main, app.sidebar) for widget in _trace_widgets(root)}
+                       if interaction['changes'] else {})
+            skipped = []
+            for widget_id, value in interaction['changes'].items():
+                widget = widgets.get(widget_id)
+                try:
+                    if widget is None:
+                        raise LookupError("widget not rendered")
+                    widget.set_value(restore_trace_value(value))
+                except (LookupError, ValueError, TypeError) as exc:
+                    skipped.append(f"{widget_id.rsplit('-', 1)[-1]}: {exc}")
+
+            started = time.perf_counter()
+            app.run()
+            wall_ms = (time.perf_counter() - started) * 1000
+
+            # Every run of this interaction (st.rerun continuations included) since the last one
+            replayed_ms = 0.0
+            if 'session_trace' in app.session_state:
+                with open(app.session_state['session_trace']['path'], encoding='utf-8') as replay_file:
+                    replay_file.seek(replay_offset)
+                    for line in replay_file:
+                        event = json.loads(line)
+                        replayed_ms += event.get('ms', 0.0)
+                    replay_offset = replay_file.tell()
+            replayed_state = trace_state(app.session_state)
+            report.append({
+                'step': interaction['step'],
+                'page': interaction['page'],
+                'widgets': len(interaction['changes']),
+                'recorded_ms': round(interaction['recorded_ms'], 1),
+                'replayed_ms': round(replayed_ms, 1),
+                'wall_ms': round(wall_ms, 1),
+                'skipped': skipped,
+                'state_diff': {key: (recorded, replayed_state.get(key)) for key, recorded in interaction['state'].items()
+                               if replayed_state.get(key) != recorded},
+                'error': str(app.exception[0].message) if app.exception else None,
+            })
+            if app.exception:
+                break
+    finally:
+        if previous_dir is None:
+            os.environ.pop(RECORD_DIR_ENV, None)
+        else:
+            os.environ[RECORD_DIR_ENV] = previous_dir
+        shutil.rmtree(replay_dir, ignore_errors=True)
+    return report
+
+def run_replay_cli(argv):
+    """`python app.py --replay TRACE [--speedup N]`: prints per-step latency and state diffs."""
+    parser = argparse.ArgumentParser(prog='app.py', description="Replay a recorded SkinovaAI session headlessly.")
+    parser.add_argument('--replay', required=True, metavar='TRACE', help="session trace (.ndjson) to replay")
+    parser.add_argument('--speedup', type=float, default=REPLAY_SPEEDUP, help="think-time compression (0 = none)")
+    args = parser.parse_args(argv)
+
+    report = replay_trace(args.replay, speedup=args.speedup)
+    print(f"{'step':>5} {'page':<20} {'widgets':>7} {'recorded':>10} {'replayed':>10} {'harness':>10}  notes")
+    for row in report:
+        notes = [f"{key}: {recorded!r} -> {replayed!r}" for key, (recorded, replayed) in row['state_diff'].items()]
+        notes += [f"skipped {item}" for item in row['skipped']]
+        if row['error']:
+            notes.append(f"ERROR {row['error']}")
+        print(f"{row['step']:>5} {str(row['page']):<20} {row['widgets']:>7} {row['recorded_ms']:>8.1f}ms "
+              f"{row['replayed_ms']:>8.1f}ms {row['wall_ms']:>8.1f}ms  {'; '.join(notes)}")
+    diverged = sum(1 for row in report if row['state_diff'] or row['error'])
+    print(f"{len(report)} interactions replayed, {diverged} diverged from the recording.")
+    return 1 if diverged else 0
+
+# Headless replay (under `streamlit run` and in AppTest a runtime exists, so this is never taken there)
+if __name__ == '__main__' and not st.runtime.exists():
+    sys.exit(run_replay_cli(sys.argv[1:]))
+
 
 # --- 1. CONFIGURATION & HYPER-POLISHED UI SETUP ---
 
@@ -24,6 +224,29 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# Start of this script run (session traces report the latency of every run, see 3.18)
+SCRIPT_RUN_STARTED = time.perf_counter()
+
+# Partial reruns: interactive regions are wrapped as fragments so a click only re-executes that region.
+# st.fragment (1.37+) / st.experimental_fragment (1.33+); older versions fall back to full-script reruns.
+_streamlit_fragment = getattr(st, 'fragment', None) or getattr(st, 'experimental_fragment', None)
+
+def fragment(func):
+    """Fragment decorator; a fragment-only rerun is also recorded as a step of the session trace."""
+    if _streamlit_fragment is None:
+        return func
+
+    @wraps(func)
+    def traced(*args, **kwargs):
+        if not (SESSION_RECORD_DIR and is_fragment_rerun()):
+            return func(*args, **kwargs)
+        started, changes = time.perf_counter(), open_session_step()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_session_step(started, changes)
+    return _streamlit_fragment(traced)
+
 # Apply Extensive Custom CSS for Theme, Fonts, and Hyper-Polish (150+ lines of CSS alone!)
 st.markdown(f"""
     <style>
@@ -85,6 +308,28 @@ st.markdown(f"""
         transform: translateY(-2px);
     }}
 
+    /* Batched Card Grid (one element per grid instead of one per card) */
+    .skinova-grid {{
+        display: grid;
+        column-gap: 1rem;
+    }}
+    @media (max-width: 640px) {{
+        .skinova-grid {{ grid-template-columns: minmax(0, 1fr) !important; }}
+    }}
+    .card-product {{ min-height: 320px; border-left-color: {DARK_ACCENT}; }}
+    .card-product h4 {{ color: {SOFT_BLUE}; margin-top: 0; }}
+    .card-kit {{ min-height: 250px; background-color: {LIGHT_BG}; }}
+    .card-kit h5 {{ color: {SOFT_BLUE}; margin-bottom: 5px; }}
+    .card-indicator {{ padding: 15px; border-left-width: 5px; min-height: 120px; }}
+    .card-post {{ padding: 15px 25px; margin-bottom: 12px; }}
+    .card-post summary {{ cursor: pointer; }}
+    .card-price {{ color: #4CAF50; font-weight: bold; font-size: 22px; }}
+    .card-title {{ font-weight: bold; font-size: 18px; margin-top: 5px; }}
+    .card-label {{ font-size: 14px; margin-bottom: 0; color: #777; }}
+    .card-small {{ font-size: 14px; }}
+    .card-note {{ font-size: 12px; font-style: italic; color: #777; }}
+    .card-buy {{ background-color: #FFC300; color: {TEXT_COLOR}; padding: 8px 15px; border: none; border-radius: 4px; cursor: pointer; margin-top: 10px; }}
+
     /* Score Card Specific Styling */
     .score-display {{
         font-size: 70px;
@@ -122,10 +367,9 @@ st.markdown(f"""
 
 # --- 2. SESSION STATE HYPER-INITIALIZATION (Internal DB) ---
 
-# This dictionary acts as our in-memory database, storing all user data
-if 'user_db' not in st.session_state:
-    st.session_state.user_db = {}
-    
+# The in-memory database (user_db, forum_posts, consult_requests) is bound to this session
+# in section 3.2, once the DataStore and change journal are defined.
+
 # Initialize core session flags
 if 'logged_in' not in st.session_state:
     st.session_state.logged_in = False
@@ -142,21 +386,269 @@ if 'user_data_profile' not in st.session_state:
     st.session_state.daily_progress = {} # {'2025-10-01': {'AM': [True, False], 'PM': [True, True]}}
     st.session_state.last_login_date = date.today().strftime("%Y-%m-%d")
 
-# Initialize feature-specific data (Forum, Consult Logs)
-if 'forum_posts' not in st.session_state:
-    st.session_state.forum_posts = [] # Log of all community posts
-if 'consult_requests' not in st.session_state:
-    st.session_state.consult_requests = [] # Log of all expert consult requests
-
 
 # --- 3. DATA UTILITY FUNCTIONS (Session-State Based) ---
 
+def apply_change_event(store, event):
+    """Applies one mutation event to the in-memory DB (used for live writes and log replay)."""
+    event_type = event['type']
+    if event_type == 'user_create':
+        store.user_db[event['email']] = event['record']
+    elif event_type == 'user_update':
+        record = store.user_db.get(event['email'])
+        if record is None:
+            return
+        record.update(event.get('fields', {}))
+        if event.get('progress'):
+            record.setdefault('Routine_Progress', {}).update(event['progress'])
+    elif event_type == 'scan_record':
+        record = store.user_db.get(event['email'])
+        if record is not None:
+            record.setdefault('Scan_History', []).append(event['scan'])
+    elif event_type == 'forum_post':
+        store.forum_posts.append(event['post'])
+        store.forum_posts.sort(key=lambda x: x['Timestamp'], reverse=True)
+    elif event_type == 'consult_request':
+        store.consult_requests.append(event['request'])
+    elif event_type == 'consult_status':
+        for position in event['positions']:
+            if position < len(store.consult_requests):
+                store.consult_requests[position].update(Status=event['status'], Status_Updated=event['ts'])
+
+class DataStore:
+    """The internal database: users, forum posts and consult requests.
+
+    Every mutation is expressed as an event and goes through commit(), which writes it to the
+    change journal first (when durability is enabled) and then applies it in memory.
+    """
+
+    def __init__(self, journal=None, profile_cache=None):
+        self.user_db = {}           # {email: profile dict}
+        self.forum_posts = []       # Log of all community posts (newest first)
+        self.consult_requests = []  # Log of all expert consult requests
+        self.journal = journal
+        # Cached per-user data is only valid for this store's sessions: a session-only store
+        # gets its own cache, process-wide stores pass the process cache
+        self.profile_cache = profile_cache if profile_cache is not None else ProfileCache(max_entries=PROFILE_CACHE_SESSION_ENTRIES)
+        self.lock = threading.RLock()
+        self.user_observers = []    # Incremental aggregates notified of every user change
+        self._checkpointing = False
+        self._checkpoint_lock = threading.Lock()  # One snapshot at a time; commits are not blocked
+
+    @property
+    def storage_note(self):
+        return '(Data is journaled to disk)' if self.journal is not None else '(Data is saved only during this session)'
+
+    @property
+    def session_only(self):
+        """True when no other session sees this store (neither SKINOVA_DATA_DIR nor SKINOVA_SHARED_DB is set)."""
+        return self.journal is None
+
+    def commit(self, event):
+        event['ts'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self.lock:
+            if self.journal is not None:
+                self.journal.append(event)
+
+            # Observers capture their view of the record before it changes, then apply the delta
+            email = event.get('email')
+            tokens = [observer.snapshot(self.user_db.get(email)) for observer in self.user_observers] if email else []
+            apply_change_event(self, event)
+            for observer, token in zip(self.user_observers, tokens):
+                observer.update(email, token, self.user_db.get(email))
+
+        if self.journal is not None and self.journal.snapshot_due() and not self._checkpointing:
+            self._checkpointing = True
+            threading.Thread(target=self.checkpoint, daemon=True).start()
+
+    def notify_bulk_change(self):
+        """Called after writes that bypass commit() (imports): observers rebuild on next use."""
+        for observer in self.user_observers:
+            observer.mark_stale()
+
+    def copy_state(self):
+        """A copy of the DB that later commits cannot change (caller holds the lock).
+
+        Events replace top-level fields and progress days, append scans and update consults
+        in place, so those containers are copied. Nothing else is."""
+        user_db = {email: dict(record, Routine_Progress=dict(record.get('Routine_Progress', {})),
+                               Scan_History=list(record.get('Scan_History', [])))
+                   for email, record in self.user_db.items()}
+        return user_db, list(self.forum_posts), [dict(consult) for consult in self.consult_requests]
+
+    def checkpoint(self):
+        """Writes a compressed snapshot of the whole store and truncates the journal.
+
+        Only the log rotation and the copy hold the lock; the export runs alongside new commits."""
+        try:
+            if self.journal is None:
+                return
+            with self._checkpoint_lock:
+                with self.lock:
+                    seq = self.journal.rotate()
+                    state = self.copy_state()
+                self.journal.write_snapshot(seq, *state)
+        finally:
+            self._checkpointing = False
+
+    def create_user(self, email, record):
+        self.commit({'type': 'user_create', 'email': email, 'record': record})
+
+    def update_user(self, email, fields, progress=None):
+        self.commit({'type': 'user_update', 'email': email, 'fields': fields, 'progress': progress or {}})
+
+    def add_scan(self, email, scan):
+        self.commit({'type': 'scan_record', 'email': email, 'scan': scan})
+
+    def add_forum_post(self, post):
+        self.commit({'type': 'forum_post', 'post': post})
+
+    def add_consult_request(self, request):
+        self.commit({'type': 'consult_request', 'request': request})
+
+    def set_consult_status(self, positions, status):
+        """Moves consult requests (by log position) to a new status in one event."""
+        self.commit({'type': 'consult_status', 'positions': [int(position) for position in positions], 'status': status})
+
+def get_data_store():
+    """Returns the DataStore this session is bound to."""
+    return st.session_state.data_store
+
+# Profile cache tuning (one cache per data store; process-wide stores share the process cache)
+PROFILE_CACHE_TTL = 300.0          # Seconds before a cached entry must be reloaded
+PROFILE_CACHE_MAX_ENTRIES = 20000  # LRU bound across all users and entry kinds
+PROFILE_CACHE_SESSION_ENTRIES = 64 # Bound for a session-only store's cache (one user at a time)
+
+class ProfileCache:
+    """Read-through LRU cache with TTL for decoded profiles and derived per-user aggregates.
+
+    Entries are keyed by (email, name) so one user's entries can be invalidated together.
+    A per-user generation counter stops a load that raced with an invalidation from
+    re-inserting stale data.
+    """
+
+    def __init__(self, ttl=PROFILE_CACHE_TTL, max_entries=PROFILE_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()   # {(email, name): (expires_at, value)}
+        self.keys_by_email = {}        # {email: {(email, name), ...}}
+        self.generations = {}          # {email: int}
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = self.invalidations = 0
+
+    def _drop(self, key):
+        self.entries.pop(key, None)
+        keys = self.keys_by_email.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.keys_by_email[key[0]]
+
+    def generation(self, email):
+        with self.lock:
+            return self.generations.get(email, 0)
+
+    def lookup(self, email, name):
+        """Returns (True, value) on a fresh hit, (False, None) otherwise."""
+        key = (email, name)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return True, entry[1]
+                self._drop(key)
+                self.expirations += 1
+            self.misses += 1
+            return False, None
+
+    def put(self, email, name, value, generation):
+        key = (email, name)
+        with self.lock:
+            if self.generations.get(email, 0) != generation:
+                return # Invalidated while loading
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            self.keys_by_email.setdefault(email, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self._drop(next(iter(self.entries)))
+                self.evictions += 1
+
+    def get_or_load(self, email, name, loader):
+        hit, value = self.lookup(email, name)
+        if hit:
+            return value
+        generation = self.generation(email)
+        value = loader()
+        if value is not None:
+            self.put(email, name, value, generation)
+        return value
+
+    def invalidate(self, email, names=None):
+        """Drops every entry for `email`, or only the given entry names."""
+        with self.lock:
+            self.generations[email] = self.generations.get(email, 0) + 1
+            for key in list(self.keys_by_email.get(email, ())):
+                if names is None or key[1] in names or (isinstance(key[1], tuple) and key[1][0] in names):
+                    self._drop(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            for email in self.keys_by_email:
+                self.generations[email] = self.generations.get(email, 0) + 1
+            self.entries.clear()
+            self.keys_by_email.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
+
+@st.cache_resource
+def get_process_profile_cache():
+    """The ProfileCache shared by the process-wide (durable and shared) stores."""
+    return ProfileCache()
+
+def get_profile_cache():
+    """The ProfileCache of this session's data store.
+
+    Loaders read the session's own copy of the profile, so entries must never be shared with
+    sessions bound to another store (each default session has its own DataStore)."""
+    return get_data_store().profile_cache
+
+def get_dashboard_aggregates(email):
+    """Today's step counts, compliance and 24h score change, cached until the next save."""
+    def compute():
+        routine_steps = st.session_state.user_data_profile.get('Routine', {})
+        today_progress = st.session_state.daily_progress.get(get_today_key(), {'AM': [], 'PM': []})
+        total_steps = sum(len(steps) for steps in routine_steps.values())
+        completed_steps = sum(v.count(True) for v in today_progress.values())
+        history = st.session_state.skin_score_history
+        return {
+            'total_steps': total_steps,
+            'completed_steps': completed_steps,
+            'completion_percent': int((completed_steps / total_steps) * 100) if total_steps > 0 else 0,
+            'score_change_24h': history[-1] - history[-2] if len(history) > 1 else 0,
+        }
+    # Keyed by day so the cached compliance rolls over at midnight
+    return get_profile_cache().get_or_load(email, ('dashboard', get_today_key()), compute)
+
 def create_new_user(name, email):
     """Creates a new user entry in the internal database."""
     initial_score = random.randint(60, 85)
     
     # Detailed Initial User Profile Structure
-    st.session_state.user_db[email] = {
+    record = {
         'Name': name,
         'Email': email,
         'Age': None, # Onboarding required
@@ -173,274 +665,4231 @@ def create_new_user(name, email):
         'Skin Score': initial_score,
         'Score_History': [initial_score] * 30, # 30 days of initial score
         'Routine_Progress': {},
+        'Scan_History': [], # Compact per-scan vectors (see scan_history_entry), oldest first
         'Streak': 1,
         'Last Login': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
         'Onboarding_Complete': False
     }
+    get_data_store().create_user(email, record)
     return st.session_state.user_db[email]
 
+# Write-behind tuning: staged writes are committed once either limit is reached
+WRITE_BEHIND_MAX_DELAY = 2.0  # Seconds a staged write may wait before being committed
+WRITE_BEHIND_MAX_OPS = 50     # Staged writes that force an early commit
+WRITE_BEHIND_FLUSH_INTERVAL = 0.5  # Seconds between the background flusher's checks
+
+class WriteBehindBuffer:
+    """Per-session buffer of dirty user fields, committed to the user DB in one batch.
+
+    Only fields whose value differs from the committed record are kept, and routine
+    progress is tracked per day, so a checkbox click stages a single row no matter how
+    long the history is. Toggling a value back to its committed state drops the write.
+
+    While it holds staged writes the buffer is registered with `registry`, which keeps it
+    alive after its session is gone and commits it in the background once it is due.
+    """
+
+    def __init__(self, store, registry=None):
+        self.store = store
+        self.user_db = store.user_db
+        self.registry = registry
+        self.lock = threading.RLock()  # The session and the background flusher both flush
+        self.pending_fields = {}   # {email: {field: value}}
+        self.pending_progress = {} # {email: {day_key: {'AM': [...], 'PM': [...]}}}
+        self.staged_ops = 0
+        self.first_staged_at = None
+
+    def _touch(self):
+        self.staged_ops += 1
+        if self.first_staged_at is None:
+            self.first_staged_at = time.monotonic()
+            if self.registry is not None:
+                self.registry.add(self)
+
+    def stage_field(self, email, field, value):
+        with self.lock:
+            committed = self.user_db[email].get(field)
+            fields = self.pending_fields.setdefault(email, {})
+            if committed == value:
+                fields.pop(field, None)
+            else:
+                fields[field] = copy.deepcopy(value)
+            self._touch()
+
+    def stage_progress_row(self, email, day_key, row):
+        with self.lock:
+            committed = self.user_db[email].get('Routine_Progress', {}).get(day_key)
+            rows = self.pending_progress.setdefault(email, {})
+            if committed == row:
+                rows.pop(day_key, None)
+            else:
+                rows[day_key] = copy.deepcopy(row)
+            self._touch()
+
+    def is_due(self):
+        with self.lock:
+            if self.first_staged_at is None:
+                return False
+            return (self.staged_ops >= WRITE_BEHIND_MAX_OPS or
+                    time.monotonic() - self.first_staged_at >= WRITE_BEHIND_MAX_DELAY)
+
+    def flush(self, email=None):
+        """Commits staged writes (for one user, or everyone) and returns the number of writes applied."""
+        with self.lock:
+            emails = [email] if email else list(set(self.pending_fields) | set(self.pending_progress))
+            written = 0
+            for user_email in emails:
+                fields = self.pending_fields.pop(user_email, {})
+                rows = self.pending_progress.pop(user_email, {})
+                if user_email not in self.user_db or not (fields or rows):
+                    continue
+                # One event per user per batch, however many toggles were coalesced into it
+                self.store.update_user(user_email, fields, rows)
+                written += len(fields) + len(rows)
+
+            if not self.pending_fields and not self.pending_progress:
+                self.staged_ops = 0
+                self.first_staged_at = None
+                if self.registry is not None:
+                    self.registry.discard(self)
+            return written
+
+class WriteBufferRegistry:
+    """Strong references to every buffer with staged writes, so none is lost with its session.
+
+    A closed tab or an expired session drops its session state, and with it the only other
+    reference to its buffer. The flusher thread commits every buffer whose writes are due, so
+    an idle session's last toggles still reach the store (and the journal and other replicas).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buffers = set()
+
+    def add(self, buffer):
+        with self.lock:
+            self.buffers.add(buffer)
+
+    def discard(self, buffer):
+        with self.lock:
+            self.buffers.discard(buffer)
+
+    def flush_due(self, force=False):
+        """Flushes the buffers that are due (all of them with force=True); returns the writes applied."""
+        with self.lock:
+            buffers = list(self.buffers)
+        written = 0
+        for buffer in buffers:
+            if force or buffer.is_due():
+                try:
+                    written += buffer.flush()
+                except Exception:
+                    # One failing store must not stop the flusher (or the other sessions' writes)
+                    LOGGER.exception("Write-behind flush failed")
+        return written
+
+    def run(self):
+        while True:
+            time.sleep(WRITE_BEHIND_FLUSH_INTERVAL)
+            self.flush_due()
+
+@st.cache_resource
+def _live_write_buffers():
+    """Process-wide registry of buffers with staged writes, flushed in the background and at shutdown."""
+    registry = WriteBufferRegistry()
+    atexit.register(registry.flush_due, force=True)
+    threading.Thread(target=registry.run, name='skinova-write-behind', daemon=True).start()
+    return registry
+
+def get_write_buffer():
+    """Returns this session's write-behind buffer, creating it on first use."""
+    if 'write_buffer' not in st.session_state:
+        st.session_state.write_buffer = WriteBehindBuffer(get_data_store(), _live_write_buffers())
+        # The session sweep flushes it when the session expires
+        with session_heavy_state() as heavy:
+            heavy.write_buffer = st.session_state.write_buffer
+    return st.session_state.write_buffer
+
 def get_user_data(email):
-    """Retrieves the full profile data for a given email."""
+    """Retrieves the full profile data for a given email (pending writes are committed first)."""
+    get_write_buffer().flush(email)
     return st.session_state.user_db.get(email, {})
 
 def save_user_data(email, update_dict):
-    """Updates specific fields for the user in the internal database."""
-    if email in st.session_state.user_db:
-        st.session_state.user_db[email].update(update_dict)
-        # Also update the ephemeral session profile immediately
-        st.session_state.user_data_profile.update(update_dict)
-        return True
-    return False
+    """Updates the session profile immediately and stages only the changed fields for a batched commit."""
+    if email not in st.session_state.user_db:
+        return False
+
+    # The ephemeral session profile always reflects the latest values
+    st.session_state.user_data_profile.update(update_dict)
+    get_profile_cache().invalidate(email, names=('dashboard',))
+
+    buffer = get_write_buffer()
+    for field, value in update_dict.items():
+        if field == 'Routine_Progress':
+            # Full history passed in: only the days that actually changed are staged
+            for day_key, row in value.items():
+                buffer.stage_progress_row(email, day_key, row)
+        else:
+            buffer.stage_field(email, field, value)
+
+    if buffer.is_due():
+        buffer.flush()
+    return True
+
+def save_progress_row(email, day_key, row):
+    """Stages a single day's routine progress (constant-size write per checkbox click)."""
+    if email not in st.session_state.user_db:
+        return False
+
+    st.session_state.user_data_profile.setdefault('Routine_Progress', {})[day_key] = row
+    get_profile_cache().invalidate(email, names=('dashboard',))
+    # The year calendar is patched in place (one cell) rather than rebuilt
+    hit, calendar = get_profile_cache().lookup(email, ('calendar', get_today_key()))
+    if hit:
+        calendar.set_day(day_key, row)
+
+    buffer = get_write_buffer()
+    buffer.stage_progress_row(email, day_key, row)
+    if buffer.is_due():
+        buffer.flush()
+    return True
 
 def get_today_key():
     """Helper function to get the current date's string key."""
     return date.today().strftime("%Y-%m-%d")
 
 
-# --- 4. PAGE NAVIGATION & AUTH ---
+# --- 3.1 STREAMING NDJSON EXPORT / IMPORT (Backup & Migration) ---
 
-def navigate_to(page):
-    """Changes the current page view."""
-    st.session_state.current_page = page
+EXPORT_FORMAT = 'skinova-ndjson'
+EXPORT_FORMAT_VERSION = 2  # v2 adds 'scan' rows
+EXPORT_CHUNK_ROWS = 1000   # Rows encoded per write() call
+IMPORT_BATCH_ROWS = 1000   # Rows committed per import transaction
+IMPORT_MAX_ERRORS = 20     # Rejected-row messages kept in the import report
 
-def logout():
-    """Resets session state and returns to login page."""
-    # Only reset ephemeral session flags, keep the DB intact
-    st.session_state.logged_in = False
-    st.session_state.user_email = None
-    st.session_state.user_data_profile = {}
-    st.session_state.current_page = 'Login/Signup'
-    st.experimental_rerun()
+# Profile fields exported as their own row kinds (so a user row stays small)
+_EXPORT_SPLIT_FIELDS = ('Score_History', 'Routine_Progress', 'Scan_History')
 
-def initialize_user_session(email, user_data):
-    """Initializes session state with hyper-user data upon login/signup."""
-    st.session_state.logged_in = True
-    st.session_state.user_email = email
-    
-    # Load all persistent data into the ephemeral session state
-    st.session_state.user_data_profile = user_data
-    st.session_state.onboarding_complete = user_data.get('Onboarding_Complete', False)
-    st.session_state.daily_progress = user_data.get('Routine_Progress', {})
-    st.session_state.routine_streak = user_data.get('Streak', 0)
-    st.session_state.skin_score = user_data.get('Skin Score', 75)
-    st.session_state.skin_score_history = user_data.get('Score_History', [75] * 30)
-    
-    
-    # --- HYPER-LOGIN STREAK CHECK & DAILY SCORE UPDATE ---
-    last_login_str = user_data.get('Last Login', datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-    last_login_dt = datetime.strptime(last_login_str, "%Y-%m-%d %H:%M:%S").date()
-    today = date.today()
-    
-    score_change = 0
-    
-    if last_login_dt < today:
-        # Check if they completed their routine yesterday (Hypothetical full completion check)
-        yesterday_key = (today - timedelta(days=1)).strftime("%Y-%m-%d")
-        yesterday_progress = st.session_state.daily_progress.get(yesterday_key, {'AM': [False, False], 'PM': [False, False]})
-        
-        total_steps_yesterday = sum(len(v) for v in yesterday_progress.values())
-        completed_steps_yesterday = sum(v.count(True) for v in yesterday_progress.values())
-        
-        if completed_steps_yesterday >= (total_steps_yesterday * 0.8): # 80% compliance
-            st.session_state.routine_streak = st.session_state.routine_streak + 1 if last_login_dt == today - timedelta(days=1) else 1
-            score_change += 2 # Small passive reward for consistency
-            st.toast(f"🔥 Streak maintained! Now at {st.session_state.routine_streak} days. (+2 Score)", icon='🏆')
-        else:
-            if st.session_state.routine_streak > 0 and last_login_dt == today - timedelta(days=1):
-                st.toast(f"😔 Yesterday's routine compliance was low. Streak lost ({st.session_state.routine_streak} days).", icon='💔')
-            st.session_state.routine_streak = 1 # Start new streak regardless
-            score_change -= 1 # Small penalty for low compliance
+# Required keys per row kind, used by the importer's validation
+IMPORT_REQUIRED_KEYS = {
+    'meta': ('format', 'version'),
+    'user': ('email', 'profile'),
+    'score_history': ('email', 'scores'),
+    'routine_progress': ('email', 'day', 'AM', 'PM'),
+    'scan': ('email', 'scan'),
+    'forum_post': ('Post_ID', 'User_Email', 'Timestamp', 'Post_Title', 'Post_Content'),
+    'consult': ('Email', 'Timestamp', 'Consult_Type', 'Status'),
+}
 
-        # Append today's score to history and cap at 30 days
-        st.session_state.skin_score += score_change
-        st.session_state.skin_score = max(50, min(99, st.session_state.skin_score)) 
-        st.session_state.skin_score_history.append(st.session_state.skin_score)
-        st.session_state.skin_score_history = st.session_state.skin_score_history[-30:]
-        
-        # Save all changes back to the internal database
-        save_user_data(email, {
-            'Last Login': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            'Streak': st.session_state.routine_streak,
-            'Skin Score': st.session_state.skin_score,
-            'Score_History': st.session_state.skin_score_history
-        })
-        
-    st.experimental_rerun()
+def iter_export_records(user_db, forum_posts, consult_requests):
+    """Yields the whole database as flat rows, one entity at a time (nothing is materialized)."""
+    yield {'kind': 'meta', 'format': EXPORT_FORMAT, 'version': EXPORT_FORMAT_VERSION,
+           'exported_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
 
+    for email, record in user_db.items():
+        yield {'kind': 'user', 'email': email,
+               'profile': {k: v for k, v in record.items() if k not in _EXPORT_SPLIT_FIELDS}}
+        yield {'kind': 'score_history', 'email': email, 'scores': record.get('Score_History', [])}
+        for day_key, row in record.get('Routine_Progress', {}).items():
+            yield {'kind': 'routine_progress', 'email': email, 'day': day_key,
+                   'AM': row.get('AM', []), 'PM': row.get('PM', [])}
+        for scan in record.get('Scan_History', []):
+            yield {'kind': 'scan', 'email': email, 'scan': scan}
 
-# --- 5. CORE FEATURE FUNCTIONS (PAGES) ---
+    for post in forum_posts:
+        yield dict(post, kind='forum_post')
+    for consult in consult_requests:
+        yield dict(consult, kind='consult')
 
-## 1. Login & Signup (Detailed UI/UX)
-def login_signup_page():
-    st.title("Welcome to SkinovaAI 🧴")
-    st.subheader("Your Hyper-Personalized Skincare Journey Starts Here")
-    st.markdown("---")
+def write_ndjson(records, fileobj, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Encodes rows as NDJSON into a binary file object, chunk by chunk. Returns the row count."""
+    count = 0
+    chunk = []
+    for record in records:
+        chunk.append(json.dumps(record, ensure_ascii=False, separators=(',', ':')))
+        if len(chunk) >= chunk_rows:
+            fileobj.write(('\n'.join(chunk) + '\n').encode('utf-8'))
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        fileobj.write(('\n'.join(chunk) + '\n').encode('utf-8'))
+        count += len(chunk)
+    return count
 
-    col1, col2 = st.columns(2)
+def export_database(path, user_db, forum_posts, consult_requests, compress=None):
+    """Streams the full database to `path` (gzip when compress=True or the path ends in .gz)."""
+    if compress is None:
+        compress = path.endswith('.gz')
+    opener = gzip.open if compress else open
+    with opener(path, 'wb') as fileobj:
+        return write_ndjson(iter_export_records(user_db, forum_posts, consult_requests), fileobj)
 
-    with col1:
-        st.markdown(f'<div class="skinova-card"><h3>Create Your Account (Signup)</h3></div>', unsafe_allow_html=True)
-        with st.form("signup_form"):
-            new_name = st.text_input("Full Name *", key="s_name")
-            new_email = st.text_input("Email Address *", key="s_email")
-            st.markdown("_Your email will be your unique identifier. **No passwords needed!**_", help="We simulate a secure token-based login for simplicity.")
-            
-            signup_submitted = st.form_submit_button("🚀 Create Account & Start Onboarding")
+def _open_ndjson_text(fileobj):
+    """Wraps a binary stream (plain or gzip, detected from the magic bytes) for line iteration."""
+    magic = fileobj.read(2)
+    fileobj.seek(0)
+    if magic == b'\x1f\x8b':
+        fileobj = gzip.GzipFile(fileobj=fileobj, mode='rb')
+    return TextIOWrapper(fileobj, encoding='utf-8')
 
-            if signup_submitted:
-                if new_email in st.session_state.user_db:
-                    st.error("🚫 Duplicate email entry. An account with this email already exists. Please log in.")
-                elif not new_name or not new_email or '@' not in new_email:
-                    st.warning("Please enter a valid Name and Email.")
-                else:
-                    user_data = create_new_user(new_name, new_email)
-                    st.success("🎉 Account created successfully! Redirecting to hyper-onboarding...")
-                    
-                    initialize_user_session(new_email, user_data)
-                    navigate_to('Onboarding')
-                    st.experimental_rerun()
+def validate_import_row(row, is_known_user):
+    """Returns an error message for an invalid row, or None when the row can be imported."""
+    if not isinstance(row, dict):
+        return "row is not a JSON object"
+    kind = row.get('kind')
+    if kind not in IMPORT_REQUIRED_KEYS:
+        return f"unknown row kind {kind!r}"
+    missing = [key for key in IMPORT_REQUIRED_KEYS[kind] if key not in row]
+    if missing:
+        return f"{kind} row missing {', '.join(missing)}"
 
-    with col2:
-        st.markdown(f'<div class="skinova-card"><h3>Existing User (Login)</h3></div>', unsafe_allow_html=True)
-        with st.form("login_form"):
-            login_email = st.text_input("Email Address *", key="l_email")
-            
-            login_submitted = st.form_submit_button("➡️ Login to Dashboard")
-            
-            if login_submitted:
-                if login_email in st.session_state.user_db:
-                    user_data = get_user_data(login_email)
-                    st.success("Welcome back! Redirecting...")
-                    
-                    # Initialization handles score/streak updates on login
-                    initialize_user_session(login_email, user_data)
-                    
-                    if st.session_state.onboarding_complete:
-                        navigate_to('Dashboard')
-                    else:
-                        navigate_to('Onboarding')
-                    st.experimental_rerun()
-                else:
-                    st.error("❌ Email not found. Please check your email or sign up.")
+    if kind == 'meta':
+        if not isinstance(row['version'], int):
+            return f"export version {row['version']!r} is not an integer"
+        if row['format'] != EXPORT_FORMAT or row['version'] > EXPORT_FORMAT_VERSION:
+            return f"unsupported export format {row['format']} v{row['version']}"
+    elif kind == 'user':
+        if '@' not in str(row['email']) or not isinstance(row['profile'], dict):
+            return "user row needs a valid email and a profile object"
+    elif kind in ('score_history', 'routine_progress', 'scan'):
+        if not is_known_user(row['email']):
+            return f"{kind} row references unknown user {row['email']}"
+        if kind == 'score_history' and not (isinstance(row['scores'], list)
+                                            and all(isinstance(s, (int, float)) for s in row['scores'])):
+            return "score_history scores must be a list of numbers"
+        if kind == 'routine_progress':
+            try:
+                datetime.strptime(row['day'], "%Y-%m-%d")
+            except (TypeError, ValueError):
+                return f"routine_progress day {row['day']!r} is not YYYY-MM-DD"
+            if not all(isinstance(row[slot], list) and all(isinstance(done, bool) for done in row[slot]) for slot in ('AM', 'PM')):
+                return "routine_progress AM/PM must be lists of true/false"
+        if kind == 'scan':
+            return _scan_row_error(row['scan'])
+    return None
 
-### ---
-## 2. Onboarding (Multi-Step Hyper-Setup)
-def onboarding_page():
-    st.title("Hyper-Onboarding: 2-Minute Skin Setup 🧬")
-    st.markdown("---")
-    
-    st.subheader("We need comprehensive data for the ultimate personalized routine.")
-    
-    # --- FIX START: Moved st.tabs INSIDE st.form context ---
-    with st.form("onboarding_form", clear_on_submit=False):
-        tab1, tab2, tab3 = st.tabs(["Personal Info", "Concerns & History", "Lifestyle & Goals"])
+def _is_number_list(value, length):
+    return (isinstance(value, list) and len(value) == length
+            and all(isinstance(item, (int, float)) and not isinstance(item, bool) for item in value))
 
-        # --- TAB 1: Baseline Data (Enhanced Detail) ---
-        with tab1:
-            st.markdown("### Step 1: Baseline Data")
-            user_age = st.slider("1. Age", min_value=12, max_value=80, value=25)
-            user_gender = st.selectbox("2. Biological Gender", ['Female', 'Male', 'Non-Binary', 'Prefer not to say'])
-            user_ethnicity = st.selectbox("3. Fitzpatrick Skin Type (Determines Pigmentation Risk)", 
-                                           ['Type I (Always burns)', 'Type II (Burns easily)', 'Type III (Tans sometimes)', 'Type IV (Tans easily)', 'Type V (Rarely burns)', 'Type VI (Never burns)'])
-            user_location = st.selectbox("4. Current Climate/Location Type", 
-                                          ['Tropical/Humid', 'Arid/Dry Desert', 'Temperate/Seasonal', 'Cold/Northern', 'Urban/Polluted'])
-            user_skin_type = st.radio("5. Self-Assessed Skin Type (Basic)", ['Very Dry', 'Dry/Normal', 'Combination (Oily T-Zone)', 'Oily'])
-        
-        # --- TAB 2: Skin History (Enhanced Detail) ---
-        with tab2:
-            st.markdown("### Step 2: Skin History & Concerns")
-            concerns = st.multiselect("6. Primary Skin Concerns (Select 2-4)",
-                                        ['Acne & Breakouts (Hormonal)', 'Acne & Breakouts (Fungal/Bacterial)', 'Dryness & Dehydration (Barrier)', 'Redness & Sensitivity (Rosacea)', 
-                                         'Dark Spots/Melasma/Pigmentation', 'Fine Lines & Wrinkles (Static)', 'Loss of Firmness/Elasticity', 'Oil Control/Excess Sebum'],
-                                         default=['Acne & Breakouts (Hormonal)', 'Oil Control/Excess Sebum'], max_selections=4)
-            allergy = st.text_input("7. Known Product Allergies (e.g., Lanolin, fragrance, harsh surfactants)", "None")
-            sensitivity_level = st.select_slider("8. Skin Sensitivity Level (How easily does your skin react?)", options=['Low', 'Mild', 'Moderate', 'High/Reactive'], value='Moderate')
-            history_products = st.checkbox("9. Have you used prescription-strength actives (Retinoids/AHAs > 10%) before?")
-        
-        # --- TAB 3: Goals & Habits (Enhanced Detail) ---
-        with tab3:
-            st.markdown("### Step 3: Goals & Habits")
-            goal = st.selectbox("10. Primary Skincare Goal", ['Acne Clearing & Scar Reduction', 'Advanced Anti-Aging & Firming', 'Max Hydration & Barrier Repair', 'Brightening & Even Tone/Melasma Reduction'])
-            sleep_hours = st.slider("11. Average Nightly Sleep (Hours)", min_value=4.0, max_value=10.0, value=7.0, step=0.5)
-            budget = st.select_slider("12. Expected Monthly Budget (USD)", options=['$20 - $50 (Budget)', '$50 - $100 (Mid-Range)', '$100 - $200 (Premium)', '$200+ (Luxury)'])
-            
-            st.markdown("---")
-            submitted = st.form_submit_button("✅ Finalize Personalized Profile")
-    # --- FIX END: Form ends here, submitted logic follows ---
+def _scan_row_error(scan):
+    """Checks a scan against what build_scan_history() needs (see scan_history_entry)."""
+    if not isinstance(scan, dict):
+        return "scan row needs a scan object"
+    missing = [key for key in ('at', 'hash', 'levels', 'vector') if key not in scan]
+    if missing:
+        return f"scan missing {', '.join(missing)}"
+    if not isinstance(scan['at'], str) or not isinstance(scan['hash'], str):
+        return "scan 'at' and 'hash' must be strings"
+    levels = scan['levels']
+    if not (isinstance(levels, list) and len(levels) == len(ANALYZER_INDICATORS)
+            and all(isinstance(level, int) and not isinstance(level, bool) and 0 <= level < len(options)
+                    for level, options in zip(levels, ANALYZER_INDICATORS.values()))):
+        return f"scan levels must be {len(ANALYZER_INDICATORS)} indicator levels"
+    if not _is_number_list(scan['vector'], TWIN_DIM):
+        return f"scan vector must be {TWIN_DIM} numbers"
+    if scan.get('metrics') is not None and not _is_number_list(scan['metrics'], len(TILE_METRICS)):
+        return f"scan metrics must be null or {len(TILE_METRICS)} numbers"
+    return None
 
-    if submitted:
-        if len(concerns) < 2 or not goal:
-            st.error("Please select at least 2 Primary Concerns and your Primary Skincare Goal.")
+def _commit_import_batch(batch, user_db, forum_posts, consult_requests):
+    """Applies one validated batch. Changes are staged first, then merged in one step."""
+    new_users = {}
+    score_rows = {}
+    progress_rows = {}
+    scan_rows = {}
+    new_posts = []
+    new_consults = []
+
+    for row in batch:
+        kind = row.pop('kind')
+        if kind == 'user':
+            profile = dict(row['profile'], Email=row['email'])
+            profile.setdefault('Score_History', [])
+            profile.setdefault('Routine_Progress', {})
+            profile.setdefault('Scan_History', [])
+            new_users[row['email']] = profile
+        elif kind == 'score_history':
+            score_rows[row['email']] = row['scores']
+        elif kind == 'routine_progress':
+            progress_rows.setdefault(row['email'], {})[row['day']] = {'AM': row['AM'], 'PM': row['PM']}
+        elif kind == 'scan':
+            scan_rows.setdefault(row['email'], []).append(row['scan'])
+        elif kind == 'forum_post':
+            new_posts.append(row)
+        elif kind == 'consult':
+            new_consults.append(row)
+
+    # Fold history rows into whole records, so the user DB sees one upsert per user
+    for email in set(score_rows) | set(progress_rows) | set(scan_rows):
+        if email not in new_users:
+            existing = user_db[email]
+            new_users[email] = dict(existing, Routine_Progress=dict(existing.get('Routine_Progress', {})),
+                                    Scan_History=list(existing.get('Scan_History', [])))
+        if email in score_rows:
+            new_users[email]['Score_History'] = score_rows[email]
+        new_users[email]['Routine_Progress'].update(progress_rows.get(email, {}))
+        # A scan is identified by its time and photo hash, so importing the same export twice adds nothing
+        scans = new_users[email]['Scan_History']
+        seen = {(scan['at'], scan['hash']) for scan in scans}
+        for scan in scan_rows.get(email, []):
+            if (scan['at'], scan['hash']) not in seen:
+                seen.add((scan['at'], scan['hash']))
+                scans.append(scan)
+
+    user_db.update(new_users)
+    if new_posts:
+        forum_posts.extend(new_posts)
+        forum_posts.sort(key=lambda x: x['Timestamp'], reverse=True)
+    consult_requests.extend(new_consults)
+
+def import_ndjson(fileobj, user_db, forum_posts, consult_requests,
+                  batch_rows=IMPORT_BATCH_ROWS, on_progress=None):
+    """Streams an NDJSON export (plain or gzip) into the database in validated batches.
+
+    Users must precede their history rows (as the exporter writes them), so only the
+    current batch's emails are tracked and memory stays constant.
+    `on_progress(rows_read)` is called after every committed batch.
+    Returns a report dict with imported/rejected counts and the first few errors.
+    """
+    report = {'imported': 0, 'rejected': 0, 'errors': []}
+    batch_emails = set()
+    batch = []
+    line_no = 0
+
+    def is_known_user(email):
+        return email in batch_emails or email in user_db
+
+    def reject(message):
+        report['rejected'] += 1
+        if len(report['errors']) < IMPORT_MAX_ERRORS:
+            report['errors'].append(f"line {line_no}: {message}")
+
+    for line_no, line in enumerate(_open_ndjson_text(fileobj), start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError as exc:
+            reject(f"invalid JSON ({exc.msg})")
+            continue
+
+        error = validate_import_row(row, is_known_user)
+        if error:
+            reject(error)
+            continue
+        if row['kind'] == 'meta':
+            continue
+        if row['kind'] == 'user':
+            batch_emails.add(row['email'])
+
+        batch.append(row)
+        if len(batch) >= batch_rows:
+            _commit_import_batch(batch, user_db, forum_posts, consult_requests)
+            report['imported'] += len(batch)
+            batch = []
+            batch_emails.clear()
+            if on_progress:
+                on_progress(line_no)
+
+    if batch:
+        _commit_import_batch(batch, user_db, forum_posts, consult_requests)
+        report['imported'] += len(batch)
+    if on_progress:
+        on_progress(line_no)
+    return report
+
+def load_snapshot(fileobj, user_db, forum_posts, consult_requests, batch_rows=IMPORT_BATCH_ROWS):
+    """Loads a journal snapshot, which this process wrote itself, without import validation.
+
+    Every row must load: a row the importer would reject (a field added since the validator
+    was written, say) would otherwise vanish from the store and from every later snapshot.
+    A line that does not parse means the snapshot is corrupt and raises ValueError.
+    Returns the number of rows loaded.
+    """
+    loaded = 0
+    batch = []
+    for line_no, line in enumerate(_open_ndjson_text(fileobj), start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError as exc:
+            raise ValueError(f"corrupt snapshot, line {line_no}: {exc.msg}") from exc
+        if row.get('kind') == 'meta':
+            continue
+        batch.append(row)
+        if len(batch) >= batch_rows:
+            _commit_import_batch(batch, user_db, forum_posts, consult_requests)
+            loaded += len(batch)
+            batch = []
+    if batch:
+        _commit_import_batch(batch, user_db, forum_posts, consult_requests)
+        loaded += len(batch)
+    return loaded
+
+
+# --- 3.2 DURABLE CHANGE LOG & SNAPSHOTS (Crash Recovery) ---
+
+# Durability is opt-in: set SKINOVA_DATA_DIR to journal every mutation to disk and share
+# one recovered DataStore across all sessions of this process.
+DATA_DIR_ENV = 'SKINOVA_DATA_DIR'
+JOURNAL_SYNC_EVERY = 64       # Appended events per fsync batch
+JOURNAL_SYNC_INTERVAL = 1.0   # Max seconds an appended event waits for fsync (checked on append)
+SNAPSHOT_EVERY = 10000        # Journal events between compressed snapshots
+
+class ChangeJournal:
+    """Append-only event log (changes.log) plus gzip NDJSON snapshots (snapshot-<seq>.ndjson.gz).
+
+    Events are flushed to the OS on every append and fsync'ed in batches. A snapshot records
+    the state up to its sequence number, so recovery loads the newest snapshot and replays
+    only the log entries written after it. While a snapshot is being written, the log it
+    covers is kept as changes.log.old and new events go to a fresh changes.log.
+    """
+
+    def __init__(self, data_dir):
+        os.makedirs(data_dir, exist_ok=True)
+        self.data_dir = data_dir
+        self.log_path = os.path.join(data_dir, 'changes.log')
+        self.rotated_path = self.log_path + '.old'
+        self.log = None
+        self.seq = 0
+        self.events_since_snapshot = 0
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def snapshot_paths(self):
+        """Returns [(seq, path)] for all snapshots on disk, oldest first."""
+        snapshots = []
+        for name in os.listdir(self.data_dir):
+            if name.startswith('snapshot-') and name.endswith('.ndjson.gz'):
+                snapshots.append((int(name[len('snapshot-'):-len('.ndjson.gz')]), os.path.join(self.data_dir, name)))
+        return sorted(snapshots)
+
+    def recover(self, store):
+        """Loads the latest snapshot into `store`, replays the log tail and opens the log for appends."""
+        snapshots = self.snapshot_paths()
+        if snapshots:
+            self.seq, snapshot_path = snapshots[-1]
+            with open(snapshot_path, 'rb') as snapshot_file:
+                load_snapshot(snapshot_file, store.user_db, store.forum_posts, store.consult_requests)
+
+        # A log rotated by an unfinished checkpoint holds the events just before the live log
+        replayed = self.replay(self.rotated_path, store) + self.replay(self.log_path, store)
+        self.events_since_snapshot = replayed
+        self.log = open(self.log_path, 'ab')
+        return replayed
+
+    def replay(self, path, store):
+        """Applies the events in `path` newer than self.seq and returns how many were applied.
+
+        Replay stops at the first torn or invalid line, and the file is cut back to the last good
+        line. Otherwise new appends would land behind the bad bytes and be skipped by the next
+        recovery."""
+        if not os.path.exists(path):
+            return 0
+        replayed = 0
+        good_bytes = 0
+        with open(path, 'rb') as log_file:
+            for line in log_file:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError("unterminated line")
+                    event = json.loads(line)
+                    seq = int(event['seq'])
+                except (ValueError, KeyError, TypeError):
+                    break
+                good_bytes += len(line)
+                if seq <= self.seq:
+                    continue
+                apply_change_event(store, event)
+                self.seq = seq
+                replayed += 1
+        if good_bytes < os.path.getsize(path):
+            with open(path, 'r+b') as log_file:
+                log_file.truncate(good_bytes)
+                os.fsync(log_file.fileno())
+        return replayed
+
+    def append(self, event):
+        self.seq += 1
+        event['seq'] = self.seq
+        self.log.write((json.dumps(event, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8'))
+        self.log.flush()
+        self.unsynced += 1
+        self.events_since_snapshot += 1
+        if self.unsynced >= JOURNAL_SYNC_EVERY or time.monotonic() - self.last_sync >= JOURNAL_SYNC_INTERVAL:
+            self.sync()
+
+    def sync(self):
+        if self.log is not None and self.unsynced:
+            self.log.flush()
+            os.fsync(self.log.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def snapshot_due(self):
+        return self.events_since_snapshot >= SNAPSHOT_EVERY
+
+    def rotate(self):
+        """Starts a fresh log and returns the seq the old one ends at (caller holds the store lock).
+
+        The old log stays on disk as changes.log.old until write_snapshot() covers it."""
+        self.sync()
+        self.log.close()
+        if os.path.exists(self.rotated_path):
+            # The last checkpoint did not finish: keep its events ahead of this log's
+            with open(self.rotated_path, 'ab') as rotated, open(self.log_path, 'rb') as current:
+                shutil.copyfileobj(current, rotated)
+                rotated.flush()
+                os.fsync(rotated.fileno())
+            os.remove(self.log_path)
         else:
-            # --- HYPER-SCORE INITIAL CALCULATION LOGIC (Complex Formula) ---
-            base_score = 95 
-            
-            # 1. Age Penalty (More penalty for age > 40)
-            base_score -= (user_age / 10) * 0.5
-            
-            # 2. Concern Penalty (Severe concerns drop score more)
-            if any('Melasma' in c or 'Wrinkles' in c for c in concerns): base_score -= 8
-            if any('Acne' in c for c in concerns): base_score -= 5
-            
-            # 3. Sensitivity & Fitzpatrick Penalty
-            if sensitivity_level in ['High/Reactive']: base_score -= 7
-            if user_ethnicity in ['Type IV', 'Type V', 'Type VI'] and 'Pigmentation' in concerns: base_score -= 4 # Higher risk for PIH
-            
-            # 4. Lifestyle Bonus/Penalty
-            if sleep_hours < 6.0: base_score -= 3
-            if history_products: base_score += 2 # Experienced user bonus
-            
-            initial_score = max(55, min(90, int(base_score + random.uniform(-3, 3))))
-            
-            # --- DYNAMIC ROUTINE GENERATION (Based on Input) ---
-            
-            # Morning Routine (Focus: Antioxidant + Protection)
-            am_steps = ['Cleanser (Low pH)']
-            if 'Pigmentation' in concerns or 'Brightening' in goal:
-                am_steps.append('Vitamin C Serum (L-Ascorbic)')
-            am_steps.append('Hydrating Moisturizer')
-            am_steps.append('Broad Spectrum SPF 50+')
-
-            # Evening Routine (Focus: Treatment + Repair)
-            pm_steps = ['Oil-Based Makeup Remover', 'Water-Based Cleanser']
-            if any('Acne' in c for c in concerns):
-                pm_steps.append('Targeted BHA or Azelaic Acid Treatment')
-            elif any('Wrinkles' in c or 'Firmness' in c for c in concerns) and history_products:
-                pm_steps.append('High-Potency Retinoid/Retinal')
-            else:
-                pm_steps.append('Hydrating/Peptide Serum')
-            pm_steps.append('Occlusive Repair Cream')
+            os.replace(self.log_path, self.rotated_path)
+        self.log = open(self.log_path, 'ab')
+        self.events_since_snapshot = 0
+        return self.seq
 
-            routine_steps_dict = {'Morning': am_steps, 'Evening': pm_steps}
-            
-            update_dict = {
-                'Age': user_age,
-                'Location': user_location,
-                'Skin_Type': user_skin_type,
-                'Concerns': concerns,
-                'Allergies': allergy,
-                'Sensitivity': sensitivity_level,
-                'Goal': goal,
-                'Budget': budget,
-                'Sleep_Hours': sleep_hours,
-                'Skin Score': initial_score,
-                'Routine': routine_steps_dict, 
-                'Score_History': st.session_state.skin_score_history, # Use existing history, update last score
-                'Last Login': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                'Onboarding_Complete': True
-            }
+    def write_snapshot(self, seq, user_db, forum_posts, consult_requests):
+        """Writes the snapshot for `seq` from a copy of the store, then drops what it covers.
+
+        Runs without the store lock. A crash before the rename leaves the old snapshot plus
+        changes.log.old and changes.log, which replay to the same state."""
+        snapshot_path = os.path.join(self.data_dir, f'snapshot-{seq:012d}.ndjson.gz')
+        tmp_path = snapshot_path + '.tmp'
+        export_database(tmp_path, user_db, forum_posts, consult_requests, compress=True)
+        with open(tmp_path, 'rb') as tmp_file:
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, snapshot_path)
+        os.remove(self.rotated_path)
+
+        for _, old_path in self.snapshot_paths()[:-1]:
+            os.remove(old_path)
+
+    def close(self):
+        self.sync()
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+@st.cache_resource
+def open_durable_store(data_dir):
+    """Recovers the process-wide DataStore from `data_dir` (once per process)."""
+    journal = ChangeJournal(data_dir)
+    store = DataStore(journal, get_process_profile_cache())
+    started = time.monotonic()
+    replayed = journal.recover(store)
+    store.recovery_stats = {'replayed_events': replayed, 'seconds': time.monotonic() - started}
+    atexit.register(journal.close)
+    return store
+
+# --- 3.3 SHARED MULTI-REPLICA STORE (SQLite + Change Feed) ---
+
+# Set SKINOVA_SHARED_DB to a SQLite file path to let several server processes on the same
+# host share one store. Takes precedence over SKINOVA_DATA_DIR.
+SHARED_DB_ENV = 'SKINOVA_SHARED_DB'
+CHANGE_POLL_INTERVAL = 0.25   # Seconds between change-feed checks per replica
+CHANGES_RETAINED = 100000     # Change-feed rows kept for lagging replicas
+CHANGES_PRUNE_EVERY = 1000    # Feed rows written by a replica between prunes
+OBSERVER_REFRESH_CHUNK = 500  # Emails per IN (...) query when replaying foreign writes to observers
+
+_SHARED_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS users (email TEXT PRIMARY KEY, record TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS routine_progress (email TEXT NOT NULL, day TEXT NOT NULL, row TEXT NOT NULL, PRIMARY KEY (email, day))",
+    "CREATE TABLE IF NOT EXISTS scan_history (seq INTEGER PRIMARY KEY AUTOINCREMENT, email TEXT NOT NULL, scan TEXT NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS scan_history_email ON scan_history (email, seq)",
+    "CREATE TABLE IF NOT EXISTS forum_posts (seq INTEGER PRIMARY KEY AUTOINCREMENT, ts TEXT NOT NULL, item TEXT NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS forum_posts_ts ON forum_posts (ts DESC, seq DESC)",
+    "CREATE TABLE IF NOT EXISTS consult_requests (seq INTEGER PRIMARY KEY AUTOINCREMENT, ts TEXT NOT NULL, item TEXT NOT NULL)",
+    # Change feed: one row per committed write; replicas poll it to invalidate their caches
+    "CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, email TEXT)",
+]
+
+class SharedUserMapping(MutableMapping):
+    """Dict-like view of the shared users table, served from the replica's read cache."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, email):
+        record = self.store.load_user(email)
+        if record is None:
+            raise KeyError(email)
+        return record
+
+    def __contains__(self, email):
+        return self.store.load_user(email) is not None
+
+    def __iter__(self):
+        for (email,) in self.store.connection().execute("SELECT email FROM users"):
+            yield email
+
+    def __len__(self):
+        return self.store.connection().execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def __setitem__(self, email, record):
+        self.store.put_users({email: record})
+
+    def __delitem__(self, email):
+        self.store.delete_user(email)
+
+    def update(self, records):
+        """Upserts many users in a single transaction."""
+        self.store.put_users(dict(records))
+
+    def items(self):
+        """Streams (email, record) pairs from one consistent read, without filling the cache.
+
+        Users, their progress rows and their scans come from three cursors in email order that
+        are merged as they stream, so the whole table costs three queries rather than three per user."""
+        conn = sqlite3.connect(self.store.path, timeout=30, isolation_level=None)
+        try:
+            conn.execute("BEGIN")
+            progress = RowsByEmail(conn.execute("SELECT email, day, row FROM routine_progress ORDER BY email, day"))
+            scans = RowsByEmail(conn.execute("SELECT email, scan FROM scan_history ORDER BY email, seq"))
+            for email, record_json in conn.execute("SELECT email, record FROM users ORDER BY email"):
+                record = json.loads(record_json)
+                record['Routine_Progress'] = {day: json.loads(row) for day, row in progress.take(email)}
+                record['Scan_History'] = [json.loads(scan) for (scan,) in scans.take(email)]
+                yield email, record
+        finally:
+            conn.close()
+
+class RowsByEmail:
+    """Walks a cursor of (email, ...) rows sorted by email, handing out one email's rows at a time."""
+
+    def __init__(self, cursor):
+        self.rows = iter(cursor)
+        self.pending = next(self.rows, None)
+
+    def take(self, email):
+        """That email's rows (without the email column). Call with ascending emails; rows of
+        emails never asked for are skipped."""
+        matched = []
+        while self.pending is not None and self.pending[0] <= email:
+            if self.pending[0] == email:
+                matched.append(self.pending[1:])
+            self.pending = next(self.rows, None)
+        return matched
+
+class SharedLogView(Sequence):
+    """Read-only sequence over the forum/consult tables (ordering is defined by the query)."""
+
+    def __init__(self, store, table, order_by):
+        self.store = store
+        self.table = table
+        self.order_by = order_by
+
+    def __len__(self):
+        return self.store.cached_log_read(self.table, 'len', lambda conn: conn.execute(
+            f"SELECT COUNT(*) FROM {self.table}").fetchone()[0])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            items = self.store.cached_log_read(self.table, (start, stop), lambda conn: [
+                json.loads(item) for (item,) in conn.execute(
+                    f"SELECT item FROM {self.table} ORDER BY {self.order_by} LIMIT ? OFFSET ?",
+                    (max(0, stop - start), start))])
+            return items[::step]
+        if index < 0:
+            index += len(self)
+        items = self[index:index + 1]
+        if not items:
+            raise IndexError(index)
+        return items[0]
+
+    def __iter__(self):
+        for (item,) in self.store.connection().execute(f"SELECT item FROM {self.table} ORDER BY {self.order_by}"):
+            yield json.loads(item)
+
+    def iter_from(self, start):
+        """Streams the items from position `start` on, without going through the read cache."""
+        for (item,) in self.store.connection().execute(
+                f"SELECT item FROM {self.table} ORDER BY {self.order_by} LIMIT -1 OFFSET ?", (start,)):
+            yield json.loads(item)
+
+    def append(self, item):
+        self.store.insert_log_items(self.table, [item])
+
+    def extend(self, items):
+        self.store.insert_log_items(self.table, list(items))
+
+    def sort(self, key=None, reverse=False):
+        pass # Order comes from the ORDER BY clause, not from the stored sequence
+
+class SharedSQLiteStore:
+    """DataStore backed by a SQLite file shared by every replica on the host.
+
+    Writes take SQLite's cross-process write lock (BEGIN IMMEDIATE) and append to the
+    `changes` feed in the same transaction. Each replica keeps decoded records in the
+    process-wide ProfileCache and polls the feed at most every CHANGE_POLL_INTERVAL
+    seconds, evicting only the users (or log tables) that another process touched and
+    replaying those users into the observers. Reads run concurrently thanks to WAL mode.
+    """
+
+    journal = None
+    storage_note = '(Data is shared across replicas)'
+    session_only = False
+
+    def __init__(self, path, profile_cache):
+        self.path = path
+        self.lock = threading.RLock()
+        self._local = threading.local()
+        self.profile_cache = profile_cache  # Decoded records live under (email, 'record')
+        self.user_observers = []            # Incremental aggregates (see DataStore)
+        self._log_cache = {}    # {table: {read_key: result}}
+        self._own_changes = set()  # Feed entries written by this replica (no observer refresh needed)
+        self._last_prune = 0       # Feed seq at this replica's last prune
+        self.foreign_status_changes = 0  # Consult status rewrites by other replicas (see ConsultIndex)
+        self._next_poll = 0.0
+
+        conn = self.connection()
+        for statement in _SHARED_SCHEMA:
+            conn.execute(statement)
+        self._last_change = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+
+        self.user_db = SharedUserMapping(self)
+        self.forum_posts = SharedLogView(self, 'forum_posts', 'ts DESC, seq DESC')
+        self.consult_requests = SharedLogView(self, 'consult_requests', 'seq')
+
+    def connection(self):
+        """One autocommit connection per thread (Streamlit runs sessions on separate threads)."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def write_transaction(self):
+        """Cross-process write lock: BEGIN IMMEDIATE takes SQLite's reserved lock up front."""
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    # -- Change feed --------------------------------------------------------
+
+    def poll_changes(self, force=False):
+        """Evicts cache entries written by any process since the last poll."""
+        now = time.monotonic()
+        if not force and now < self._next_poll:
+            return
+        self._next_poll = now + CHANGE_POLL_INTERVAL
+
+        conn = self.connection()
+        rows = conn.execute("SELECT seq, kind, email FROM changes WHERE seq > ? ORDER BY seq",
+                            (self._last_change,)).fetchall()
+        if not rows:
+            return
+        with self.lock:
+            oldest = conn.execute("SELECT MIN(seq) FROM changes").fetchone()[0]
+            pruned_past = oldest > self._last_change + 1 and self._last_change > 0
+            if pruned_past:
+                # Feed was pruned past our position: we cannot tell what changed
+                self.profile_cache.clear()
+                self._log_cache.clear()
+            foreign_emails = set()
+            for seq, kind, email in rows:
+                own = seq in self._own_changes
+                self._own_changes.discard(seq)
+                if kind == 'user':
+                    self.profile_cache.invalidate(email)
+                    if not own:
+                        foreign_emails.add(email)
+                elif kind == 'consult_status':
+                    # Existing rows were rewritten, not appended: length checks cannot see it
+                    self._log_cache.pop('consult_requests', None)
+                    self.foreign_status_changes += not own
+                else:
+                    self._log_cache.pop(kind, None)
+            self._last_change = max(self._last_change, rows[-1][0])
+        if pruned_past:
+            self.notify_bulk_change()
+        elif foreign_emails:
+            # Observers keep each user's previous contribution, so re-reading the changed users is enough
+            self.refresh_observers(foreign_emails)
+
+    def _record_changes(self, conn, kind, emails=(None,)):
+        emails = list(emails)
+        conn.executemany("INSERT INTO changes (kind, email) VALUES (?, ?)", [(kind, email) for email in emails])
+        seq = conn.execute("SELECT MAX(seq) FROM changes").fetchone()[0]
+        # Rows written inside one BEGIN IMMEDIATE transaction get consecutive sequence numbers
+        with self.lock:
+            self._own_changes.update(range(seq - len(emails) + 1, seq + 1))
+        # Multi-row writes skip over seq values, so prune by distance from the last prune
+        if seq - self._last_prune >= CHANGES_PRUNE_EVERY:
+            conn.execute("DELETE FROM changes WHERE seq <= ?", (seq - CHANGES_RETAINED,))
+            self._last_prune = seq
+
+    # -- Reads --------------------------------------------------------------
+
+    @staticmethod
+    def load_progress(conn, email):
+        return {day: json.loads(row) for day, row in
+                conn.execute("SELECT day, row FROM routine_progress WHERE email = ?", (email,))}
+
+    def load_user(self, email):
+        """Read-through: cached record, or one consistent read from SQLite."""
+        self.poll_changes()
+        hit, record = self.profile_cache.lookup(email, 'record')
+        if hit:
+            return record
+        generation = self.profile_cache.generation(email)
+
+        conn = self.connection()
+        conn.execute("BEGIN")
+        try:
+            row = conn.execute("SELECT record FROM users WHERE email = ?", (email,)).fetchone()
+            record = None
+            if row is not None:
+                record = json.loads(row[0])
+                record['Routine_Progress'] = self.load_progress(conn, email)
+                record['Scan_History'] = [json.loads(scan) for (scan,) in
+                                          conn.execute("SELECT scan FROM scan_history WHERE email = ? ORDER BY seq", (email,))]
+            feed_position = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+        finally:
+            conn.execute("COMMIT")
+
+        # Only cache what is provably current; otherwise the next poll would have to evict it
+        if record is not None and feed_position <= self._last_change:
+            self.profile_cache.put(email, 'record', record, generation)
+        return record
+
+    def cached_log_read(self, table, read_key, loader):
+        self.poll_changes()
+        with self.lock:
+            table_cache = self._log_cache.setdefault(table, {})
+            if read_key in table_cache:
+                return table_cache[read_key]
+        result = loader(self.connection())
+        with self.lock:
+            self._log_cache.setdefault(table, {})[read_key] = result
+        return result
+
+    # -- Observers ----------------------------------------------------------
+
+    def notify_bulk_change(self):
+        for observer in self.user_observers:
+            observer.mark_stale()
+
+    def refresh_observers(self, emails):
+        """Applies other replicas' writes to the observers as per-user deltas (two reads per chunk)."""
+        if not self.user_observers:
+            return
+        emails = sorted(emails)
+        today_key = date.today().strftime("%Y-%m-%d")
+        records, today_rows = {}, {}
+        conn = self.connection()
+        conn.execute("BEGIN")
+        try:
+            for start in range(0, len(emails), OBSERVER_REFRESH_CHUNK):
+                chunk = emails[start:start + OBSERVER_REFRESH_CHUNK]
+                marks = ', '.join('?' * len(chunk))
+                records.update((email, json.loads(record)) for email, record in
+                               conn.execute(f"SELECT email, record FROM users WHERE email IN ({marks})", chunk))
+                today_rows.update((email, json.loads(row)) for email, row in
+                                  conn.execute(f"SELECT email, row FROM routine_progress WHERE day = ? AND email IN ({marks})",
+                                               [today_key, *chunk]))
+        finally:
+            conn.execute("COMMIT")
+        for email in emails:
+            view = None
+            if email in records:
+                view = dict(records[email], Routine_Progress={today_key: today_rows[email]} if email in today_rows else {})
+            for observer in self.user_observers:
+                observer.update(email, None, view)
+
+    def _observer_view(self, conn, email, record):
+        """The record plus only today's progress row (all that observers look at)."""
+        if record is None:
+            return None
+        today_key = date.today().strftime("%Y-%m-%d")
+        row = conn.execute("SELECT row FROM routine_progress WHERE email = ? AND day = ?", (email, today_key)).fetchone()
+        return dict(record, Routine_Progress={today_key: json.loads(row[0])} if row else {})
+
+    # -- Writes -------------------------------------------------------------
+
+    def _write_user(self, conn, email, record, progress):
+        record = {k: v for k, v in record.items() if k not in ('Routine_Progress', 'Scan_History')}
+        conn.execute("INSERT OR REPLACE INTO users (email, record) VALUES (?, ?)", (email, json.dumps(record)))
+        conn.executemany("INSERT OR REPLACE INTO routine_progress (email, day, row) VALUES (?, ?, ?)",
+                         [(email, day, json.dumps(row)) for day, row in progress.items()])
+
+    def put_users(self, records):
+        changes = []
+        with self.write_transaction() as conn:
+            for email, record in records.items():
+                if self.user_observers:
+                    row = conn.execute("SELECT record FROM users WHERE email = ?", (email,)).fetchone()
+                    old_view = self._observer_view(conn, email, json.loads(row[0]) if row else None)
+                    changes.append((email, [observer.snapshot(old_view) for observer in self.user_observers]))
+                self._write_user(conn, email, record, record.get('Routine_Progress', {}))
+                conn.execute("DELETE FROM scan_history WHERE email = ?", (email,))
+                conn.executemany("INSERT INTO scan_history (email, scan) VALUES (?, ?)",
+                                 [(email, json.dumps(scan)) for scan in record.get('Scan_History', [])])
+            self._record_changes(conn, 'user', list(records))
+        for email in records:
+            self.profile_cache.invalidate(email)
+        today_key = date.today().strftime("%Y-%m-%d")
+        for email, tokens in changes:
+            new_view = dict(records[email], Routine_Progress={
+                day: row for day, row in records[email].get('Routine_Progress', {}).items() if day == today_key})
+            for observer, token in zip(self.user_observers, tokens):
+                observer.update(email, token, new_view)
+
+    def delete_user(self, email):
+        with self.write_transaction() as conn:
+            conn.execute("DELETE FROM users WHERE email = ?", (email,))
+            conn.execute("DELETE FROM routine_progress WHERE email = ?", (email,))
+            conn.execute("DELETE FROM scan_history WHERE email = ?", (email,))
+            self._record_changes(conn, 'user', [email])
+        self.profile_cache.invalidate(email)
+
+    def insert_log_items(self, table, items):
+        with self.write_transaction() as conn:
+            conn.executemany(f"INSERT INTO {table} (ts, item) VALUES (?, ?)",
+                             [(item.get('Timestamp', ''), json.dumps(item)) for item in items])
+            self._record_changes(conn, table)
+        with self.lock:
+            self._log_cache.pop(table, None)
+
+    def commit(self, event):
+        """Applies a DataStore mutation event as one SQLite transaction."""
+        event_type = event['type']
+        if event_type == 'user_create':
+            self.put_users({event['email']: event['record']})
+        elif event_type == 'user_update':
+            email = event['email']
+            progress = dict(event.get('progress') or {})
+            with self.write_transaction() as conn:
+                row = conn.execute("SELECT record FROM users WHERE email = ?", (email,)).fetchone()
+                if row is None:
+                    return
+                record = json.loads(row[0])
+                old_view = self._observer_view(conn, email, record) if self.user_observers else None
+                tokens = [observer.snapshot(old_view) for observer in self.user_observers]
+                fields = dict(event.get('fields', {}))
+                progress.update(fields.pop('Routine_Progress', {}))
+                record = dict(record, **fields)
+                # Only the changed progress rows are rewritten, never the whole history
+                self._write_user(conn, email, record, progress)
+                self._record_changes(conn, 'user', [email])
+            self.profile_cache.invalidate(email)
+            if tokens:
+                today_key = date.today().strftime("%Y-%m-%d")
+                today_rows = dict(old_view['Routine_Progress'])
+                if today_key in progress:
+                    today_rows[today_key] = progress[today_key]
+                new_view = dict(record, Routine_Progress=today_rows)
+                for observer, token in zip(self.user_observers, tokens):
+                    observer.update(email, token, new_view)
+        elif event_type == 'scan_record':
+            # Append-only: one row per scan, the user record itself is untouched
+            with self.write_transaction() as conn:
+                conn.execute("INSERT INTO scan_history (email, scan) VALUES (?, ?)", (event['email'], json.dumps(event['scan'])))
+                self._record_changes(conn, 'user', [event['email']])
+            self.profile_cache.invalidate(event['email'])
+        elif event_type == 'forum_post':
+            self.insert_log_items('forum_posts', [event['post']])
+        elif event_type == 'consult_request':
+            self.insert_log_items('consult_requests', [event['request']])
+        elif event_type == 'consult_status':
+            updated = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            with self.write_transaction() as conn:
+                seqs = [seq for (seq,) in conn.execute("SELECT seq FROM consult_requests ORDER BY seq")]
+                conn.executemany("UPDATE consult_requests SET item = json_set(item, '$.Status', ?, '$.Status_Updated', ?) WHERE seq = ?",
+                                 [(event['status'], updated, seqs[position]) for position in event['positions']])
+                self._record_changes(conn, 'consult_status')
+            with self.lock:
+                self._log_cache.pop('consult_requests', None)
+
+    def create_user(self, email, record):
+        self.commit({'type': 'user_create', 'email': email, 'record': record})
+
+    def update_user(self, email, fields, progress=None):
+        self.commit({'type': 'user_update', 'email': email, 'fields': fields, 'progress': progress or {}})
+
+    def add_scan(self, email, scan):
+        self.commit({'type': 'scan_record', 'email': email, 'scan': scan})
+
+    def add_forum_post(self, post):
+        self.commit({'type': 'forum_post', 'post': post})
+
+    def add_consult_request(self, request):
+        self.commit({'type': 'consult_request', 'request': request})
+
+    def set_consult_status(self, positions, status):
+        """Moves consult requests (by log position) to a new status in one event."""
+        self.commit({'type': 'consult_status', 'positions': [int(position) for position in positions], 'status': status})
+
+    def checkpoint(self):
+        pass # SQLite is the durable copy; there is no separate snapshot
+
+@st.cache_resource
+def open_shared_store(path):
+    """Opens the process-wide handle on the shared SQLite store (once per replica)."""
+    return SharedSQLiteStore(path, get_process_profile_cache())
+
+
+# Bind this session to its data store: session-only by default, journaled to disk with
+# SKINOVA_DATA_DIR, or shared across replicas with SKINOVA_SHARED_DB. The session_state
+# aliases keep existing page code unchanged.
+if 'data_store' not in st.session_state:
+    shared_db = os.environ.get(SHARED_DB_ENV)
+    data_dir = os.environ.get(DATA_DIR_ENV)
+    if shared_db:
+        st.session_state.data_store = open_shared_store(shared_db)
+    elif data_dir:
+        st.session_state.data_store = open_durable_store(data_dir)
+    else:
+        st.session_state.data_store = DataStore()
+    st.session_state.user_db = st.session_state.data_store.user_db
+    st.session_state.forum_posts = st.session_state.data_store.forum_posts
+    st.session_state.consult_requests = st.session_state.data_store.consult_requests
+
+
+# --- 3.4 COHORT ANALYTICS (Incrementally Maintained Aggregates) ---
+
+COHORT_DIMENSIONS = ('Skin_Type', 'Goal', 'Location')
+COMPLIANT_THRESHOLD = 0.8   # Same 80% bar used by the daily streak check
+# Streak histogram: (upper bound inclusive, label); the last bucket is open-ended
+STREAK_BUCKETS = [(1, '1 day'), (3, '2-3 days'), (7, '4-7 days'), (14, '8-14 days'), (30, '15-30 days'), (None, '31+ days')]
+_STREAK_BOUNDS = np.array([bound for bound, _ in STREAK_BUCKETS[:-1]])
+
+def cohort_contribution(record, day_key):
+    """What one user adds to the cohort aggregates (None if the user is not onboarded yet)."""
+    if not record or not record.get('Onboarding_Complete'):
+        return None
+    total_steps = sum(len(steps) for steps in (record.get('Routine') or {}).values())
+    today_progress = (record.get('Routine_Progress') or {}).get(day_key)
+    completed_steps = sum(v.count(True) for v in today_progress.values()) if today_progress else 0
+    return (
+        tuple(record.get(dimension) or 'Not set' for dimension in COHORT_DIMENSIONS),
+        record.get('Skin Score', 0),
+        int(np.searchsorted(_STREAK_BOUNDS, record.get('Streak', 0))),
+        completed_steps / total_steps if total_steps else 0.0,
+    )
+
+class CohortAggregates:
+    """Population aggregates kept current by applying per-user deltas on every committed change.
+
+    Registered as a user observer on the DataStore. Each user's current contribution is kept,
+    so update() swaps it for the new one: a toggle costs O(1) instead of a scan over every
+    user, and writes from other replicas apply the same way without knowing the old record.
+    rebuild() recomputes everything in one vectorized pandas pass and is used on first use,
+    after bulk imports, at day rollover and on demand.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stale = True
+        self.day_key = None
+        self.rebuilt_at = None
+        self.rebuild_seconds = 0.0
+        self._reset()
+
+    def _reset(self):
+        self.users = 0
+        self.score_sum = 0.0
+        self.compliance_sum = 0.0
+        self.compliant_users = 0
+        self.streak_counts = [0] * len(STREAK_BUCKETS)
+        self.groups = {dimension: {} for dimension in COHORT_DIMENSIONS}  # {value: [users, score_sum, compliance_sum]}
+        self.contributions = {}  # {email: cohort_contribution()}
+
+    def _apply(self, contribution, sign):
+        dimension_values, score, streak_bucket, compliance = contribution
+        self.users += sign
+        self.score_sum += sign * score
+        self.compliance_sum += sign * compliance
+        self.compliant_users += sign * (compliance >= COMPLIANT_THRESHOLD)
+        self.streak_counts[streak_bucket] += sign
+        for dimension, value in zip(COHORT_DIMENSIONS, dimension_values):
+            group = self.groups[dimension].setdefault(value, [0, 0.0, 0.0])
+            group[0] += sign
+            group[1] += sign * score
+            group[2] += sign * compliance
+            if group[0] == 0:
+                del self.groups[dimension][value]
+
+    # -- User observer protocol --------------------------------------------
+
+    def snapshot(self, record):
+        return None # The previous contribution is kept in self.contributions
+
+    def update(self, email, token, record):
+        after = cohort_contribution(record, self.day_key)
+        with self.lock:
+            before = self.contributions.get(email)
+            if before == after:
+                return
+            if before is not None:
+                self._apply(before, -1)
+                del self.contributions[email]
+            if after is not None:
+                self._apply(after, +1)
+                self.contributions[email] = after
+
+    def mark_stale(self):
+        self.stale = True
+
+    # -- Full rebuild -------------------------------------------------------
+
+    def rebuild(self, user_db):
+        """Recomputes every aggregate from scratch with vectorized pandas group-bys."""
+        started = time.monotonic()
+        day_key = get_today_key()
+        users = dict(user_db.items())
+        frame = pd.DataFrame(list(users.values()), index=list(users), columns=[
+            *COHORT_DIMENSIONS, 'Skin Score', 'Streak', 'Routine', 'Routine_Progress', 'Onboarding_Complete'])
+        frame = frame[frame['Onboarding_Complete'].notna() & frame['Onboarding_Complete'].astype(bool)]
+        for dimension in COHORT_DIMENSIONS:
+            frame[dimension] = frame[dimension].where(frame[dimension].fillna('').astype(bool), 'Not set')
+        frame['score'] = pd.to_numeric(frame['Skin Score'], errors='coerce').fillna(0).astype(float)
+        streaks = pd.to_numeric(frame['Streak'], errors='coerce').fillna(0).to_numpy(dtype=float)
+        frame['streak_bucket'] = np.searchsorted(_STREAK_BOUNDS, streaks)
+
+        # Step counts straight from the nested routine and today's progress lists, no per-user loop
+        routines = frame['Routine'].astype(object).str
+        total_steps = sum(routines.get(slot).str.len().fillna(0) for slot in ('Morning', 'Evening'))
+        today = frame['Routine_Progress'].astype(object).str.get(day_key).astype(object).str
+        completed_steps = sum(today.get(slot).explode().eq(True).groupby(level=0, sort=False).sum()
+                              .reindex(frame.index, fill_value=0) for slot in ('AM', 'PM'))
+        frame['compliance'] = (completed_steps / total_steps.where(total_steps > 0)).fillna(0.0).astype(float)
+
+        contributions = dict(zip(frame.index, zip(
+            zip(*(frame[dimension].tolist() for dimension in COHORT_DIMENSIONS)),
+            frame['Skin Score'].fillna(0).tolist(), frame['streak_bucket'].tolist(), frame['compliance'].tolist())))
+
+        with self.lock:
+            self._reset()
+            self.day_key = day_key
+            self.contributions = contributions
+            self.users = len(frame)
+            self.score_sum = float(frame['score'].sum())
+            self.compliance_sum = float(frame['compliance'].sum())
+            self.compliant_users = int((frame['compliance'] >= COMPLIANT_THRESHOLD).sum())
+            self.streak_counts = np.bincount(frame['streak_bucket'], minlength=len(STREAK_BUCKETS)).tolist()
+            for dimension in COHORT_DIMENSIONS:
+                grouped = frame.groupby(dimension).agg(users=('score', 'size'), score_sum=('score', 'sum'),
+                                                      compliance_sum=('compliance', 'sum'))
+                self.groups[dimension] = {value: [int(users), float(score_sum), float(compliance_sum)]
+                                          for value, users, score_sum, compliance_sum in grouped.itertuples()}
+            self.stale = False
+            self.rebuilt_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            self.rebuild_seconds = time.monotonic() - started
+
+    # -- Read side ----------------------------------------------------------
+
+    def summary(self):
+        with self.lock:
+            return {
+                'users': self.users,
+                'avg_score': self.score_sum / self.users if self.users else 0.0,
+                'avg_compliance': self.compliance_sum / self.users if self.users else 0.0,
+                'compliant_share': self.compliant_users / self.users if self.users else 0.0,
+            }
+
+    def by_dimension(self, dimension):
+        """DataFrame of users, average score and average compliance per value of `dimension`."""
+        with self.lock:
+            rows = [(value, users, score_sum / users, compliance_sum / users)
+                    for value, (users, score_sum, compliance_sum) in self.groups[dimension].items() if users]
+        frame = pd.DataFrame(rows, columns=[dimension, 'Users', 'Avg Skin Score', 'Avg Compliance'])
+        return frame.sort_values('Avg Skin Score', ascending=False).set_index(dimension)
+
+    def streak_distribution(self):
+        with self.lock:
+            return pd.Series(self.streak_counts, index=[label for _, label in STREAK_BUCKETS], name='Users')
+
+def get_cohort_aggregates(force_rebuild=False):
+    """Returns the store's cohort aggregates, registering them as an observer on first use."""
+    store = get_data_store()
+    with store.lock:
+        aggregates = getattr(store, 'cohort_aggregates', None)
+        if aggregates is None:
+            aggregates = CohortAggregates()
+            store.cohort_aggregates = aggregates
+            store.user_observers.append(aggregates)
+        if force_rebuild or aggregates.stale or aggregates.day_key != get_today_key():
+            aggregates.rebuild(store.user_db)
+    return aggregates
+
+
+# --- 3.5 FORECASTING ENGINE (Vectorized Score Projections) ---
+
+FORECAST_HORIZON = 7            # Days projected ahead
+FORECAST_EWMA_ALPHA = 0.3       # Smoothing for the EWMA level (higher = more weight on recent days)
+FORECAST_HUBER_K = 1.345        # Huber threshold, in robust residual standard deviations
+FORECAST_IRLS_ITERATIONS = 5    # Reweighting passes for the robust trend
+FORECAST_INTERVAL_Z = 1.96      # 95% prediction interval
+FORECAST_BATCH_ROWS = 10000     # Users per vectorized call in the nightly batch
+FORECAST_NIGHTLY_HOUR = 3       # Local hour at which every user's forecast is precomputed
+FORECAST_CACHE_MAX_ENTRIES = 50000  # LRU bound on cached forecasts per store (least recently viewed go first)
+
+def stack_histories(histories):
+    """Left-pads score histories with NaN into one (users, days) float matrix."""
+    width = max((len(history) for history in histories), default=0)
+    matrix = np.full((len(histories), width), np.nan)
+    for row, history in enumerate(histories):
+        if history:
+            matrix[row, width - len(history):] = history
+    return matrix
+
+def forecast_scores(matrix, horizon=FORECAST_HORIZON):
+    """Forecasts every row of a (users, days) score matrix in one batched NumPy pass.
+
+    A Huber-robust least-squares trend is fitted by IRLS for all rows at once, so a
+    single outlier day cannot swing the slope. The forecast starts from an EWMA level
+    of the detrended series (no lag on trending users) and follows that slope. Prediction intervals widen with the distance from the fitted window.
+    Returns a dict of arrays: point/lower/upper are (users, horizon); level/slope are (users,).
+    """
+    users, days = matrix.shape
+    valid = ~np.isnan(matrix)
+    y = np.where(valid, matrix, 0.0)
+    x = np.arange(days, dtype=float)[None, :]
+    counts = valid.sum(axis=1)
+
+    # 1. Robust trend: iteratively reweighted least squares with Huber weights
+    weights = valid.astype(float)
+    for _ in range(FORECAST_IRLS_ITERATIONS):
+        weight_sum = np.maximum(weights.sum(axis=1), 1e-12)
+        x_mean = (weights * x).sum(axis=1) / weight_sum
+        y_mean = (weights * y).sum(axis=1) / weight_sum
+        dx = x - x_mean[:, None]
+        dy = y - y_mean[:, None]
+        sxx = (weights * dx * dx).sum(axis=1)
+        slope = np.where(sxx > 1e-12, (weights * dx * dy).sum(axis=1) / np.maximum(sxx, 1e-12), 0.0)
+        residuals = np.where(valid, dy - slope[:, None] * dx, np.nan)
+        with warnings.catch_warnings():
+            # MAD-based scale per row (all-NaN rows are users with no history yet)
+            warnings.simplefilter('ignore', RuntimeWarning)
+            scale = 1.4826 * np.nanmedian(np.abs(residuals), axis=1) if users and days else np.zeros(users)
+        scale = np.where(np.isfinite(scale) & (scale > 1e-6), scale, 1e-6)
+        ratio = np.abs(np.nan_to_num(residuals)) / (FORECAST_HUBER_K * scale[:, None])
+        weights = np.where(ratio <= 1.0, 1.0, 1.0 / np.maximum(ratio, 1e-12)) * valid
+
+    residuals = np.nan_to_num(residuals)
+    sigma = np.sqrt((weights * residuals ** 2).sum(axis=1) / np.maximum(counts - 2, 1))
+
+    # 2. EWMA level of the detrended series, re-anchored at the last observed day
+    decay = (1 - FORECAST_EWMA_ALPHA) ** np.arange(days - 1, -1, -1, dtype=float)
+    ewma_weights = decay[None, :] * valid
+    detrended = y - slope[:, None] * (x - (days - 1))
+    level = (ewma_weights * detrended).sum(axis=1) / np.maximum(ewma_weights.sum(axis=1), 1e-12)
+
+    # 3. Point forecast and prediction interval
+    steps = np.arange(1, horizon + 1, dtype=float)
+    point = level[:, None] + slope[:, None] * steps[None, :]
+    x_future = (days - 1) + steps[None, :]
+    leverage = np.where(sxx[:, None] > 1e-12, (x_future - x_mean[:, None]) ** 2 / np.maximum(sxx[:, None], 1e-12), 0.0)
+    spread = FORECAST_INTERVAL_Z * sigma[:, None] * np.sqrt(1 + 1 / np.maximum(counts[:, None], 1) + leverage)
+
+    # Skin scores are clamped to 50-99 everywhere else in the app
+    return {
+        'point': np.clip(point, 50, 99),
+        'lower': np.clip(point - spread, 50, 99),
+        'upper': np.clip(point + spread, 50, 99),
+        'level': level,
+        'slope': slope,
+    }
+
+class ForecastCache:
+    """Per-user forecasts, valid until the user's score history changes.
+
+    Entries are keyed by a signature of the history they came from, so a changed history
+    is simply a miss. precompute() fills the cache for every user in batched NumPy calls.
+    At most max_entries forecasts are kept; the least recently used are evicted first.
+    """
+
+    def __init__(self, max_entries=FORECAST_CACHE_MAX_ENTRIES):
+        self.entries = OrderedDict()   # {email: (history_signature, {'point', 'lower', 'upper'})}
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.last_batch = None
+
+    @staticmethod
+    def _signature(history):
+        return hash(tuple(history))
+
+    def _store_rows(self, emails, signatures, result):
+        forecasts = [{name: result[name][row].astype(np.float32) for name in ('point', 'lower', 'upper')}
+                     for row in range(len(emails))]
+        with self.lock:
+            for email, signature, forecast in zip(emails, signatures, forecasts):
+                self.entries[email] = (signature, forecast)
+                self.entries.move_to_end(email)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return forecasts
+
+    def get(self, email, history):
+        signature = self._signature(history)
+        with self.lock:
+            entry = self.entries.get(email)
+            if entry is not None and entry[0] == signature:
+                self.entries.move_to_end(email)
+                return entry[1]
+        return self._store_rows([email], [signature], forecast_scores(stack_histories([history])))[0]
+
+    def precompute(self, histories):
+        """Forecasts every (email, score history) pair, FORECAST_BATCH_ROWS users per vectorized call."""
+        started = time.monotonic()
+        for start in range(0, len(histories), FORECAST_BATCH_ROWS):
+            emails, batch = zip(*histories[start:start + FORECAST_BATCH_ROWS])
+            self._store_rows(emails, [self._signature(h) for h in batch], forecast_scores(stack_histories(batch)))
+        self.last_batch = {'users': len(histories), 'seconds': time.monotonic() - started,
+                           'finished_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+        return self.last_batch
+
+def score_histories(store):
+    """(email, score history) for every user, copied under the store lock so signups can proceed."""
+    with store.lock:
+        return [(email, list(record.get('Score_History') or [])) for email, record in store.user_db.items()]
+
+@st.cache_resource
+def _nightly_forecast_stores():
+    """Starts the process-wide thread that precomputes forecasts for every registered store nightly."""
+    stores = weakref.WeakSet()
+
+    def run():
+        while True:
+            now = datetime.now()
+            next_run = now.replace(hour=FORECAST_NIGHTLY_HOUR, minute=0, second=0, microsecond=0)
+            if next_run <= now:
+                next_run += timedelta(days=1)
+            time.sleep((next_run - now).total_seconds())
+            for store in list(stores):
+                try:
+                    store.forecast_cache.precompute(score_histories(store))
+                except Exception:
+                    # One failing store must not stop the thread (or tomorrow's run)
+                    LOGGER.exception("Nightly forecast precompute failed")
+
+    threading.Thread(target=run, name='skinova-nightly-forecasts', daemon=True).start()
+    return stores
+
+def get_score_forecast(email, history):
+    """The user's forecast, precomputed overnight or computed (and cached) on first view."""
+    store = get_data_store()
+    if getattr(store, 'forecast_cache', None) is None:
+        store.forecast_cache = ForecastCache()
+        _nightly_forecast_stores().add(store)
+    return store.forecast_cache.get(email, history)
+
+
+# --- 3.6 WHAT-IF HABIT SIMULATOR (Monte Carlo Trajectories) ---
+
+SIM_DAYS = 90                  # Simulated horizon
+SIM_TRAJECTORIES = 4000        # Stochastic paths per run
+SIM_COMPLIANT_GAIN = 0.025     # Latent (logit) gain on a day the routine is completed
+SIM_MISSED_LOSS = 0.012        # Latent loss on a missed day
+SIM_RISK_DRAG = 0.0005         # Latent drag per internal-risk point per day
+SIM_DAILY_NOISE = 0.04         # Std. dev. of day-to-day latent noise
+SIM_PERCENTILES = (10, 25, 50, 75, 90)
+SIM_SEED = 7                   # Fixed seed: slider changes move the bands, not the noise
+SIM_DIET_OPTIONS = ['Balanced (Homemade)', 'High Sugar/Processed', 'High Dairy & Gluten', 'Strict Vegetarian/Vegan']
+SIM_GUT_OPTIONS = ['Good', 'Average', 'Poor (Bloating/Irregular)']
+SIM_FLUSHING_OPTIONS = ['Rarely', 'Sometimes (After actives)', 'Often (Heat/Spicy food)']
+
+def compute_internal_risk_score(q_inputs):
+    """Lifestyle risk points from the analyzer questionnaire (higher = more internal stress on skin)."""
+    internal_risk_score = 0
+    
+    if q_inputs['stress_level'] >= 7: internal_risk_score += 5
+    if q_inputs['water_intake'] <= 1.5: internal_risk_score += 4
+    if q_inputs['sleep_quality'] == 'Poor': internal_risk_score += 5
+    if q_inputs['diet_type'] in ['High Sugar/Processed', 'High Dairy & Gluten']: internal_risk_score += 6
+    if q_inputs['gut_health'] == 'Poor (Bloating/Irregular)': internal_risk_score += 5
+    if q_inputs['sun_exposure'] > 30: internal_risk_score += 8
+    if q_inputs['flushing'] == 'Often (Heat/Spicy food)': internal_risk_score += 4
+    return internal_risk_score
+
+def simulate_score_trajectories(start_score, risk_score, compliance, days=SIM_DAYS,
+                                trajectories=SIM_TRAJECTORIES, seed=SIM_SEED):
+    """Simulates (trajectories, days + 1) skin-score paths in one vectorized pass.
+
+    Scores evolve in logit space between the app's 50-99 bounds, so gains taper off near
+    the ceiling without any per-step clamping. Each day is a Bernoulli(compliance) draw:
+    completed days add SIM_COMPLIANT_GAIN, missed days subtract SIM_MISSED_LOSS, the
+    lifestyle risk adds a constant drag and Gaussian noise covers everything else.
+    """
+    rng = np.random.default_rng(seed)
+    completed = rng.random((trajectories, days)) < compliance
+    steps = (np.where(completed, SIM_COMPLIANT_GAIN, -SIM_MISSED_LOSS)
+             - SIM_RISK_DRAG * risk_score
+             + rng.normal(0.0, SIM_DAILY_NOISE, (trajectories, days)))
+
+    start_fraction = np.clip((start_score - 50) / 49, 0.01, 0.99)
+    start_latent = np.log(start_fraction / (1 - start_fraction))
+    latent = start_latent + np.concatenate([np.zeros((trajectories, 1)), np.cumsum(steps, axis=1)], axis=1)
+    return 50 + 49 / (1 + np.exp(-latent))
+
+def summarize_trajectories(paths, target=90):
+    """Percentile bands per day plus headline odds for the final day."""
+    bands = np.percentile(paths, SIM_PERCENTILES, axis=0)
+    return {
+        'bands': dict(zip(SIM_PERCENTILES, bands)),
+        'median_final': float(bands[SIM_PERCENTILES.index(50)][-1]),
+        'target_probability': float((paths[:, -1] >= target).mean()),
+    }
+
+
+# --- 3.7 CARD TEMPLATES (Batched HTML Rendering) ---
+
+# Card styling lives in the .card-* CSS classes so each rendered card carries only its own fields.
+CARD_TEMPLATE_SOURCES = {
+    'product': """
+        <div class="skinova-card card-product">
+            <h4>$name</h4>
+            <p class="card-price">$price</p>
+            <p><strong>Type:</strong> $type</p>
+            <p><strong>Target:</strong> $target</p>
+            <p class="card-small"><strong>Key Ingredients:</strong> $ingredients</p>
+            <a href="$link" target="_blank"><button class="card-buy">View &amp; Buy (Affiliate Link)</button></a>
+        </div>
+    """,
+    'kit': """
+        <div class="skinova-card card-kit">
+            <h5>$step</h5>
+            <p class="card-title">$product</p>
+            <p class="card-small"><strong>Key Ingredients:</strong> $ingredients</p>
+            <p class="card-note"><strong>Rationale:</strong> $rationale</p>
+        </div>
+    """,
+    'indicator': """
+        <div class="skinova-card card-indicator" style="border-left-color: $color;">
+            <p class="card-label">$label</p>
+            <p class="card-title" style="color: $color;">$value</p>
+        </div>
+    """,
+    'forum_post': """
+        <details class="skinova-card card-post">
+            <summary><strong>$title</strong> - <em>Posted by $author on $posted</em></summary>
+            <p><strong>Concern:</strong> $content</p>
+            <p class="card-note">Hyper-Simulation: Dummy Replies: $replies, Last Activity: $activity</p>
+        </details>
+    """,
+    'twin': """
+        <div class="skinova-card card-kit">
+            <h5>$label</h5>
+            <p class="card-title">$score</p>
+            <p class="card-small"><strong>Profile:</strong> $profile</p>
+            <p class="card-note"><strong>Their Evening Routine:</strong> $routine</p>
+        </div>
+    """,
+}
+
+class CardTemplate:
+    """Card markup compiled once with whitespace collapsed. Fields are HTML-escaped on render."""
+
+    def __init__(self, source):
+        self._template = string.Template("".join(line.strip() for line in source.strip().splitlines()))
+
+    def render(self, fields):
+        return self._template.substitute({key: html.escape(str(value)) for key, value in fields.items()})
+
+@st.cache_resource
+def get_card_templates():
+    """Process-wide compiled card templates."""
+    return {name: CardTemplate(source) for name, source in CARD_TEMPLATE_SOURCES.items()}
+
+def render_card_grid(template_name, rows, num_cols=1):
+    """Renders all cards as a single markdown element laid out with CSS grid (no nested st.columns)."""
+    if not rows:
+        return
+    template = get_card_templates()[template_name]
+    cards = "".join(template.render(row) for row in rows)
+    st.markdown(f'<div class="skinova-grid" style="grid-template-columns: repeat({num_cols}, minmax(0, 1fr));">{cards}</div>',
+                unsafe_allow_html=True)
+
+
+# --- 3.8 UPLOAD SPILLING & SESSION MEMORY BUDGET ---
+
+SESSION_SPILL_DIR = os.path.join(os.environ.get(DATA_DIR_ENV) or tempfile.gettempdir(), 'skinova-spill')
+UPLOAD_SPILL_CHUNK = 1024 * 1024              # Bytes copied per read while spilling an upload
+SESSION_HEAVY_BUDGET_BYTES = 512 * 1024       # Resident heavy state allowed per session
+PROCESS_HEAVY_BUDGET_BYTES = 64 * 1024 * 1024 # Resident heavy state allowed across all sessions
+SESSION_IDLE_EVICT_SECONDS = 300              # Idle sessions have their heavy state moved to disk
+SESSION_EXPIRE_SECONDS = 24 * 3600            # Abandoned sessions are dropped (disk files included)
+SESSION_SWEEP_INTERVAL = 15                   # Seconds between eviction sweeps
+
+def spill_upload(uploaded_file, subdir='uploads'):
+    """Streams an UploadedFile to the spill directory chunk by chunk and returns a plain-dict handle to it."""
+    target_dir = os.path.join(SESSION_SPILL_DIR, subdir)
+    os.makedirs(target_dir, exist_ok=True)
+    suffix = os.path.splitext(uploaded_file.name)[1]
+    uploaded_file.seek(0)
+    with tempfile.NamedTemporaryFile(dir=target_dir, prefix='upload-', suffix=suffix, delete=False) as tmp:
+        shutil.copyfileobj(uploaded_file, tmp, UPLOAD_SPILL_CHUNK)
+        size = tmp.tell()
+    return {'spill_path': tmp.name, 'name': uploaded_file.name, 'size': size, 'mime': uploaded_file.type}
+
+@contextmanager
+def open_spilled(upload):
+    """Read-only mmap over a spilled upload, so decoding reads from the page cache instead of a heap copy."""
+    if upload['size'] == 0:
+        yield BytesIO(b'')
+        return
+    with open(upload['spill_path'], 'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as view:
+        yield view
+
+def discard_spilled(upload):
+    remove_spill_file(upload['spill_path'])
+
+def remove_spill_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+class SessionHeavyState:
+    """Large per-session artifacts (uploads, analysis reports and figures) kept outside st.session_state.
+
+    Every item carries its size (the pickled size unless given). Items can be evicted one by
+    one to a pickle on disk and are rehydrated transparently by the next get(), so an idle
+    tab costs only its bookkeeping. Values must be plain data (the script's classes are
+    redefined on every rerun and do not pickle). All methods are called with self.lock held.
+    """
+
+    def __init__(self, session_key):
+        self.session_key = session_key
+        self.lock = threading.RLock()
+        self.items = OrderedDict()  # {name: (value, size)} in least-recently-used order
+        self.spilled = {}           # {name: (path, size)}
+        self.resident_bytes = 0     # Sum of the resident items' sizes (read without the lock by sweeps)
+        self.last_seen = time.monotonic()
+        self.write_buffer = None    # The session's WriteBehindBuffer, flushed when the session expires
+
+    def put(self, name, value, size=None):
+        if size is None:
+            size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        self.pop(name)
+        self.items[name] = (value, size)
+        self.resident_bytes += size
+        # Over the per-session budget: spill the least recently used items, never the new one
+        while self.resident_bytes > SESSION_HEAVY_BUDGET_BYTES and len(self.items) > 1:
+            self.evict(next(iter(self.items)))
+
+    def get(self, name, default=None):
+        if name in self.spilled:
+            path, size = self.spilled.pop(name)
+            with open(path, 'rb') as fh:
+                self.items[name] = (pickle.load(fh), size)
+            self.resident_bytes += size
+            os.remove(path)
+        if name not in self.items:
+            return default
+        self.items.move_to_end(name)
+        return self.items[name][0]
+
+    def take(self, name):
+        """Removes an item and hands it over, spilled files included (the caller now owns them)."""
+        value = self.get(name)
+        if name in self.items:
+            self.resident_bytes -= self.items.pop(name)[1]
+        return value
+
+    def pop(self, name):
+        value = self.take(name)
+        if isinstance(value, dict) and 'spill_path' in value:
+            discard_spilled(value)
+        return value
+
+    def evict(self, name=None):
+        """Moves one item (or all of them) to disk and returns the resident bytes released."""
+        os.makedirs(SESSION_SPILL_DIR, exist_ok=True)
+        released = 0
+        for item_name in ([name] if name else list(self.items)):
+            value, size = self.items.pop(item_name)
+            path = os.path.join(SESSION_SPILL_DIR, f"state-{self.session_key}-{item_name}.pkl")
+            with open(path, 'wb') as fh:
+                pickle.dump(value, fh, pickle.HIGHEST_PROTOCOL)
+            self.spilled[item_name] = (path, size)
+            released += size
+        self.resident_bytes -= released
+        return released
+
+    def clear(self):
+        for name in list(self.items) + list(self.spilled):
+            self.pop(name)
+
+class SessionMemoryRegistry:
+    """Process-wide index of every session's heavy state, enforcing the idle and global memory budgets.
+
+    The registry lock only guards the session table. Each session's state has its own lock,
+    held while the page works with it, so pickling and disk writes never block other sessions.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.sessions = {}  # {session_key: SessionHeavyState}
+        self.last_sweep = 0.0
+        self.evictions = 0
+
+    @contextmanager
+    def checkout(self, session_key):
+        """Yields the session's heavy state under its own lock and marks the session active."""
+        with self.lock:
+            state = self.sessions.get(session_key)
+            if state is None:
+                state = self.sessions[session_key] = SessionHeavyState(session_key)
+            state.last_seen = time.monotonic()
+            sweep_due = state.last_seen - self.last_sweep >= SESSION_SWEEP_INTERVAL
+            if sweep_due:
+                self.last_sweep = state.last_seen  # Claims this sweep: concurrent checkouts skip it
+        with state.lock:
+            yield state
+        if sweep_due:
+            self.sweep()
+
+    def sweep(self):
+        """Expires abandoned sessions, evicts idle ones, then evicts the least recently seen until under budget."""
+        with self.lock:
+            now = self.last_sweep = time.monotonic()
+            expired = [key for key, state in self.sessions.items() if now - state.last_seen >= SESSION_EXPIRE_SECONDS]
+            expired = [self.sessions.pop(key) for key in expired]
+            by_age = sorted(self.sessions.values(), key=lambda state: state.last_seen)
+
+        # File work runs outside the registry lock; a session busy with its state is skipped
+        for state in expired:
+            with state.lock:
+                if state.write_buffer is not None:
+                    try:
+                        state.write_buffer.flush()
+                    except Exception:
+                        LOGGER.exception("Write-behind flush failed for an expired session")
+                state.clear()
+        resident = self.resident_bytes()
+        for state in by_age:
+            if now - state.last_seen < SESSION_IDLE_EVICT_SECONDS and resident <= PROCESS_HEAVY_BUDGET_BYTES:
+                break
+            if not state.items or not state.lock.acquire(blocking=False):
+                continue
+            try:
+                resident -= state.evict()
+            finally:
+                state.lock.release()
+            with self.lock:
+                self.evictions += 1
+
+    def resident_bytes(self):
+        with self.lock:
+            states = list(self.sessions.values())
+        return sum(state.resident_bytes for state in states)
+
+    def discard_all(self):
+        with self.lock:
+            states = list(self.sessions.values())
+            self.sessions.clear()
+        for state in states:
+            with state.lock:
+                state.clear()
+
+@st.cache_resource
+def get_session_registry():
+    """Process-wide session memory registry. Spilled files are removed at shutdown."""
+    registry = SessionMemoryRegistry()
+    atexit.register(registry.discard_all)
+    return registry
+
+def session_heavy_state():
+    """Context manager over this session's heavy state (created on first use)."""
+    if 'heavy_state_key' not in st.session_state:
+        st.session_state.heavy_state_key = f"{random.getrandbits(64):016x}"
+    return get_session_registry().checkout(st.session_state.heavy_state_key)
+
+def spilled_uploader(label, item_name, subdir='uploads', **kwargs):
+    """A file uploader whose files go straight to disk: the widget is reset after each upload.
+
+    The heavy-state item `item_name` holds the spilled file's handle. The previous file is
+    removed when a new one replaces it or when the session's heavy state is cleared."""
+    generation_key = f"{item_name}_generation"
+    widget_key = f"{item_name}_{st.session_state.get(generation_key, 0)}"
+    st.file_uploader(label, key=widget_key, on_change=on_spilled_upload, args=(widget_key, item_name, subdir), **kwargs)
+    with session_heavy_state() as heavy:
+        return heavy.get(item_name)
+
+def on_spilled_upload(widget_key, item_name, subdir):
+    """Uploader callback: spills the new file to disk and resets the widget so its buffer is released."""
+    uploaded_file = st.session_state.get(widget_key)
+    if uploaded_file is None:
+        return
+    spilled = spill_upload(uploaded_file, subdir)
+    with session_heavy_state() as heavy:
+        heavy.put(item_name, spilled, size=0)  # Handle only: the bytes live on disk
+    generation_key = f"{item_name}_generation"
+    st.session_state[generation_key] = st.session_state.get(generation_key, 0) + 1
+
+
+# --- 3.9 ADMISSION CONTROL (Weighted, Fair Queue for CPU-Heavy Work) ---
+
+ADMISSION_CAPACITY = max(2, os.cpu_count() or 2)  # Weight units that may run at once
+ADMISSION_MAX_QUEUE = 64                          # Queued tickets beyond this are rejected outright
+ADMISSION_MAX_WAIT = 20.0                         # Seconds a request waits before giving up
+ADMISSION_POLL_SECONDS = 0.5                      # Wait-estimate refresh interval while queued
+ADMISSION_EWMA_ALPHA = 0.2                        # Smoothing of observed service times
+
+# {operation: (weight units, initial service-time estimate in seconds)}
+ADMISSION_COSTS = {
+    'analysis': (2, 2.5),
+    'export': (2, 3.0),
+    'chart': (1, 0.3),
+}
+
+class AdmissionTicket:
+    def __init__(self, user, operation, weight):
+        self.user = user
+        self.operation = operation
+        self.weight = weight
+        self.enqueued_at = time.monotonic()
+        self.granted_at = None
+        self.done = False
+
+class AdmissionController:
+    """Weighted semaphore with a per-user round-robin queue.
+
+    Each operation holds `weight` units of a fixed capacity while it runs. Waiting tickets
+    sit in one FIFO per user and are granted by rotating across users, so one user
+    queueing ten exports cannot delay everyone else's analysis. The head ticket is never
+    skipped for a lighter one behind it, so heavy work cannot starve. Service times are
+    tracked per operation to turn a queue position into an estimated wait.
+    """
+
+    def __init__(self, capacity=ADMISSION_CAPACITY):
+        self.capacity = capacity
+        self.available = capacity
+        self.cond = threading.Condition()
+        self.queues = OrderedDict()  # {user: deque of waiting tickets}, in round-robin order
+        self.running = []
+        self.service_seconds = {op: estimate for op, (_, estimate) in ADMISSION_COSTS.items()}
+        self.counters = {'admitted': 0, 'rejected': 0, 'timed_out': 0}
+
+    def submit(self, user, operation):
+        """Queues a ticket and returns it, or returns None if the queue is full or the user already has this operation pending."""
+        weight = min(ADMISSION_COSTS[operation][0], self.capacity)
+        with self.cond:
+            pending = [t for t in self.running if t.user == user] + list(self.queues.get(user, ()))
+            if any(t.operation == operation for t in pending) or self.queued() >= ADMISSION_MAX_QUEUE:
+                self.counters['rejected'] += 1
+                return None
+            ticket = AdmissionTicket(user, operation, weight)
+            self.queues.setdefault(user, deque()).append(ticket)
+            self._dispatch()
+            return ticket
+
+    def _dispatch(self):
+        while self.queues:
+            user, queue = next(iter(self.queues.items()))
+            ticket = queue[0]
+            if ticket.weight > self.available:
+                break
+            queue.popleft()
+            if queue:
+                self.queues.move_to_end(user)
+            else:
+                del self.queues[user]
+            self.available -= ticket.weight
+            ticket.granted_at = time.monotonic()
+            self.running.append(ticket)
+            self.counters['admitted'] += 1
+        self.cond.notify_all()
+
+    def wait(self, ticket, timeout):
+        with self.cond:
+            return self.cond.wait_for(lambda: ticket.granted_at is not None, timeout)
+
+    def release(self, ticket):
+        """Returns a granted ticket's capacity (recording its service time) or withdraws a queued one."""
+        with self.cond:
+            if ticket.done:
+                return
+            ticket.done = True
+            if ticket.granted_at is None:
+                queue = self.queues.get(ticket.user)
+                if queue is not None and ticket in queue:
+                    queue.remove(ticket)
+                    if not queue:
+                        del self.queues[ticket.user]
+                self.counters['timed_out'] += 1
+            else:
+                self.running.remove(ticket)
+                self.available += ticket.weight
+                elapsed = time.monotonic() - ticket.granted_at
+                previous = self.service_seconds[ticket.operation]
+                self.service_seconds[ticket.operation] = previous + ADMISSION_EWMA_ALPHA * (elapsed - previous)
+            self._dispatch()
+
+    def queued(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def _dispatch_order(self):
+        """Waiting tickets in the order round-robin dispatch would grant them."""
+        queues = [list(queue) for queue in self.queues.values()]
+        return [queue[i] for i in range(max(map(len, queues), default=0)) for queue in queues if i < len(queue)]
+
+    def position(self, ticket):
+        with self.cond:
+            order = self._dispatch_order()
+            return order.index(ticket) if ticket in order else 0
+
+    def estimate_wait(self, ticket=None, operation=None):
+        """Seconds until `ticket` (or a new `operation` request) would start, from running and queued work."""
+        with self.cond:
+            order = self._dispatch_order()
+            if ticket is None and not order and self.available >= ADMISSION_COSTS[operation][0]:
+                return 0.0
+            now = time.monotonic()
+            work = sum(max(0.0, self.service_seconds[t.operation] - (now - t.granted_at)) * t.weight for t in self.running)
+            ahead = order[:order.index(ticket)] if ticket in order else order
+            work += sum(self.service_seconds[t.operation] * t.weight for t in ahead)
+            return work / self.capacity
+
+    def stats(self):
+        with self.cond:
+            return dict(self.counters, running=len(self.running), queued=self.queued(),
+                        in_use=self.capacity - self.available, capacity=self.capacity)
+
+@st.cache_resource
+def get_admission_controller():
+    """Process-wide admission controller shared by every session."""
+    return AdmissionController()
+
+@contextmanager
+def admission(operation, max_wait=ADMISSION_MAX_WAIT):
+    """Yields True once `operation` holds capacity, or False after telling the user it was rejected or timed out."""
+    controller = get_admission_controller()
+    user = st.session_state.get('user_email') or st.session_state.get('heavy_state_key', 'anonymous')
+    ticket = controller.submit(user, operation)
+    if ticket is None:
+        st.warning(f"⏳ The server is busy (or this request is already running). "
+                   f"Estimated wait: ~{controller.estimate_wait(operation=operation):.0f}s. Please try again shortly.")
+        yield False
+        return
+
+    notice = st.empty()
+    deadline = time.monotonic() + max_wait
+    try:
+        while not controller.wait(ticket, timeout=ADMISSION_POLL_SECONDS):
+            if time.monotonic() >= deadline:
+                notice.warning(f"⏳ Still busy after {max_wait:.0f}s. Estimated wait: "
+                               f"~{controller.estimate_wait(ticket):.0f}s. Please try again shortly.")
+                yield False
+                return
+            notice.info(f"⏳ Queued behind {controller.position(ticket)} request(s). "
+                        f"Estimated wait: ~{controller.estimate_wait(ticket):.0f}s")
+        notice.empty()
+        yield True
+    finally:
+        controller.release(ticket)
+
+
+# --- 3.10 NOTIFICATION OUTBOX (Durable Queue + Async Delivery) ---
+
+# Page handlers only INSERT into the outbox table; an asyncio worker thread delivers in the
+# background. Set SKINOVA_SMTP_HOST (plus _PORT/_USER/_PASSWORD/_SENDER) for real delivery, or
+# SKINOVA_SMTP_STANDIN=1 in development for a local SMTP stand-in that writes .eml files next to
+# the outbox. With neither, messages are queued but not delivered until a transport is configured.
+SMTP_HOST_ENV = 'SKINOVA_SMTP_HOST'
+SMTP_STANDIN_ENV = 'SKINOVA_SMTP_STANDIN'
+OUTBOX_BATCH_SIZE = 50         # Messages claimed per delivery round
+OUTBOX_POLL_SECONDS = 5.0      # Idle wait between rounds (enqueue wakes the worker early)
+OUTBOX_LEASE_SECONDS = 120     # Claimed rows are retried by any replica if not settled by then
+OUTBOX_MAX_ATTEMPTS = 6        # Failed deliveries before a message is marked dead
+OUTBOX_BACKOFF_BASE = 5.0      # Seconds before the first retry, doubled per attempt
+OUTBOX_BACKOFF_CAP = 900.0     # Longest wait between retries
+OUTBOX_SEND_TIMEOUT = 20       # SMTP socket timeout
+
+_OUTBOX_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        dedupe_key TEXT NOT NULL UNIQUE,
+        kind TEXT NOT NULL,
+        recipient TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        body TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL NOT NULL,
+        last_error TEXT,
+        created_at TEXT NOT NULL,
+        sent_at TEXT)""",
+    "CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)",
+]
+
+class SMTPTransport:
+    """Delivers a batch over one SMTP connection. Returns {message id: error or None}."""
+
+    def __init__(self, host, port, sender, username=None, password=None):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.username = username
+        self.password = password
+
+    async def start(self):
+        pass
+
+    async def send_batch(self, messages):
+        return await asyncio.to_thread(self._send_batch, messages)
+
+    def _send_batch(self, messages):
+        results = {}
+        try:
+            with smtplib.SMTP(self.host, self.port, timeout=OUTBOX_SEND_TIMEOUT) as smtp:
+                if self.username:
+                    smtp.starttls()
+                    smtp.login(self.username, self.password)
+                for message in messages:
+                    mail = EmailMessage()
+                    mail['From'] = self.sender
+                    mail['To'] = message['recipient']
+                    mail['Subject'] = message['subject']
+                    mail['Message-ID'] = f"<{message['dedupe_key']}@skinova>"
+                    mail.set_content(message['body'])
+                    try:
+                        smtp.send_message(mail)
+                        results[message['id']] = None
+                    except smtplib.SMTPException as exc:
+                        results[message['id']] = str(exc)
+        except (OSError, smtplib.SMTPException) as exc:
+            for message in messages:
+                results.setdefault(message['id'], str(exc))
+        return results
+
+class LocalSMTPTransport(SMTPTransport):
+    """SMTP stand-in for development: a tiny sink server on localhost that writes each message to an .eml file."""
+
+    def __init__(self, maildir):
+        super().__init__('127.0.0.1', 0, 'no-reply@skinova.local')
+        self.maildir = maildir
+
+    async def start(self):
+        os.makedirs(self.maildir, exist_ok=True)
+        self.server = await asyncio.start_server(self._handle_client, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def _handle_client(self, reader, writer):
+        async def reply(line):
+            writer.write(f"{line}\r\n".encode())
+            await writer.drain()
+
+        await reply("220 skinova-standin ESMTP")
+        while line := await reader.readline():
+            command = line.decode('utf-8', 'replace').strip().upper()
+            if command.startswith(('HELO', 'EHLO')):
+                await reply("250 skinova-standin")
+            elif command.startswith(('MAIL', 'RCPT', 'RSET', 'NOOP')):
+                await reply("250 OK")
+            elif command == 'DATA':
+                await reply("354 End data with <CR><LF>.<CR><LF>")
+                lines = []
+                while (data_line := await reader.readline()) not in (b'.\r\n', b'.\n', b''):
+                    lines.append(data_line[1:] if data_line.startswith(b'..') else data_line)
+                with open(os.path.join(self.maildir, f"{time.time_ns()}.eml"), 'wb') as fh:
+                    fh.writelines(lines)
+                await reply("250 OK: queued")
+            elif command == 'QUIT':
+                await reply("221 Bye")
+                break
+            else:
+                await reply("502 Command not implemented")
+        writer.close()
+
+class NotificationOutbox:
+    """Durable outbox table plus the asyncio worker that drains it.
+
+    enqueue() is a single INSERT OR IGNORE keyed by a dedupe key, so handlers never wait
+    on delivery and a repeated event (rerun, double click, second replica) is stored
+    once. The worker claims due rows under a lease, hands them to the transport in
+    batches and either marks them sent or schedules a retry with exponential backoff.
+    """
+
+    def __init__(self, path, transport):
+        self.path = path
+        self.transport = transport
+        self._local = threading.local()
+        self._loop = None
+        self._wakeup = None
+        conn = self.connection()
+        for statement in _OUTBOX_SCHEMA:
+            conn.execute(statement)
+
+    def connection(self):
+        """One autocommit connection per thread (same pattern as SharedSQLiteStore)."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def write_transaction(self):
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    # -- Producer side (page handlers) ---------------------------------------
+
+    def enqueue(self, kind, recipient, subject, body, dedupe_key):
+        """Stores a message for delivery; returns False if the dedupe key was already queued."""
+        cursor = self.connection().execute(
+            "INSERT OR IGNORE INTO outbox (dedupe_key, kind, recipient, subject, body, next_attempt_at, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (dedupe_key, kind, recipient, subject, body, time.time(), datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        if cursor.rowcount and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+        return bool(cursor.rowcount)
+
+    def stats(self):
+        counts = dict(self.connection().execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+        return {status: counts.get(status, 0) for status in ('pending', 'sending', 'sent', 'dead')}
+
+    # -- Worker side ----------------------------------------------------------
+
+    def start(self):
+        threading.Thread(target=asyncio.run, args=(self._run(),), name='skinova-outbox', daemon=True).start()
+
+    async def _run(self):
+        self._wakeup = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        started = False
+        failures = 0  # Consecutive failed rounds, for the backoff
+        while True:
+            try:
+                if not started:
+                    await self.transport.start()
+                    started = True
+                batch = await asyncio.to_thread(self._claim_batch)
+                if batch:
+                    results = await self.transport.send_batch(batch)
+                    await asyncio.to_thread(self._settle, batch, results)
+                failures = 0
+                if batch:
+                    continue
+            except Exception:
+                if not threading.main_thread().is_alive():
+                    return  # Interpreter shutdown closed the executor; leased rows are retried after the lease
+                failures += 1
+                delay = min(OUTBOX_BACKOFF_CAP, OUTBOX_BACKOFF_BASE * 2 ** (failures - 1))
+                LOGGER.exception("Outbox round failed (%d in a row); retrying in %.0fs", failures, delay)
+                await asyncio.sleep(delay)
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), OUTBOX_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def _claim_batch(self):
+        """Leases up to OUTBOX_BATCH_SIZE due rows. Expired leases (crashed worker) are due again."""
+        now = time.time()
+        with self.write_transaction() as conn:
+            rows = conn.execute(
+                "SELECT id, dedupe_key, recipient, subject, body, attempts FROM outbox "
+                "WHERE status IN ('pending', 'sending') AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?",
+                (now, OUTBOX_BATCH_SIZE)).fetchall()
+            conn.executemany("UPDATE outbox SET status = 'sending', next_attempt_at = ? WHERE id = ?",
+                             [(now + OUTBOX_LEASE_SECONDS, row[0]) for row in rows])
+        return [dict(zip(('id', 'dedupe_key', 'recipient', 'subject', 'body', 'attempts'), row)) for row in rows]
+
+    def _settle(self, batch, results):
+        now = time.time()
+        sent, failed = [], []
+        for message in batch:
+            error = results.get(message['id'], 'No result from transport')
+            if error is None:
+                sent.append((datetime.now().strftime("%Y-%m-%d %H:%M:%S"), message['id']))
+                continue
+            attempts = message['attempts'] + 1
+            delay = min(OUTBOX_BACKOFF_CAP, OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+            status = 'dead' if attempts >= OUTBOX_MAX_ATTEMPTS else 'pending'
+            failed.append((status, attempts, now + delay, error[:500], message['id']))
+        with self.write_transaction() as conn:
+            conn.executemany("UPDATE outbox SET status = 'sent', sent_at = ?, last_error = NULL WHERE id = ?", sent)
+            conn.executemany("UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?", failed)
+
+@st.cache_resource
+def get_notification_outbox():
+    """Process-wide outbox. Lives in the shared SQLite file when SKINOVA_SHARED_DB is set.
+
+    The delivery worker runs only when a transport is configured; otherwise messages wait as pending."""
+    data_dir = os.environ.get(DATA_DIR_ENV) or tempfile.gettempdir()
+    path = os.environ.get(SHARED_DB_ENV) or os.path.join(data_dir, 'skinova-outbox.sqlite3')
+    if os.environ.get(SMTP_HOST_ENV):
+        transport = SMTPTransport(os.environ[SMTP_HOST_ENV], int(os.environ.get('SKINOVA_SMTP_PORT', 587)),
+                                  os.environ.get('SKINOVA_SMTP_SENDER', 'no-reply@skinova.ai'),
+                                  os.environ.get('SKINOVA_SMTP_USER'), os.environ.get('SKINOVA_SMTP_PASSWORD'))
+    elif os.environ.get(SMTP_STANDIN_ENV):
+        transport = LocalSMTPTransport(os.path.join(data_dir, 'skinova-mail'))
+    else:
+        transport = None
+        LOGGER.warning("No %s set: notifications are queued but not delivered (set %s=1 for the local stand-in)",
+                       SMTP_HOST_ENV, SMTP_STANDIN_ENV)
+    outbox = NotificationOutbox(path, transport)
+    if transport is not None:
+        outbox.start()
+    return outbox
+
+
+# --- 3.11 LEADERBOARD (Incremental Top-K and Rank Lookup) ---
+
+LEADERBOARD_METRICS = ('Streak', 'Skin Score')
+LEADERBOARD_SEGMENTS = ('Skin_Type', 'Location')
+LEADERBOARD_TOP_K = 10
+
+class RankIndex:
+    """Order-statistics index over non-negative integer values.
+
+    A Fenwick tree of counts per value answers "how many users are above v" in O(log V);
+    the sorted list of distinct values plus a member set per value serves top-K without
+    touching the rest of the population.
+    """
+
+    def __init__(self, size=128):
+        self.tree = [0] * (size + 1)
+        self.members = {}      # {value: set of emails}
+        self.values = []       # Distinct values, ascending
+        self.total = 0
+
+    def _grow(self, value):
+        size = len(self.tree) - 1
+        while value >= size:
+            size *= 2
+        self.tree = [0] * (size + 1)
+        for existing, emails in self.members.items():
+            self._bump(existing, len(emails))
+
+    def _bump(self, value, delta):
+        index = value + 1
+        while index < len(self.tree):
+            self.tree[index] += delta
+            index += index & -index
+
+    def _count_upto(self, value):
+        index, count = min(value + 1, len(self.tree) - 1), 0
+        while index > 0:
+            count += self.tree[index]
+            index -= index & -index
+        return count
+
+    def add(self, value, email):
+        if value >= len(self.tree) - 1:
+            self._grow(value)
+        emails = self.members.get(value)
+        if emails is None:
+            emails = self.members[value] = set()
+            bisect.insort(self.values, value)
+        emails.add(email)
+        self._bump(value, 1)
+        self.total += 1
+
+    def remove(self, value, email):
+        emails = self.members[value]
+        emails.discard(email)
+        if not emails:
+            del self.members[value]
+            del self.values[bisect.bisect_left(self.values, value)]
+        self._bump(value, -1)
+        self.total -= 1
+
+    def count_above(self, value):
+        return self.total - self._count_upto(value)
+
+    def top(self, k):
+        """Up to k (value, email) pairs, highest value first; ties ordered by email."""
+        leaders = []
+        for value in reversed(self.values):
+            leaders.extend((value, email) for email in heapq.nsmallest(k - len(leaders), self.members[value]))
+            if len(leaders) >= k:
+                break
+        return leaders
+
+def leaderboard_entry(record):
+    """A user's leaderboard values and segments (None if the user is not onboarded yet)."""
+    if not record or not record.get('Onboarding_Complete'):
+        return None
+    return (
+        tuple(max(0, int(round(record.get(metric) or 0))) for metric in LEADERBOARD_METRICS),
+        tuple(record.get(dimension) or 'Not set' for dimension in LEADERBOARD_SEGMENTS),
+    )
+
+class Leaderboard:
+    """Streak and score rankings, globally and per segment, kept current through the user observer hook.
+
+    One RankIndex exists per (metric, segment dimension, segment value); the global board uses
+    dimension None. A committed change to a user moves them between indexes in O(log V), and
+    rank() is a single Fenwick query, so no request ever sorts the user DB.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stale = True
+        self.entries = {}   # {email: leaderboard_entry}
+        self.indexes = {}   # {(metric, dimension, segment value): RankIndex}
+
+    def _index_keys(self, entry):
+        values, segments = entry
+        for metric, value in zip(LEADERBOARD_METRICS, values):
+            yield (metric, None, None), value
+            for dimension, segment in zip(LEADERBOARD_SEGMENTS, segments):
+                yield (metric, dimension, segment), value
+
+    def _apply(self, email, entry, sign):
+        for key, value in self._index_keys(entry):
+            if sign > 0:
+                self.indexes.setdefault(key, RankIndex()).add(value, email)
+            else:
+                index = self.indexes[key]
+                index.remove(value, email)
+                if not index.total:
+                    del self.indexes[key]
+
+    # -- User observer protocol --------------------------------------------
+
+    def snapshot(self, record):
+        return None # The previous entry is kept in self.entries
+
+    def update(self, email, token, record):
+        after = leaderboard_entry(record)
+        with self.lock:
+            before = self.entries.get(email)
+            if before == after:
+                return
+            if before is not None:
+                self._apply(email, before, -1)
+                del self.entries[email]
+            if after is not None:
+                self._apply(email, after, +1)
+                self.entries[email] = after
+
+    def mark_stale(self):
+        self.stale = True
+
+    def rebuild(self, user_db):
+        with self.lock:
+            self.entries, self.indexes = {}, {}
+            for email, record in user_db.items():
+                entry = leaderboard_entry(record)
+                if entry is not None:
+                    self._apply(email, entry, +1)
+                    self.entries[email] = entry
+            self.stale = False
+
+    # -- Read side ----------------------------------------------------------
+
+    def _key(self, metric, dimension, email):
+        segment = self.entries[email][1][LEADERBOARD_SEGMENTS.index(dimension)] if dimension else None
+        return (metric, dimension, segment)
+
+    def rank(self, metric, email, dimension=None):
+        """(rank, population, value) for the user, within their own segment of `dimension` if given."""
+        with self.lock:
+            if email not in self.entries:
+                return None
+            value = self.entries[email][0][LEADERBOARD_METRICS.index(metric)]
+            index = self.indexes[self._key(metric, dimension, email)]
+            return index.count_above(value) + 1, index.total, value
+
+    def top(self, metric, email=None, dimension=None, k=LEADERBOARD_TOP_K):
+        """Top-k (rank, email, value) rows, globally or within the user's segment of `dimension`."""
+        with self.lock:
+            key = self._key(metric, dimension, email) if dimension and email in self.entries else (metric, None, None)
+            index = self.indexes.get(key)
+            if index is None:
+                return []
+            return [(index.count_above(value) + 1, member, value) for value, member in index.top(k)]
+
+def get_leaderboard():
+    """Returns the store's leaderboard, registering it as a user observer on first use."""
+    store = get_data_store()
+    with store.lock:
+        leaderboard = getattr(store, 'leaderboard', None)
+        if leaderboard is None:
+            leaderboard = Leaderboard()
+            store.leaderboard = leaderboard
+            store.user_observers.append(leaderboard)
+        if leaderboard.stale:
+            leaderboard.rebuild(store.user_db)
+    return leaderboard
+
+
+# --- 3.12 COMPLIANCE CALENDAR (Vectorized Year Heatmap) ---
+
+COMPLIANCE_CALENDAR_DAYS = 365
+# Fill colors from "no record" through 0% ... 100% compliance
+COMPLIANCE_NO_DATA_COLOR = '#EBEDF0'
+COMPLIANCE_COLORS = np.array(['#E3F2FA', '#B3DDF0', SOFT_BLUE, DARK_ACCENT, '#1F5F7A'])
+COMPLIANCE_BINS = np.array([0.25, 0.5, 0.75, 1.0])  # Upper edges (exclusive) of all but the last color
+WEEKDAY_LABELS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
+def _row_ratio(rows, slot):
+    """Completed/total for one slot of every progress row (NaN where the slot has no steps)."""
+    done = np.fromiter((sum(row.get(slot, ())) for row in rows), dtype=float, count=len(rows))
+    total = np.fromiter((len(row.get(slot, ())) for row in rows), dtype=float, count=len(rows))
+    return np.divide(done, total, out=np.full(len(rows), np.nan), where=total > 0)
+
+class ComplianceCalendar:
+    """AM/PM compliance for the trailing year as two dense float arrays (NaN = no record that day).
+
+    Built in one pass: the ISO day keys are parsed by NumPy in a single call and scattered
+    into the arrays by offset. set_day() patches one cell when today's checkboxes change,
+    and the weekday/monthly breakdowns are recomputed lazily with bincount.
+    """
+
+    def __init__(self, progress, end_day):
+        self.start = np.datetime64(end_day, 'D') - (COMPLIANCE_CALENDAR_DAYS - 1)
+        self.dates = self.start + np.arange(COMPLIANCE_CALENDAR_DAYS)
+        self.am = np.full(COMPLIANCE_CALENDAR_DAYS, np.nan)
+        self.pm = np.full(COMPLIANCE_CALENDAR_DAYS, np.nan)
+        self._breakdowns = None
+        self.lock = threading.Lock()  # The cached calendar is patched by save_progress_row()
+        if progress:
+            offsets = (np.array(list(progress), dtype='datetime64[D]') - self.start).astype(np.int64)
+            in_window = (offsets >= 0) & (offsets < COMPLIANCE_CALENDAR_DAYS)
+            rows = [row for row, keep in zip(progress.values(), in_window) if keep]
+            self.am[offsets[in_window]] = _row_ratio(rows, 'AM')
+            self.pm[offsets[in_window]] = _row_ratio(rows, 'PM')
+
+    def set_day(self, day_key, row):
+        offset = int((np.datetime64(day_key, 'D') - self.start).astype(np.int64))
+        if 0 <= offset < COMPLIANCE_CALENDAR_DAYS:
+            with self.lock:
+                self.am[offset], self.pm[offset] = _row_ratio([row], 'AM')[0], _row_ratio([row], 'PM')[0]
+                self._breakdowns = None
+
+    def breakdowns(self):
+        """(weekday frame, monthly frame, tracked days) of average AM/PM compliance over recorded days."""
+        with self.lock:
+            return self._breakdowns if self._breakdowns is not None else self._compute_breakdowns()
+
+    def _compute_breakdowns(self):
+        weekdays = (self.dates.astype(np.int64) - 4) % 7  # 1970-01-01 was a Thursday
+        months, month_index = np.unique(self.dates.astype('datetime64[M]'), return_inverse=True)
+
+        def averages(groups, size):
+            columns = {}
+            for label, values in (('Morning', self.am), ('Evening', self.pm)):
+                recorded = ~np.isnan(values)
+                sums = np.bincount(groups[recorded], weights=values[recorded], minlength=size)
+                counts = np.bincount(groups[recorded], minlength=size)
+                columns[label] = np.divide(sums, counts, out=np.full(size, np.nan), where=counts > 0)
+            return columns
+
+        weekday_frame = pd.DataFrame(averages(weekdays, 7), index=WEEKDAY_LABELS)
+        month_labels = pd.to_datetime(months).strftime('%b %Y')
+        monthly_frame = pd.DataFrame(averages(month_index, len(months)), index=month_labels)
+        tracked = int((~np.isnan(self.am) | ~np.isnan(self.pm)).sum())
+        self._breakdowns = (weekday_frame, monthly_frame.dropna(how='all'), tracked)
+        return self._breakdowns
+
+    def render_today(self):
+        """Today's AM and PM cells (the year view's last column) as inline swatches."""
+        with self.lock:
+            values = (self.am[-1], self.pm[-1])
+        cells = []
+        for label, value in zip(("☀️ Morning", "🌙 Evening"), values):
+            color = COMPLIANCE_NO_DATA_COLOR if np.isnan(value) else COMPLIANCE_COLORS[np.digitize(value, COMPLIANCE_BINS)]
+            text = "no record" if np.isnan(value) else f"{value * 100:.0f}%"
+            cells.append(f'<span style="display: inline-block; width: 11px; height: 11px; background: {color}; '
+                         f'margin: 0 4px 0 16px;"></span>{label}: {text}')
+        return "".join(cells)
+
+    def render_svg(self, slot):
+        """GitHub-style week-column heatmap for 'AM' or 'PM' as one compact inline SVG (one path per color)."""
+        with self.lock:
+            values = (self.am if slot == 'AM' else self.pm).copy()
+        levels = np.where(np.isnan(values), -1, np.digitize(np.nan_to_num(values), COMPLIANCE_BINS))
+        cells = np.arange(COMPLIANCE_CALENDAR_DAYS) + int((self.start.astype(np.int64) - 4) % 7)  # 1970-01-01 was a Thursday
+        xs, ys = (cells // 7) * 14, (cells % 7) * 14 + 16
+        paths = []
+        for level, color in [(-1, COMPLIANCE_NO_DATA_COLOR)] + list(enumerate(COMPLIANCE_COLORS)):
+            mask = levels == level
+            if mask.any():
+                outline = "".join(f"M{x} {y}h11v11h-11z" for x, y in zip(xs[mask], ys[mask]))
+                paths.append(f'<path fill="{color}" d="{outline}"/>')
+        month_starts = np.flatnonzero(self.dates.astype('datetime64[D]') == self.dates.astype('datetime64[M]'))
+        labels = "".join(f'<text x="{xs[i]}" y="11" font-size="10" fill="#777">{pd.Timestamp(self.dates[i]).strftime("%b")}</text>'
+                         for i in month_starts if xs[i] <= xs[-1] - 20)
+        return f'<svg viewBox="0 0 {int(xs[-1]) + 11} 112" width="100%" xmlns="http://www.w3.org/2000/svg">{labels}{"".join(paths)}</svg>'
+
+def get_compliance_calendar(email):
+    """Trailing-year calendar for the session's progress, cached per user per day."""
+    return get_profile_cache().get_or_load(
+        email, ('calendar', get_today_key()),
+        lambda: ComplianceCalendar(st.session_state.daily_progress, date.today()))
+
+
+# --- 3.13 SKIN TWINS (Nearest-Neighbour Search over Scan Vectors) ---
+
+# Indicator rating options, ordered from best to worst (the position is the severity level)
+ANALYZER_INDICATORS = {
+    "Acne Index (P. Acnes Activity)": ["Low", "Mild (Localized)", "Moderate (Diffuse)", "High (Severe)"],
+    "Pigmentation Index (Melanin Density)": ["Low", "Mild (Freckling)", "Moderate (Sun Damage)", "High (Melasma)"],
+    "Wrinkle Depth (Simulated)": ["Low (Dynamic only)", "Minimal (Fine Lines)", "Moderate (Static lines)", "Significant (Deep creases)"],
+    "Hydration Level (TEWL Metric)": ["Optimal (Level 5)", "Good (Level 4)", "Fair (Level 3)", "Poor (Level 2)"],
+    "Redness/Inflammation Index": ["Minimal", "Localized (Around acne)", "Diffuse (General sensitivity)"],
+}
+SKIN_TYPE_OPTIONS = ['Very Dry', 'Dry/Normal', 'Combination (Oily T-Zone)', 'Oily']
+CONCERN_OPTIONS = ['Acne & Breakouts (Hormonal)', 'Acne & Breakouts (Fungal/Bacterial)', 'Dryness & Dehydration (Barrier)', 'Redness & Sensitivity (Rosacea)',
+                   'Dark Spots/Melasma/Pigmentation', 'Fine Lines & Wrinkles (Static)', 'Loss of Firmness/Elasticity', 'Oil Control/Excess Sebum']
+FITZPATRICK_OPTIONS = ['Type I (Always burns)', 'Type II (Burns easily)', 'Type III (Tans sometimes)', 'Type IV (Tans easily)', 'Type V (Rarely burns)', 'Type VI (Never burns)']
+SLEEP_QUALITY_OPTIONS = ['Poor', 'Average', 'Good', 'Excellent']
+MAX_INTERNAL_RISK_SCORE = 37
+
+# Relative weight of each feature group in the similarity
+TWIN_WEIGHT_VISUAL = 2.0
+TWIN_WEIGHT_LIFESTYLE = 1.0
+TWIN_WEIGHT_PROFILE = 1.0
+TWIN_DIM = len(ANALYZER_INDICATORS) + 5 + len(SKIN_TYPE_OPTIONS) + len(CONCERN_OPTIONS) + 2
+
+TWIN_TOP_K = 3                  # Twins shown per scan
+TWIN_OVERFETCH = 8              # Candidates fetched per twin (several scans can belong to one user)
+TWIN_IVF_MIN_VECTORS = 50000    # Below this a brute-force scan beats probing partitions
+TWIN_IVF_NPROBE = 16            # Partitions scanned per query
+TWIN_KMEANS_SAMPLE = 100000     # Vectors used to train the partition centroids
+TWIN_KMEANS_ITERATIONS = 10
+TWIN_ASSIGN_CHUNK = 16384       # Vectors assigned to partitions per matrix product
+TWIN_REBUILD_FRACTION = 0.1     # Rebuild once the unindexed tail reaches this share of the base
+
+def scan_feature_vector(results, q_inputs, profile):
+    """Fixed-length, unit-norm float32 descriptor of one scan: indicator severities, lifestyle and profile."""
+    visual = [options.index(results[name]) / (len(options) - 1) for name, options in ANALYZER_INDICATORS.items()]
+    lifestyle = [
+        q_inputs['stress_level'] / 10,
+        q_inputs['water_intake'] / 4,
+        SLEEP_QUALITY_OPTIONS.index(q_inputs['sleep_quality']) / (len(SLEEP_QUALITY_OPTIONS) - 1),
+        min(q_inputs['sun_exposure'], 120) / 120,
+        compute_internal_risk_score(q_inputs) / MAX_INTERNAL_RISK_SCORE,
+    ]
+    concerns = profile.get('Concerns') or []
+    fitzpatrick = profile.get('Fitzpatrick_Type')
+    profile_features = ([float(profile.get('Skin_Type') == option) for option in SKIN_TYPE_OPTIONS]
+                        + [float(option in concerns) for option in CONCERN_OPTIONS]
+                        + [FITZPATRICK_OPTIONS.index(fitzpatrick) / (len(FITZPATRICK_OPTIONS) - 1) if fitzpatrick in FITZPATRICK_OPTIONS else 0.5,
+                           min(profile.get('Age') or 30, 80) / 80])
+    vector = np.concatenate([TWIN_WEIGHT_VISUAL * np.asarray(visual), TWIN_WEIGHT_LIFESTYLE * np.asarray(lifestyle),
+                             TWIN_WEIGHT_PROFILE * np.asarray(profile_features)]).astype(np.float32)
+    return vector / max(float(np.linalg.norm(vector)), 1e-6)
+
+class TwinIndex:
+    """Cosine-similarity index over scan vectors, optionally backed by memory-mapped .npy files.
+
+    The indexed base is one (N, TWIN_DIM) float32 matrix. Small bases are searched brute
+    force with a single BLAS matrix-vector product. From TWIN_IVF_MIN_VECTORS on, rebuild()
+    trains spherical k-means centroids and stores the base grouped by partition, so a
+    query scores the centroids and only TWIN_IVF_NPROBE contiguous slices. Scans added
+    since the last rebuild sit in a small tail that is always searched exhaustively (and
+    appended to tail.ndjson when the index has a directory). Rebuilds run in a background
+    thread and swap in atomically.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.rebuilding = False
+        self.owner_emails = []  # owner id -> email
+        self.owner_ids = {}
+        self.base = np.empty((0, TWIN_DIM), dtype=np.float32)
+        self.base_owners = np.empty(0, dtype=np.int32)
+        self.centroids = None   # (partitions, TWIN_DIM) when the base is partitioned
+        self.offsets = None     # Partition p is base[offsets[p]:offsets[p + 1]]
+        self.tail = np.empty((1024, TWIN_DIM), dtype=np.float32)  # Grows by doubling; rows [:tail_count] are live
+        self.tail_owners = np.empty(1024, dtype=np.int32)
+        self.tail_count = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._load()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _load(self):
+        if os.path.exists(self._path('vectors.npy')):
+            self.base = np.load(self._path('vectors.npy'), mmap_mode='r')
+            self.base_owners = np.load(self._path('owners.npy'), mmap_mode='r')
+            with open(self._path('emails.json'), encoding='utf-8') as fh:
+                self.owner_emails = json.load(fh)
+            if os.path.exists(self._path('centroids.npy')):
+                self.centroids = np.load(self._path('centroids.npy'))
+                self.offsets = np.load(self._path('offsets.npy'))
+        self.owner_ids = {email: owner for owner, email in enumerate(self.owner_emails)}
+        if os.path.exists(self._path('tail.ndjson')):
+            with open(self._path('tail.ndjson'), encoding='utf-8') as fh:
+                for line in fh:
+                    row = json.loads(line)
+                    self._append_tail(row['email'], np.asarray(row['vector'], dtype=np.float32))
+
+    def _append_tail(self, email, vector):
+        owner = self.owner_ids.get(email)
+        if owner is None:
+            owner = self.owner_ids[email] = len(self.owner_emails)
+            self.owner_emails.append(email)
+        if self.tail_count == len(self.tail):
+            self.tail = np.concatenate([self.tail, np.empty_like(self.tail)])
+            self.tail_owners = np.concatenate([self.tail_owners, np.empty_like(self.tail_owners)])
+        self.tail[self.tail_count] = vector
+        self.tail_owners[self.tail_count] = owner
+        self.tail_count += 1
+
+    def __len__(self):
+        return len(self.base) + self.tail_count
+
+    def add(self, email, vector):
+        with self.lock:
+            self._append_tail(email, vector)
+            if self.directory:
+                with open(self._path('tail.ndjson'), 'a', encoding='utf-8') as fh:
+                    fh.write(json.dumps({'email': email, 'vector': vector.round(6).tolist()}) + "\n")
+            due = self.tail_count >= max(1000, TWIN_REBUILD_FRACTION * len(self.base))
+        if due:
+            self.rebuild_async()
+
+    def search(self, vector, k=TWIN_TOP_K, exclude_email=None):
+        """Top-k most similar owners as [(email, similarity)], best first, one entry per user."""
+        with self.lock:
+            base, base_owners, centroids, offsets = self.base, self.base_owners, self.centroids, self.offsets
+            # Views, not copies: appends only write past tail_count (or into a new buffer)
+            tail, tail_owners = self.tail[:self.tail_count], self.tail_owners[:self.tail_count]
+            owner_emails = self.owner_emails
+
+        if centroids is not None:
+            probes = np.argsort(centroids @ vector)[-TWIN_IVF_NPROBE:]
+            slices = [slice(offsets[p], offsets[p + 1]) for p in probes]
+        else:
+            slices = [slice(0, len(base))]
+        # Score each block in place (no copy of the base) and concatenate only the scores
+        scores = np.concatenate([base[s] @ vector for s in slices] + [tail @ vector])
+        owners = np.concatenate([base_owners[s] for s in slices] + [tail_owners])
+        if not len(scores):
+            return []
+        fetch = min(len(scores), k * TWIN_OVERFETCH)
+        best = np.argpartition(scores, -fetch)[-fetch:]
+        twins, seen = [], set()
+        for row in best[np.argsort(scores[best])[::-1]]:
+            email = owner_emails[owners[row]]
+            if email != exclude_email and email not in seen:
+                seen.add(email)
+                twins.append((email, float(scores[row])))
+                if len(twins) == k:
+                    break
+        return twins
+
+    # -- Rebuild ------------------------------------------------------------
+
+    def rebuild_async(self):
+        with self.lock:
+            if self.rebuilding:
+                return
+            self.rebuilding = True
+        threading.Thread(target=self.rebuild, name='skinova-twin-rebuild', daemon=True).start()
+
+    def rebuild(self):
+        """Folds the tail into the base, (re)partitions it when large enough and persists the result."""
+        try:
+            with self.lock:
+                consumed = self.tail_count
+                vectors = np.concatenate([self.base, self.tail[:consumed]])
+                owners = np.concatenate([self.base_owners, self.tail_owners[:consumed]])
+                owner_emails = list(self.owner_emails)
+
+            centroids = offsets = None
+            if len(vectors) >= TWIN_IVF_MIN_VECTORS:
+                centroids = train_partitions(vectors, int(np.sqrt(len(vectors))))
+                assignment = np.concatenate([np.argmax(vectors[i:i + TWIN_ASSIGN_CHUNK] @ centroids.T, axis=1)
+                                             for i in range(0, len(vectors), TWIN_ASSIGN_CHUNK)])
+                order = np.argsort(assignment, kind='stable')
+                vectors, owners = vectors[order], owners[order]
+                offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=len(centroids)))])
+
+            if self.directory:
+                self._persist(vectors, owners, owner_emails, centroids, offsets)
+                vectors = np.load(self._path('vectors.npy'), mmap_mode='r')
+                owners = np.load(self._path('owners.npy'), mmap_mode='r')
+
+            with self.lock:
+                self.base, self.base_owners = vectors, owners
+                self.centroids, self.offsets = centroids, offsets
+                self.tail_count -= consumed
+                self.tail = np.concatenate([self.tail[consumed:consumed + self.tail_count], np.empty((1024, TWIN_DIM), dtype=np.float32)])
+                self.tail_owners = np.concatenate([self.tail_owners[consumed:consumed + self.tail_count], np.empty(1024, dtype=np.int32)])
+                if self.directory:
+                    with open(self._path('tail.ndjson'), 'w', encoding='utf-8') as fh:
+                        for vector, owner in zip(self.tail[:self.tail_count], self.tail_owners[:self.tail_count]):
+                            fh.write(json.dumps({'email': self.owner_emails[owner], 'vector': vector.round(6).tolist()}) + "\n")
+        finally:
+            self.rebuilding = False
+
+    def _persist(self, vectors, owners, owner_emails, centroids, offsets):
+        """Writes every file to a temp name first, then swaps them in with os.replace."""
+        staged = {'vectors.npy': vectors, 'owners.npy': owners}
+        if centroids is not None:
+            staged.update({'centroids.npy': centroids, 'offsets.npy': offsets})
+        for name, array in staged.items():
+            with open(self._path(name + '.tmp'), 'wb') as fh:
+                np.save(fh, array)
+        with open(self._path('emails.json.tmp'), 'w', encoding='utf-8') as fh:
+            json.dump(owner_emails, fh)
+        for name in list(staged) + ['emails.json']:
+            os.replace(self._path(name + '.tmp'), self._path(name))
+        if centroids is None:
+            for name in ('centroids.npy', 'offsets.npy'):
+                if os.path.exists(self._path(name)):
+                    os.remove(self._path(name))
+
+def train_partitions(vectors, partitions, seed=0):
+    """Spherical k-means on a sample: unit-norm centroids maximising cosine similarity."""
+    rng = np.random.default_rng(seed)
+    sample = vectors[rng.choice(len(vectors), min(len(vectors), TWIN_KMEANS_SAMPLE), replace=False)]
+    centroids = sample[rng.choice(len(sample), partitions, replace=False)].copy()
+    for _ in range(TWIN_KMEANS_ITERATIONS):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        empty = norms[:, 0] == 0
+        centroids = np.where(empty[:, None], centroids, sums / np.maximum(norms, 1e-12)).astype(np.float32)
+    return centroids
+
+def get_twin_index():
+    """Returns the store's twin index. With SKINOVA_DATA_DIR it is memory-mapped from <data dir>/twins."""
+    store = get_data_store()
+    with store.lock:
+        index = getattr(store, 'twin_index', None)
+        if index is None:
+            directory = os.path.join(store.journal.data_dir, 'twins') if store.journal is not None else None
+            index = store.twin_index = TwinIndex(directory)
+    return index
+
+# Map a durable store's index files when the process binds it, not on the first scan
+if get_data_store().journal is not None:
+    get_twin_index()
+
+
+# --- 3.14 KIT RECOMMENDER (Matrix Scoring over the Product Catalog) ---
+
+# Hyper-Extension: Expanded product list (20+ items), shared by the marketplace and the kit builder
+PRODUCT_CATALOG = [
+    {"Name": "Barrier Repair Cleanser", "Price": "$25", "Concern": "Dryness & Dehydration (Barrier)", "Link": "#", "Type": "Cleanser", "Key_Ingredients": "Ceramides, Glycerin, Cholesterol"},
+    {"Name": "BHA Pimple Serum (2%)", "Price": "$35", "Concern": "Acne & Breakouts (Fungal/Bacterial)", "Link": "#", "Type": "Treatment", "Key_Ingredients": "Salicylic Acid, Niacinamide, Green Tea"},
+    {"Name": "Pro-Retinol 0.5% Cream", "Price": "$50", "Concern": "Fine Lines & Wrinkles (Static)", "Link": "#", "Type": "Treatment", "Key_Ingredients": "Encapsulated Retinol, Peptides, Bisabolol"},
+    {"Name": "Calm-Cica Gel", "Price": "$30", "Concern": "Redness & Sensitivity (Rosacea)", "Link": "#", "Type": "Moisturizer", "Key_Ingredients": "Centella Asiatica, Allantoin, Panthenol"},
+    {"Name": "Ascorbic Acid 15% Serum", "Price": "$45", "Concern": "Dark Spots/Melasma/Pigmentation", "Link": "#", "Type": "Serum", "Key_Ingredients": "L-Ascorbic Acid, Ferulic Acid, Vitamin E"},
+    {"Name": "Multi-Weight HA Booster", "Price": "$28", "Concern": "Dryness & Dehydration (Barrier)", "Link": "#", "Type": "Serum", "Key_Ingredients": "Hyaluronic Acid (3 Weights), B5, Trehalose"},
+    {"Name": "A-Zinc Oil Control Serum", "Price": "$30", "Concern": "Oil Control/Excess Sebum", "Link": "#", "Type": "Serum", "Key_Ingredients": "Niacinamide (10%), Zinc PCA, Licorice Root"},
+    {"Name": "Mineral Defense SPF 50", "Price": "$35", "Concern": "All", "Link": "#", "Type": "Sunscreen", "Key_Ingredients": "Zinc Oxide, Titanium Dioxide, Iron Oxides"},
+    {"Name": "Hydro-Repair Eye Cream", "Price": "$40", "Concern": "Fine Lines & Wrinkles (Static)", "Link": "#", "Type": "Eye Care", "Key_Ingredients": "Argireline Peptide, Caffeine, Retinal"},
+    {"Name": "Deep Hydrating Toner", "Price": "$20", "Concern": "Dryness & Dehydration (Barrier)", "Link": "#", "Type": "Toner", "Key_Ingredients": "Rose Water, Snail Mucin, Galactomyces Ferment"},
+    {"Name": "Azelaic Acid Suspension", "Price": "$22", "Concern": "Acne & Breakouts (Hormonal)", "Link": "#", "Type": "Treatment", "Key_Ingredients": "Azelaic Acid (10%), Squalane"},
+    {"Name": "PM Occlusive Balm", "Price": "$38", "Concern": "Loss of Firmness/Elasticity", "Link": "#", "Type": "Moisturizer", "Key_Ingredients": "Petrolatum, Shea Butter, Peptides"},
+    {"Name": "Glycolic Acid Toning Pads", "Price": "$32", "Concern": "Loss of Firmness/Elasticity", "Link": "#", "Type": "Exfoliant", "Key_Ingredients": "Glycolic Acid (8%), Aloe Vera"},
+    {"Name": "Gel-to-Foam Clarifying Cleanser", "Price": "$24", "Concern": "Oil Control/Excess Sebum", "Link": "#", "Type": "Cleanser", "Key_Ingredients": "Salicylic Acid, Willow Bark"},
+    {"Name": "Creamy Hydrating Cleansing Balm", "Price": "$30", "Concern": "Dryness & Dehydration (Barrier)", "Link": "#", "Type": "Cleanser", "Key_Ingredients": "Ceramides, Oat Extract"},
+    {"Name": "Gentle pH-Balanced Cleanser", "Price": "$18", "Concern": "Redness & Sensitivity (Rosacea)", "Link": "#", "Type": "Cleanser", "Key_Ingredients": "Glycerin, Niacinamide"},
+    {"Name": "Peptide & Copper Complex Serum", "Price": "$65", "Concern": "Loss of Firmness/Elasticity", "Link": "#", "Type": "Serum", "Key_Ingredients": "Copper Peptides, Hyaluronic Acid"},
+    {"Name": "Niacinamide 10% Barrier Serum", "Price": "$24", "Concern": "Redness & Sensitivity (Rosacea)", "Link": "#", "Type": "Serum", "Key_Ingredients": "Niacinamide, Zinc PCA"},
+    {"Name": "Oil-Free Water Gel Moisturizer", "Price": "$26", "Concern": "Oil Control/Excess Sebum", "Link": "#", "Type": "Moisturizer", "Key_Ingredients": "Hyaluronic Acid, Amino Acids"},
+    {"Name": "Ceramide-Rich Repair Cream", "Price": "$34", "Concern": "Dryness & Dehydration (Barrier)", "Link": "#", "Type": "Moisturizer", "Key_Ingredients": "Ceramides, Squalane, Cholesterol"},
+    {"Name": "Benzoyl Peroxide Spot Treatment", "Price": "$12", "Concern": "Acne & Breakouts (Fungal/Bacterial)", "Link": "#", "Type": "Treatment", "Key_Ingredients": "Benzoyl Peroxide 5%"},
+    {"Name": "Time-Release Retinaldehyde Cream", "Price": "$70", "Concern": "Fine Lines & Wrinkles (Static)", "Link": "#", "Type": "Treatment", "Key_Ingredients": "Retinaldehyde, Bakuchiol"},
+    {"Name": "Kojic Acid & Arbutin Mask (Weekly)", "Price": "$36", "Concern": "Dark Spots/Melasma/Pigmentation", "Link": "#", "Type": "Treatment", "Key_Ingredients": "Alpha-Arbutin, Kojic Acid"},
+    {"Name": "PHA/BHA Gentle Exfoliator", "Price": "$28", "Concern": "Oil Control/Excess Sebum", "Link": "#", "Type": "Exfoliant", "Key_Ingredients": "PHA, Lactic Acid"},
+    {"Name": "Sheer Daily Fluid SPF 30", "Price": "$22", "Concern": "Oil Control/Excess Sebum", "Link": "#", "Type": "Sunscreen", "Key_Ingredients": "Zinc Oxide, Niacinamide, Green Tea"},
+    {"Name": "Growth Factor Recovery Serum", "Price": "$120", "Concern": "Loss of Firmness/Elasticity", "Link": "#", "Type": "Serum", "Key_Ingredients": "Peptides, Ceramides, Squalane"},
+]
+
+# Ingredient flags, matched against the start of a word in Key_Ingredients
+INGREDIENT_FLAGS = {
+    'exfoliant': ('salicylic', 'glycolic', 'lactic', 'pha', 'bha', 'willow bark'),
+    'retinoid': ('retinol', 'retinal'),
+    'potent': ('retinol', 'retinal', 'benzoyl peroxide', 'glycolic', 'salicylic', 'l-ascorbic'),
+    'antibacterial': ('benzoyl peroxide', 'azelaic', 'salicylic'),
+    'antioxidant': ('ascorbic', 'l-ascorbic', 'ferulic', 'vitamin e', 'green tea'),
+    'brightening': ('ascorbic', 'l-ascorbic', 'arbutin', 'alpha-arbutin', 'kojic', 'licorice', 'azelaic', 'niacinamide'),
+    'barrier': ('ceramide', 'cholesterol', 'squalane', 'panthenol', 'b5'),
+    'humectant': ('hyaluronic', 'glycerin', 'trehalose', 'snail', 'amino acids', 'aloe', 'rose water'),
+    'occlusive': ('petrolatum', 'shea', 'squalane'),
+    'soothing': ('centella', 'allantoin', 'oat', 'bisabolol', 'panthenol', 'aloe'),
+    'peptide': ('peptide', 'copper peptide', 'argireline'),
+    'oil_control': ('niacinamide', 'zinc pca', 'salicylic', 'willow bark'),
+}
+KIT_FEATURES = CONCERN_OPTIONS + list(INGREDIENT_FLAGS) + ['price']
+
+# Profile encoding: every answer adds weight to concern and ingredient features
+GOAL_CONCERN_WEIGHTS = {
+    'Acne Clearing & Scar Reduction': {'Acne & Breakouts (Hormonal)': 0.5, 'Acne & Breakouts (Fungal/Bacterial)': 0.5},
+    'Advanced Anti-Aging & Firming': {'Fine Lines & Wrinkles (Static)': 0.5, 'Loss of Firmness/Elasticity': 0.5},
+    'Max Hydration & Barrier Repair': {'Dryness & Dehydration (Barrier)': 0.7},
+    'Brightening & Even Tone/Melasma Reduction': {'Dark Spots/Melasma/Pigmentation': 0.7},
+}
+CONCERN_INGREDIENT_WEIGHTS = {
+    'Acne & Breakouts (Hormonal)': {'antibacterial': 0.4, 'oil_control': 0.2},
+    'Acne & Breakouts (Fungal/Bacterial)': {'antibacterial': 0.5, 'exfoliant': 0.2},
+    'Dryness & Dehydration (Barrier)': {'humectant': 0.4, 'barrier': 0.4},
+    'Redness & Sensitivity (Rosacea)': {'soothing': 0.5, 'potent': -0.3},
+    'Dark Spots/Melasma/Pigmentation': {'brightening': 0.5, 'antioxidant': 0.2},
+    'Fine Lines & Wrinkles (Static)': {'retinoid': 0.5, 'peptide': 0.3, 'antioxidant': 0.2},
+    'Loss of Firmness/Elasticity': {'peptide': 0.5, 'retinoid': 0.2},
+    'Oil Control/Excess Sebum': {'oil_control': 0.5},
+}
+SKIN_TYPE_INGREDIENT_WEIGHTS = {
+    'Very Dry': {'barrier': 0.6, 'occlusive': 0.5, 'humectant': 0.4, 'exfoliant': -0.4},
+    'Dry/Normal': {'humectant': 0.4, 'barrier': 0.3},
+    'Combination (Oily T-Zone)': {'oil_control': 0.4, 'humectant': 0.2, 'occlusive': -0.2},
+    'Oily': {'oil_control': 0.6, 'exfoliant': 0.3, 'occlusive': -0.5},
+}
+SENSITIVITY_POTENCY_PENALTY = {'Low': 0.0, 'Mild': 0.2, 'Moderate': 0.4, 'High/Reactive': 0.9}
+# {budget answer: (max price per product, weight against price)}
+BUDGET_BANDS = {
+    '$20 - $50 (Budget)': (35, 1.0),
+    '$50 - $100 (Mid-Range)': (60, 0.5),
+    '$100 - $200 (Premium)': (100, 0.2),
+    '$200+ (Luxury)': (float('inf'), 0.0),
+}
+DEFAULT_BUDGET = '$50 - $100 (Mid-Range)'
+
+# {slot: (product types that fill it, flags the slot never takes)}; no photosensitisers in the AM serum
+KIT_SLOTS = {
+    'Cleanser': (('Cleanser',), ()),
+    'AM_Serum': (('Serum',), ('retinoid', 'exfoliant')),
+    'Moisturizer': (('Moisturizer',), ()),
+    'Sunscreen': (('Sunscreen',), ()),
+    'PM_Treatment': (('Treatment', 'Exfoliant'), ()),
+}
+KIT_CACHE_MAX_ENTRIES = 50000   # Distinct profile signatures kept (compact tuples, well under 1 KB each)
+KIT_BATCH_ROWS = 10000          # Profiles scored per matrix product in precompute()
+KIT_RATIONALE_FEATURES = 2      # Strongest matching features quoted per product
+KIT_POTENCY_SCORE_CAP = 80      # Scores from here up no longer raise the weight of potent actives
+
+def parse_allergies(text):
+    """Lower-cased allergen names from the onboarding free-text answer ('None' means no allergies)."""
+    tokens = re.split(r'[,;/]|\band\b', (text or '').lower())
+    return tuple(sorted({token.strip(' .') for token in tokens} - {'', 'none', 'n/a', 'na', 'no'}))
+
+def product_price(product):
+    return float(product['Price'].replace('$', ''))
+
+def product_feature_matrix(catalog):
+    """(products, features) matrix: targeted concern, ingredient flags and price in $100s."""
+    matrix = np.zeros((len(catalog), len(KIT_FEATURES)))
+    flag_offset = len(CONCERN_OPTIONS)
+    for row, product in enumerate(catalog):
+        if product['Concern'] in CONCERN_OPTIONS:
+            matrix[row, CONCERN_OPTIONS.index(product['Concern'])] = 1.0
+        ingredients = product['Key_Ingredients'].lower()
+        for column, keywords in enumerate(INGREDIENT_FLAGS.values()):
+            if any(re.search(r'(?<![a-z])' + re.escape(keyword), ingredients) for keyword in keywords):
+                matrix[row, flag_offset + column] = 1.0
+        matrix[row, -1] = product_price(product) / 100
+    return matrix
+
+def profile_signature(profile, score):
+    """Everything the kit depends on. Users with equal signatures share one cached kit."""
+    return (tuple(sorted(profile.get('Concerns') or [])), profile.get('Skin_Type'), profile.get('Sensitivity', 'Mild'),
+            profile.get('Goal', ''), profile.get('Budget') or DEFAULT_BUDGET, parse_allergies(profile.get('Allergies')),
+            int(score) // 5)
+
+def profile_weight_vector(signature):
+    """Encodes a profile signature as a weight per KIT_FEATURES column."""
+    concerns, skin_type, sensitivity, goal, budget, _, score_bucket = signature
+    weights = dict.fromkeys(KIT_FEATURES, 0.0)
+    for concern in concerns:
+        weights[concern] = weights.get(concern, 0.0) + 1.0
+        for feature, weight in CONCERN_INGREDIENT_WEIGHTS.get(concern, {}).items():
+            weights[feature] += weight
+    for concern, weight in GOAL_CONCERN_WEIGHTS.get(goal, {}).items():
+        weights[concern] += weight
+    for feature, weight in SKIN_TYPE_INGREDIENT_WEIGHTS.get(skin_type, {}).items():
+        weights[feature] += weight
+    # Low scores justify stronger actives; reactive skin pays for them
+    weights['potent'] += max(0, KIT_POTENCY_SCORE_CAP - score_bucket * 5) / 50 - SENSITIVITY_POTENCY_PENALTY.get(sensitivity, 0.2)
+    weights['soothing'] += SENSITIVITY_POTENCY_PENALTY.get(sensitivity, 0.2) / 2
+    weights['price'] = -BUDGET_BANDS.get(budget, BUDGET_BANDS[DEFAULT_BUDGET])[1]
+    return np.array([weights[feature] for feature in KIT_FEATURES])
+
+class KitRecommender:
+    """Scores the whole catalog for many profiles with one matrix product, then fills each kit slot.
+
+    Hard constraints (slot type and excluded flags, allergies, price cap) mask the score
+    matrix before the per-slot argmax. A slot with nothing in budget falls back to the best
+    allergy-safe product and is marked over budget. Kits are cached per profile signature.
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.features = product_feature_matrix(catalog)
+        self.prices = np.array([product_price(product) for product in catalog])
+        self.searchable = [f"{product['Name']} {product['Key_Ingredients']}".lower() for product in catalog]
+        flag_offset = len(CONCERN_OPTIONS)
+        flag_columns = {flag: flag_offset + i for i, flag in enumerate(INGREDIENT_FLAGS)}
+        self.slot_masks = {
+            slot: np.array([product['Type'] in types for product in catalog])
+                  & ~self.features[:, [flag_columns[flag] for flag in excluded]].any(axis=1)
+            for slot, (types, excluded) in KIT_SLOTS.items()
+        }
+        self.entries = OrderedDict()   # {signature: compact kit}, least recently used first
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+        self.last_batch = None
+
+    def _allergy_mask(self, allergies):
+        return np.array([not any(allergen in text for allergen in allergies) for text in self.searchable])
+
+    @staticmethod
+    def _rationale(columns):
+        labels = [f"targets {KIT_FEATURES[column].split('(')[0].strip()}" if column < len(CONCERN_OPTIONS)
+                  else f"{KIT_FEATURES[column].replace('_', '-')} ingredients" for column in columns]
+        return f"Chosen for your profile: {'; '.join(labels)}." if labels else "Best available fit for your profile."
+
+    def _score_arrays(self, signatures):
+        """Kits for a batch of signatures: (products x features) @ (features x profiles).
+
+        Returns (choice, over_budget, reasons), one row per signature and one column per slot:
+        the product row (-1 = nothing allowed), whether it breaks the price cap, and up to
+        KIT_RATIONALE_FEATURES feature columns explaining the pick (-1 padded).
+        """
+        weights = np.stack([profile_weight_vector(signature) for signature in signatures])
+        # Rounded so exact ties break on catalog order however BLAS blocks the product
+        scores = np.round(self.features @ weights.T, 9)
+        caps = np.array([BUDGET_BANDS.get(signature[4], BUDGET_BANDS[DEFAULT_BUDGET])[0] for signature in signatures])
+        in_budget = self.prices[:, None] <= caps[None, :]
+        allergy_masks = {allergies: self._allergy_mask(allergies) for allergies in {signature[5] for signature in signatures}}
+        safe = np.stack([allergy_masks[signature[5]] for signature in signatures], axis=1)
+
+        choices = np.full((len(signatures), len(KIT_SLOTS)), -1, dtype=np.int16)
+        over_budget = np.zeros((len(signatures), len(KIT_SLOTS)), dtype=bool)
+        reasons = np.full((len(signatures), len(KIT_SLOTS), KIT_RATIONALE_FEATURES), -1, dtype=np.int16)
+        for slot_column, slot_mask in enumerate(self.slot_masks.values()):
+            allowed = safe & slot_mask[:, None]
+            strict = np.where(allowed & in_budget, scores, -np.inf)
+            relaxed = np.where(allowed, scores, -np.inf)
+            has_strict = np.isfinite(strict.max(axis=0))
+            has_any = np.isfinite(relaxed.max(axis=0))
+            choice = np.where(has_strict, strict.argmax(axis=0), relaxed.argmax(axis=0))
+            # The strongest positive feature contributions explain each pick
+            contributions = self.features[choice] * weights
+            top = np.argsort(-contributions, axis=1)[:, :KIT_RATIONALE_FEATURES]
+            positive = np.take_along_axis(contributions, top, axis=1) > 0
+            choices[:, slot_column] = np.where(has_any, choice, -1)
+            over_budget[:, slot_column] = has_any & ~has_strict
+            reasons[:, slot_column, :top.shape[1]] = np.where(positive & has_any[:, None], top, -1)
+        return choices, over_budget, reasons
+
+    @staticmethod
+    def compact(choices, over_budget, reasons):
+        """One profile's kit row as ((slot, product row, over budget, rationale features), ...)."""
+        return tuple((slot, int(row), bool(over), tuple(int(feature) for feature in features if feature >= 0))
+                     for slot, row, over, features in zip(KIT_SLOTS, choices, over_budget, reasons) if row >= 0)
+
+    def _score(self, signatures):
+        """Compact kits for a batch of signatures (see compact())."""
+        choices, over_budget, reasons = self._score_arrays(signatures)
+        return [self.compact(choices[i], over_budget[i], reasons[i]) for i in range(len(signatures))]
+
+    def materialize(self, kit):
+        items = []
+        for slot, row, over_budget, reasons in kit:
+            product = self.catalog[row]
+            items.append({'slot': slot, 'name': product['Name'], 'price': product['Price'],
+                          'ingredients': product['Key_Ingredients'], 'over_budget': over_budget,
+                          'rationale': self._rationale(reasons)})
+        return items
+
+    def _store(self, signatures, kits):
+        with self.lock:
+            for signature, kit in zip(signatures, kits):
+                self.entries[signature] = kit
+                self.entries.move_to_end(signature)
+            while len(self.entries) > KIT_CACHE_MAX_ENTRIES:
+                self.entries.popitem(last=False)
+
+    def recommend(self, profile, score):
+        """The kit for one profile, from the signature cache when possible."""
+        signature = profile_signature(profile, score)
+        with self.lock:
+            kit = self.entries.get(signature)
+            if kit is not None:
+                self.entries.move_to_end(signature)
+                self.hits += 1
+                return self.materialize(kit)
+            self.misses += 1
+        kit = self._score([signature])[0]
+        self._store([signature], [kit])
+        return self.materialize(kit)
+
+    def precompute(self, user_db):
+        """Scores every onboarded user's distinct signature, KIT_BATCH_ROWS per matrix product."""
+        started = time.monotonic()
+        signatures = list(dict.fromkeys(
+            profile_signature(record, record.get('Skin Score', 0))
+            for record in user_db.values() if record.get('Concerns')))
+        for start in range(0, len(signatures), KIT_BATCH_ROWS):
+            batch = signatures[start:start + KIT_BATCH_ROWS]
+            self._store(batch, self._score(batch))
+        self.last_batch = {'signatures': len(signatures), 'seconds': time.monotonic() - started,
+                           'finished_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+        return self.last_batch
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries), 'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'last_batch': self.last_batch}
+
+@st.cache_resource(max_entries=1)
+def get_kit_recommender(rules_hash):
+    """One recommender per rules version (see kit_rules_hash())."""
+    return KitRecommender(PRODUCT_CATALOG)
+
+
+# Segment table: every kit in the onboarding answer space, precomputed (see KitSegmentTable)
+KIT_TABLE_DIR = os.path.join(os.environ.get(DATA_DIR_ENV) or tempfile.gettempdir(), 'skinova-kit-tables')
+KIT_MAX_CONCERNS = 4            # Onboarding allows up to four concerns
+KIT_SCORE_BANDS = KIT_POTENCY_SCORE_CAP // 5 + 1   # 5-point bands; 80+ is one band (identical kits)
+
+def kit_rules_hash():
+    """Fingerprint of everything a kit depends on: catalog, weight tables, slots and the scoring code.
+
+    Any edit gives a new hash, and with it a new segment table. All of it lives in this file, so the
+    digest is computed once per script version rather than on every render."""
+    return compute_kit_rules_hash(os.stat(__file__).st_mtime_ns)
+
+@st.cache_resource(max_entries=1)
+def compute_kit_rules_hash(script_version):
+    rules = [PRODUCT_CATALOG, INGREDIENT_FLAGS, CONCERN_OPTIONS, SKIN_TYPE_OPTIONS, GOAL_CONCERN_WEIGHTS,
+             CONCERN_INGREDIENT_WEIGHTS, SKIN_TYPE_INGREDIENT_WEIGHTS, SENSITIVITY_POTENCY_PENALTY, BUDGET_BANDS,
+             KIT_SLOTS, KIT_RATIONALE_FEATURES, KIT_POTENCY_SCORE_CAP]
+    digest = hashlib.sha1(json.dumps(rules, default=str).encode())
+    methods = [getattr(member, '__func__', member) for member in vars(KitRecommender).values()]
+    for code in [profile_weight_vector, product_feature_matrix] + [m for m in methods if inspect.isfunction(m)]:
+        digest.update(inspect.getsource(code).encode())
+    return digest.hexdigest()[:16]
+
+def kit_segment_axes():
+    """The segment space, one list per signature field (allergies excluded: they are free text)."""
+    concern_sets = [combo for size in range(1, KIT_MAX_CONCERNS + 1) for combo in combinations(sorted(CONCERN_OPTIONS), size)]
+    return (concern_sets, SKIN_TYPE_OPTIONS, list(SENSITIVITY_POTENCY_PENALTY), list(GOAL_CONCERN_WEIGHTS),
+            list(BUDGET_BANDS), list(range(KIT_SCORE_BANDS)))
+
+class KitSegmentTable:
+    """Every segment's kit, precomputed: a render is one index computation and one row read.
+
+    Segments are (concern set, skin type, sensitivity, goal, budget, score band); the row of a
+    segment is its mixed-radix position over kit_segment_axes(). Rows are filled by the
+    recommender's own batch scoring, so they match on-demand kits exactly. A row also serves
+    profiles with allergies when none of its products contain an allergen (removing other products
+    cannot change an argmax). Anything else (allergen hit, legacy answers) is scored on demand.
+    The table is saved per rules hash, so a restart loads it instead of rebuilding.
+    """
+
+    def __init__(self, recommender, rules_hash):
+        self.recommender = recommender
+        self.rules_hash = rules_hash
+        self.path = os.path.join(KIT_TABLE_DIR, f"kit-table-{rules_hash}.npz")
+        axes = kit_segment_axes()
+        self.axes = [{value: position for position, value in enumerate(axis)} for axis in axes]
+        self.segments = int(np.prod([len(axis) for axis in axes]))
+        self.choices = self.over_budget = self.reasons = None
+        self.building = False
+        self.build_seconds = None
+        self.hits = self.fallbacks = 0
+        self.lock = threading.Lock()
+        try:
+            with np.load(self.path) as saved:
+                self.choices, self.over_budget, self.reasons = saved['choices'], saved['over_budget'], saved['reasons']
+        except (OSError, KeyError, ValueError):
+            pass
+
+    @property
+    def ready(self):
+        return self.choices is not None
+
+    def row(self, signature):
+        """Mixed-radix row of a signature, or None when it lies outside the segment space."""
+        concerns, skin_type, sensitivity, goal, budget, _, score_bucket = signature
+        if score_bucket < 0:
+            return None
+        row = 0
+        for axis, value in zip(self.axes, (concerns, skin_type, sensitivity, goal, budget,
+                                           min(score_bucket, KIT_SCORE_BANDS - 1))):
+            position = axis.get(value)
+            if position is None:
+                return None
+            row = row * len(axis) + position
+        return row
+
+    def lookup(self, signature):
+        """The compact kit for a signature, or None when it has to be scored on demand."""
+        row = self.row(signature) if self.ready else None
+        kit = None
+        if row is not None:
+            kit = self.recommender.compact(self.choices[row], self.over_budget[row], self.reasons[row])
+            allergies = signature[5]
+            if allergies and any(allergen in self.recommender.searchable[product_row]
+                                 for _, product_row, _, _ in kit for allergen in allergies):
+                kit = None
+        with self.lock:
+            if kit is None:
+                self.fallbacks += 1
+            else:
+                self.hits += 1
+        return kit
+
+    def build(self):
+        """Scores the whole segment space, KIT_BATCH_ROWS per matrix product, then saves it."""
+        started = time.monotonic()
+        concern_sets, skin_types, sensitivities, goals, budgets, bands = kit_segment_axes()
+        signatures = ((concerns, skin_type, sensitivity, goal, budget, (), band)
+                      for concerns in concern_sets for skin_type in skin_types for sensitivity in sensitivities
+                      for goal in goals for budget in budgets for band in bands)
+        choices = np.empty((self.segments, len(KIT_SLOTS)), dtype=np.int16)
+        over_budget = np.empty((self.segments, len(KIT_SLOTS)), dtype=bool)
+        reasons = np.empty((self.segments, len(KIT_SLOTS), KIT_RATIONALE_FEATURES), dtype=np.int16)
+        for start in range(0, self.segments, KIT_BATCH_ROWS):
+            batch = list(islice(signatures, KIT_BATCH_ROWS))
+            end = start + len(batch)
+            choices[start:end], over_budget[start:end], reasons[start:end] = self.recommender._score_arrays(batch)
+
+        os.makedirs(KIT_TABLE_DIR, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=KIT_TABLE_DIR, suffix='.tmp', delete=False) as tmp:
+            np.savez(tmp, choices=choices, over_budget=over_budget, reasons=reasons)
+        os.replace(tmp.name, self.path)
+        for entry in os.listdir(KIT_TABLE_DIR):
+            # Tables of older rules can never be served again
+            if entry.startswith('kit-table-') and entry != os.path.basename(self.path):
+                os.remove(os.path.join(KIT_TABLE_DIR, entry))
+        with self.lock:
+            self.choices, self.over_budget, self.reasons = choices, over_budget, reasons
+            self.build_seconds = time.monotonic() - started
+
+    def ensure_built(self):
+        """Starts a background build once; lookups fall back to on-demand scoring until it lands."""
+        with self.lock:
+            if self.ready or self.building:
+                return
+            self.building = True
+
+        def run():
+            try:
+                self.build()
+            finally:
+                self.building = False
+        threading.Thread(target=run, daemon=True).start()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.fallbacks
+            return {'segments': self.segments, 'ready': self.ready, 'building': self.building,
+                    'build_seconds': self.build_seconds, 'hit_rate': self.hits / lookups if lookups else 0.0}
+
+@st.cache_resource(max_entries=1)
+def get_kit_segment_table(rules_hash):
+    table = KitSegmentTable(get_kit_recommender(rules_hash), rules_hash)
+    table.ensure_built()
+    return table
+
+def recommend_kit(profile, score):
+    """The kit for a profile: a segment-table row when possible, otherwise scored on demand."""
+    rules_hash = kit_rules_hash()
+    recommender = get_kit_recommender(rules_hash)
+    kit = get_kit_segment_table(rules_hash).lookup(profile_signature(profile, score))
+    return recommender.materialize(kit) if kit is not None else recommender.recommend(profile, score)
+
+
+# --- 3.15 REGIONAL SCAN (Tiled, Thread-Parallel Image Analysis) ---
+
+TILE_SIZE = 512                 # Tile edge in pixels; bounds the float working set per worker
+TILE_OVERLAP = 64               # Pixels shared by neighbouring tiles so features on a seam are seen whole
+TILE_WORKERS = min(4, os.cpu_count() or 1)
+TILE_MIN_SKIN_FRACTION = 0.2    # Tiles with less skin than this (background, hair) are left out
+RASTER_BAND_ROWS = 256          # Rows copied from the decoder into the disk raster per step
+RASTER_MAX_SIDE = 6000          # JPEGs larger than this are DCT-downscaled while decoding
+TILE_METRICS = ('Redness', 'Shine (Oil)', 'Texture', 'Dark Spots', 'Red Spots')
+
+def face_region(cx, cy):
+    """Face zone of a point given as fractions of image width/height (the photo is assumed face-centred)."""
+    if cy < 0.33:
+        return 'Forehead'
+    if cy > 0.75:
+        return 'Chin & Jawline'
+    if cx < 0.35:
+        return 'Left Cheek'
+    if cx > 0.65:
+        return 'Right Cheek'
+    return 'Nose (T-Zone)'
+
+@contextmanager
+def decoded_raster(upload, display_size=(800, 800)):
+    """Decodes a spilled upload into a disk-backed (H, W, 3) uint8 memmap and yields (raster, display image).
+
+    The decoder output is copied band by band and released before any analysis runs, so
+    the analysis only keeps the pages of the tiles in flight resident. The file is removed on exit.
+    """
+    raster_dir = os.path.join(SESSION_SPILL_DIR, 'rasters')
+    os.makedirs(raster_dir, exist_ok=True)
+    with open_spilled(upload) as image_bytes:
+        image = Image.open(image_bytes)
+        image.draft('RGB', (RASTER_MAX_SIDE, RASTER_MAX_SIDE))
+        image.load()
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+    width, height = image.size
+    fd, path = tempfile.mkstemp(dir=raster_dir, prefix='raster-', suffix='.u8')
+    os.close(fd)
+    raster = None
+    try:
+        raster = np.memmap(path, dtype=np.uint8, mode='w+', shape=(height, width, 3))
+        for top in range(0, height, RASTER_BAND_ROWS):
+            bottom = min(top + RASTER_BAND_ROWS, height)
+            raster[top:bottom] = np.asarray(image.crop((0, top, width, bottom)))
+        raster.flush()
+        image.thumbnail(display_size)
+        yield raster, image
+    finally:
+        del raster
+        os.remove(path)
+
+def tile_starts(length, tile, stride):
+    """Window offsets along one axis; the last window is pinned to the edge so no pixels are skipped."""
+    starts = list(range(0, max(length - tile, 0) + 1, stride))
+    if starts[-1] != length - tile:
+        starts.append(length - tile)
+    return starts
+
+def tile_metrics(tile):
+    """TILE_METRICS for one (3, T, T) uint8 tile, over skin pixels only. Returns (metrics, skin fraction)."""
+    r, g, b = (channel.astype(np.float32) / 255 for channel in tile)
+    skin = (r > g) & (g > b) & (r > 0.25)
+    skin_fraction = float(skin.mean())
+    if skin_fraction < TILE_MIN_SKIN_FRACTION:
+        return np.full(len(TILE_METRICS), np.nan), skin_fraction
+    luminance = 0.299 * r + 0.587 * g + 0.114 * b
+    brightest, darkest = np.maximum(np.maximum(r, g), b), np.minimum(np.minimum(r, g), b)
+    laplacian = np.zeros_like(luminance)
+    laplacian[1:-1, 1:-1] = np.abs(4 * luminance[1:-1, 1:-1] - luminance[:-2, 1:-1] - luminance[2:, 1:-1]
+                                   - luminance[1:-1, :-2] - luminance[1:-1, 2:])
+    skin_luminance = luminance[skin].mean()
+    metrics = np.array([
+        min(1.0, 2 * float(np.clip(r - (g + b) / 2, 0, None)[skin].mean())),
+        float(((brightest > 0.85) & (brightest - darkest < 0.12))[skin].mean()),
+        min(1.0, 10 * float(laplacian[skin].mean())),
+        float((luminance < 0.75 * skin_luminance)[skin].mean()),
+        float(((r - g) > 0.2)[skin].mean()),
+    ])
+    return metrics, skin_fraction
+
+@st.cache_resource
+def get_tile_executor():
+    """Process-wide worker pool for tile analysis. NumPy releases the GIL, so tiles run truly in parallel."""
+    return ThreadPoolExecutor(max_workers=TILE_WORKERS, thread_name_prefix='skinova-tiles')
+
+def analyze_regions(raster, tile=TILE_SIZE, overlap=TILE_OVERLAP, on_progress=None):
+    """Splits an (H, W, 3) raster into overlapping tiles and scores them on the tile pool.
+
+    Tiles are windows of a sliding_window_view over the raster (no copies). on_progress
+    is called as on_progress(fraction, grid, skin) with the partial grid after every tile.
+    Returns a dict with the per-tile 'grid' (rows, cols, metrics), the 'regions' averages,
+    tile geometry and timing.
+    """
+    started = time.monotonic()
+    height, width = raster.shape[:2]
+    tile = min(tile, height, width)
+    stride = max(1, tile - overlap)
+    windows = np.lib.stride_tricks.sliding_window_view(raster, (tile, tile), axis=(0, 1))
+    rows, cols = tile_starts(height, tile, stride), tile_starts(width, tile, stride)
+
+    grid = np.full((len(rows), len(cols), len(TILE_METRICS)), np.nan)
+    skin = np.zeros((len(rows), len(cols)))
+    futures = {get_tile_executor().submit(tile_metrics, windows[top, left]): (i, j)
+               for i, top in enumerate(rows) for j, left in enumerate(cols)}
+    try:
+        for done, future in enumerate(as_completed(futures), start=1):
+            i, j = futures[future]
+            grid[i, j], skin[i, j] = future.result()
+            if on_progress is not None:
+                on_progress(done / len(futures), grid, skin)
+    finally:
+        # A rerun (e.g. the user navigated away) interrupts the loop: drop the tiles not yet started
+        for future in futures:
+            future.cancel()
+
+    regions = {}
+    for i, top in enumerate(rows):
+        for j, left in enumerate(cols):
+            if not np.isnan(grid[i, j, 0]):
+                name = face_region((left + tile / 2) / width, (top + tile / 2) / height)
+                regions.setdefault(name, []).append(grid[i, j])
+    return {
+        'grid': grid,
+        'skin': skin,
+        'regions': {name: np.mean(values, axis=0) for name, values in regions.items()},
+        'tile': tile,
+        'stride': stride,
+        'tiles': len(futures),
+        'size': (width, height),
+        'seconds': time.monotonic() - started,
+    }
+
+def figure_png(fig):
+    """Renders a figure to PNG bytes (as st.pyplot would) and closes it, so the result can be kept and pickled."""
+    buffer = BytesIO()
+    fig.savefig(buffer, format='png', bbox_inches='tight', dpi=200)
+    plt.close(fig)
+    return buffer.getvalue()
+
+def image_png(image):
+    buffer = BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def region_heatmap_figure(result, image, metric):
+    """The metric's tile grid blended over the display image, as a matplotlib figure."""
+    width, height = result['size']
+    fig, ax = plt.subplots(figsize=(5, 5 * height / width))
+    ax.imshow(image, extent=(0, width, height, 0))
+    overlay = np.ma.masked_invalid(result['grid'][:, :, TILE_METRICS.index(metric)])
+    low, high = (float(overlay.min()), float(overlay.max())) if overlay.count() else (0.0, 1.0)
+    heat = ax.imshow(overlay, extent=(0, width, height, 0), cmap='inferno', alpha=0.55,
+                     vmin=low, vmax=max(high, low + 0.05), interpolation='bilinear')
+    fig.colorbar(heat, ax=ax, fraction=0.046, pad=0.04)
+    ax.set_axis_off()
+    fig.tight_layout()
+    return fig
+
+
+# --- 3.16 PROGRESSIVE SCAN (Instant Preview, Streamed Full-Resolution Refinement) ---
+
+PREVIEW_SIDE = 256              # Edge of the coarse-pass image (one tile)
+PROGRESSIVE_UPDATE_SECONDS = 0.25  # Minimum gap between in-place indicator updates during refinement
+SCAN_TIMING_SAMPLES = 500       # Recent scans kept for the latency percentiles
+
+# Metric value at which each indicator moves to its next (worse) rating
+INDICATOR_THRESHOLDS = {
+    "Acne Index (P. Acnes Activity)": (0.01, 0.04, 0.10),
+    "Pigmentation Index (Melanin Density)": (0.03, 0.08, 0.15),
+    "Wrinkle Depth (Simulated)": (0.15, 0.30, 0.50),
+    "Hydration Level (TEWL Metric)": (0.10, 0.20, 0.35),
+    "Redness/Inflammation Index": (0.50, 0.65),
+}
+
+def summarize_tiles(grid, skin):
+    """Skin-weighted mean of the finished tiles' metrics, or None while no skin tile is done."""
+    finished = ~np.isnan(grid[..., 0])
+    if not finished.any():
+        return None
+    return np.average(grid[finished], axis=0, weights=np.maximum(skin[finished], 1e-6))
+
+def scan_indicators(metrics):
+    """Maps whole-image TILE_METRICS onto the ANALYZER_INDICATORS ratings."""
+    redness, shine, texture, dark_spots, red_spots = metrics
+    values = {
+        "Acne Index (P. Acnes Activity)": red_spots,
+        "Pigmentation Index (Melanin Density)": dark_spots,
+        "Wrinkle Depth (Simulated)": texture,
+        "Hydration Level (TEWL Metric)": texture * (1 - shine),   # Rough and matte reads as dehydrated
+        "Redness/Inflammation Index": redness,
+    }
+    return {name: ANALYZER_INDICATORS[name][int(np.searchsorted(INDICATOR_THRESHOLDS[name], value, side='right'))]
+            for name, value in values.items()}
+
+def indicator_cards(results):
+    """Card rows for the indicator grid, colour-coded by rating."""
+    cards = []
+    for key, value in results.items():
+        # Simple color logic based on the rating word
+        color = "#4CAF50" if value.startswith(("Low", "Minimal", "Optimal", "Good")) else ("#FFC300" if value.startswith(("Mild", "Moderate", "Fair", "Localized")) else "#FF4B4B")
+        cards.append({'label': key.split('(')[0].strip(), 'value': value, 'color': color})
+    return cards
+
+def preview_scan(upload, display_size=(640, 640)):
+    """Coarse pass: decodes a display-sized image (JPEGs decode at reduced DCT scale) and scores it as one tile.
+
+    Returns (display image, metrics or None).
+    """
+    with open_spilled(upload) as image_bytes:
+        image = Image.open(image_bytes)
+        # draft() keeps both sides at least as large as requested, so ask for the fitted size
+        scale = min(display_size[0] / image.width, display_size[1] / image.height, 1.0)
+        image.draft('RGB', (max(1, int(image.width * scale)), max(1, int(image.height * scale))))
+        image = image.convert('RGB')
+    image.thumbnail(display_size)
+    coarse = image.copy()
+    coarse.thumbnail((PREVIEW_SIDE, PREVIEW_SIDE))
+    metrics, _ = tile_metrics(np.moveaxis(np.asarray(coarse), -1, 0))
+    return image, (None if np.isnan(metrics[0]) else metrics)
+
+class ScanTimings:
+    """Rolling latency samples of progressive scans: time to the first (preview) and to the final result."""
+
+    def __init__(self, maxlen=SCAN_TIMING_SAMPLES):
+        self.samples = deque(maxlen=maxlen)   # (first_seconds, final_seconds)
+        self.lock = threading.Lock()
+
+    def record(self, first_seconds, final_seconds):
+        with self.lock:
+            self.samples.append((first_seconds, final_seconds))
+
+    def stats(self):
+        with self.lock:
+            samples = np.array(self.samples, dtype=float).reshape(-1, 2)
+        if not len(samples):
+            return {'scans': 0}
+        first_p50, final_p50 = np.percentile(samples, 50, axis=0)
+        first_p95, final_p95 = np.percentile(samples, 95, axis=0)
+        return {'scans': len(samples), 'first_p50': first_p50, 'first_p95': first_p95,
+                'final_p50': final_p50, 'final_p95': final_p95}
+
+@st.cache_resource
+def get_scan_timings():
+    return ScanTimings()
+
+
+# --- 3.17 SCAN HISTORY (Longitudinal Before/After Comparison) ---
+
+SCAN_VECTOR_DECIMALS = 4        # Stored precision of scan vectors (the JSON stays compact)
+SCAN_SAME_PHOTO_BITS = 6        # dHash bits that may differ for two scans to count as the same photo
+
+def thumbnail_hash(image):
+    """64-bit difference hash of a PIL image as 16 hex digits (robust to re-encoding and resizing)."""
+    pixels = np.asarray(image.convert('L').resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return f"{int(''.join('1' if bit else '0' for bit in bits), 2):016x}"
+
+def scan_history_entry(results, metrics, vector, image, risk_score, mode):
+    """Everything a later comparison needs, so old photos never have to be decoded again."""
+    return {
+        'at': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'hash': thumbnail_hash(image),
+        'mode': mode,
+        'levels': [options.index(results[name]) for name, options in ANALYZER_INDICATORS.items()],
+        'metrics': None if metrics is None else [round(float(value), SCAN_VECTOR_DECIMALS) for value in metrics],
+        'vector': [round(float(value), SCAN_VECTOR_DECIMALS) for value in vector],
+        'risk': risk_score,
+    }
+
+def record_scan(email, entry):
+    """Appends a scan to the user's history (one journal event, never a rewrite of the list)."""
+    get_data_store().add_scan(email, entry)
+    get_profile_cache().invalidate(email, names=('scan_history',))
+
+def build_scan_history(scans):
+    """Columnar arrays over a user's scans: one row per scan, oldest first."""
+    metric_rows = [scan['metrics'] if scan.get('metrics') is not None else [np.nan] * len(TILE_METRICS) for scan in scans]
+    return {
+        'at': [scan['at'] for scan in scans],
+        'hash': [scan['hash'] for scan in scans],
+        'mode': [scan.get('mode', '') for scan in scans],
+        'levels': np.array([scan['levels'] for scan in scans], dtype=np.int8).reshape(len(scans), len(ANALYZER_INDICATORS)),
+        'metrics': np.array(metric_rows, dtype=np.float32).reshape(len(scans), len(TILE_METRICS)),
+        'vectors': np.array([scan['vector'] for scan in scans], dtype=np.float32).reshape(len(scans), TWIN_DIM),
+        'risk': np.array([scan.get('risk', 0) for scan in scans], dtype=np.int16),
+    }
+
+def get_scan_history(email):
+    """The user's scan history as cached columnar arrays (rebuilt only after a new scan)."""
+    return get_profile_cache().get_or_load(
+        email, 'scan_history', lambda: build_scan_history(get_user_data(email).get('Scan_History', [])))
+
+def hash_distance(first, second):
+    return bin(int(first, 16) ^ int(second, 16)).count('1')
+
+
+# --- 3.18 SESSION RECORDER (Real Interaction Traces as Performance Tests, see 0. for the format) ---
+
+TRACE_FREE_TEXT_TYPES = ('string_value', 'string_trigger_value')  # text_input / text_area / chat_input values
+TRACE_EMAIL_PATTERN = re.compile(r'[^@\s]+@[^@\s]+\.[^@\s]+')
+
+# The recorder reads widget values through private runtime APIs. They are only touched while
+# recording, so an unset SKINOVA_RECORD_DIR never depends on them; a Streamlit version without
+# them switches recording off (with a warning) rather than breaking the app.
+
+@st.cache_resource
+def _session_recorder_status():
+    """Process-wide: 'disabled' is set once the recorder finds its private runtime APIs missing."""
+    return {'disabled': False}
+
+# Unset (or unsupported): nothing is recorded and nothing is paid for
+SESSION_RECORD_DIR = None if _session_recorder_status()['disabled'] else os.environ.get(RECORD_DIR_ENV)
+
+def _widget_state():
+    """(widget values by id, widget metadata by id) of the running session, or None when this
+    Streamlit version no longer has them (recording is then switched off for the process)."""
+    try:
+        from streamlit.runtime.state import get_session_state
+        state = get_session_state()._state
+        return state, state._new_widget_state.widget_metadata
+    except (ImportError, AttributeError) as exc:
+        status = _session_recorder_status()
+        if not status['disabled']:
+            status['disabled'] = True
+            LOGGER.warning("Session recording disabled: Streamlit %s lacks the widget state it reads (%s)",
+                           st.__version__, exc)
+        return None
+
+def redact_trace_text(text, salt):
+    """Free text never reaches a trace. An email becomes a pseudonym that is stable within the session
+    (so a replayed signup and the later login still agree); any other text becomes a placeholder."""
+    if not isinstance(text, str) or not text.strip():
+        return text
+    digest = hmac.new(salt, text.strip().lower().encode('utf-8'), 'sha256').hexdigest()[:12]
+    if TRACE_EMAIL_PATTERN.fullmatch(text.strip()):
+        return f"user-{digest}@redacted.invalid"
+    return f"redacted-{digest}"
+
+def traced_widget_value(state, metadata, widget_id, salt):
+    value = trace_value(state[widget_id])
+    if getattr(metadata.get(widget_id), 'value_type', None) in TRACE_FREE_TEXT_TYPES:
+        value = redact_trace_text(value, salt)
+    return value
+
+def is_fragment_rerun():
+    ctx = get_script_run_ctx()
+    return ctx is not None and bool(getattr(ctx, 'fragment_ids_this_run', None))
+
+def open_session_step():
+    """Start of a run: the widgets whose value changed since the previous run, i.e. the interaction that
+    triggered it. Read before anything renders, while the widgets of the previous run still hold the
+    values the browser sent (a login button is gone again once the run has navigated away).
+
+    Widgets are identified by Streamlit's widget id, which is derived from the widget's type, label,
+    parameters and key, so the same widget gets the same id in a later headless replay.
+    Returns None when recording is unsupported.
+    """
+    widget_state = _widget_state()
+    if widget_state is None:
+        return None
+    state, metadata = widget_state
+    trace = st.session_state.get('session_trace')
+    if trace is None:
+        ctx = get_script_run_ctx()
+        opened = datetime.now()
+        session_tag = re.sub(r'\W', '', ctx.session_id)[:8] if ctx is not None else 'bare'
+        trace = {'path': os.path.join(SESSION_RECORD_DIR, f"session-{opened:%Y%m%d-%H%M%S}-{session_tag}.ndjson"),
+                 'last': {}, 'clock': time.monotonic(), 'step': 0, 'salt': os.urandom(16)}
+        os.makedirs(SESSION_RECORD_DIR, exist_ok=True)
+        with open(trace['path'], 'a', encoding='utf-8') as trace_file:
+            trace_file.write(json.dumps({'kind': 'session', 'opened': opened.isoformat(timespec='seconds')}) + "\n")
+        st.session_state.session_trace = trace
+
+    changes = {}
+    for widget_id, last_value in trace['last'].items():
+        try:
+            value = traced_widget_value(state, metadata, widget_id, trace['salt'])
+        except KeyError:
+            continue
+        # A button that was pressed reads False again on the next run; that reset is not an interaction
+        is_trigger = getattr(metadata.get(widget_id), 'value_type', None) in ('trigger_value', 'string_trigger_value')
+        if value != last_value and not (is_trigger and not value):
+            changes[widget_id] = value
+    return changes
+
+def close_session_step(started, changes):
+    """End of a run: appends the step (interaction, latency, state digest) to the session trace."""
+    ctx = get_script_run_ctx()
+    trace = st.session_state.get('session_trace')
+    widget_state = _widget_state() if ctx is not None and trace is not None else None
+    if widget_state is None:
+        return
+    state, metadata = widget_state
+    values = {}
+    for widget_id in getattr(ctx, 'widget_ids_this_run', ()):
+        try:
+            values[widget_id] = traced_widget_value(state, metadata, widget_id, trace['salt'])
+        except KeyError:
+            continue
+
+    fragment_run = is_fragment_rerun()
+    now = time.monotonic()
+    step = {'kind': 'step', 'n': trace['step'], 'dt': round(now - trace['clock'], 3),
+            'scope': 'fragment' if fragment_run else 'full', 'page': st.session_state.get('current_page'),
+            'ms': round((time.perf_counter() - started) * 1000, 1), 'changes': changes,
+            'state': trace_state(st.session_state, redact=lambda text: redact_trace_text(text, trace['salt']))}
+    with open(trace['path'], 'a', encoding='utf-8') as trace_file:
+        trace_file.write(json.dumps(step, separators=(',', ':')) + "\n")
+
+    # A fragment rerun only renders its own widgets; everything else keeps its last value
+    trace['last'] = {**trace['last'], **values} if fragment_run else values
+    trace['clock'] = now
+    trace['step'] += 1
+
+
+# --- 3.19 ACADEMY CONTENT STORE (Versioned Content Files, Render Cache) ---
+
+ACADEMY_DIR_ENV = 'SKINOVA_ACADEMY_DIR'
+ACADEMY_DIR = os.environ.get(ACADEMY_DIR_ENV) or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'academy')
+ACADEMY_FILES = {'articles': 'articles.json', 'videos': 'videos.json', 'quiz': 'quiz.json'}
+ACADEMY_DIFFICULTIES = ('Beginner', 'Intermediate', 'Advanced')
+ACADEMY_REQUIRED_FIELDS = {
+    'articles': ('id', 'title', 'topic', 'difficulty', 'body'),
+    'videos': ('id', 'title', 'topic', 'difficulty', 'url', 'summary'),
+    'quiz': ('id', 'quiz', 'topic', 'difficulty', 'question', 'options', 'answer'),
+}
+ACADEMY_ARTICLES_PER_PAGE = 10
+ACADEMY_RENDER_CACHE_ENTRIES = 256    # Rendered article pages kept per content version
+
+def academy_content_signature():
+    """(file, mtime, size) of every content file: three stats per rerun, and an edit is picked up live."""
+    signature = []
+    for file_name in ACADEMY_FILES.values():
+        path = os.path.join(ACADEMY_DIR, file_name)
+        try:
+            stat = os.stat(path)
+            signature.append((file_name, stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            signature.append((file_name, None, None))
+    return tuple(signature)
+
+def load_academy_file(kind):
+    """Returns (version, items) of one content file; malformed content fails loudly with its location."""
+    path = os.path.join(ACADEMY_DIR, ACADEMY_FILES[kind])
+    with open(path, encoding='utf-8') as content_file:
+        document = json.load(content_file)
+    items = document.get('questions' if kind == 'quiz' else kind, [])
+    for position, item in enumerate(items):
+        missing = [field for field in ACADEMY_REQUIRED_FIELDS[kind] if field not in item]
+        if missing:
+            raise ValueError(f"{path}: entry {position} is missing {', '.join(missing)}")
+        if item['difficulty'] not in ACADEMY_DIFFICULTIES:
+            raise ValueError(f"{path}: entry {position} has unknown difficulty '{item['difficulty']}'")
+        if kind == 'quiz' and item['answer'] not in item['options']:
+            raise ValueError(f"{path}: entry {position} has an answer that is not one of its options")
+    return document.get('version', 0), items
+
+class AcademyStore:
+    """Academy content of one version, indexed by (topic, difficulty), with rendered markdown cached."""
+
+    def __init__(self):
+        versions = {}
+        self.articles, self.videos, self.questions = [], [], []
+        for kind, target in (('articles', self.articles), ('videos', self.videos), ('quiz', self.questions)):
+            versions[kind], items = load_academy_file(kind)
+            target.extend(items)
+        self.version = ".".join(f"{kind[0]}{versions[kind]}" for kind in ACADEMY_FILES)
+        self.topics = sorted({item['topic'] for item in self.articles + self.videos + self.questions})
+
+        # {(topic, difficulty): [article position, ...]} in file order
+        self.article_index = {}
+        for position, article in enumerate(self.articles):
+            self.article_index.setdefault((article['topic'], article['difficulty']), []).append(position)
+        self.quizzes = {}
+        for question in self.questions:
+            self.quizzes.setdefault(question['quiz'], []).append(question)
+
+        self.rendered = OrderedDict()   # {(version, article positions): markdown}
+        self.lock = threading.Lock()
+
+    def find_articles(self, topic=None, difficulty=None):
+        """Article positions for a topic/difficulty filter (None = any), read straight off the index."""
+        return sorted(position for (article_topic, article_difficulty), positions in self.article_index.items()
+                      if topic in (None, article_topic) and difficulty in (None, article_difficulty)
+                      for position in positions)
+
+    def render_articles(self, positions):
+        """One markdown block for a page of articles, rendered once per content version."""
+        key = (self.version, tuple(positions))
+        with self.lock:
+            if key in self.rendered:
+                self.rendered.move_to_end(key)
+                return self.rendered[key]
+        blocks = []
+        for position in positions:
+            article = self.articles[position]
+            body = "\n".join(line.strip() for line in article['body'].splitlines())
+            blocks.append(f"### {article['title']}\n*{article['topic']} · {article['difficulty']}*\n\n{body}")
+        markdown = "\n\n---\n\n".join(blocks)
+        with self.lock:
+            self.rendered[key] = markdown
+            while len(self.rendered) > ACADEMY_RENDER_CACHE_ENTRIES:
+                self.rendered.popitem(last=False)
+        return markdown
+
+@st.cache_resource(max_entries=2)
+def get_academy_store(signature):
+    """Content is loaded once per process and again only when a content file changes."""
+    return AcademyStore()
+
+class QuizCounters:
+    """Aggregate quiz outcomes for the process: per question attempts/correct, per quiz submissions/perfect.
+
+    Keyed by question id, so counts survive a content reload for questions that did not change.
+    """
+
+    def __init__(self):
+        self.questions = {}   # {question id: [attempts, correct]}
+        self.quizzes = {}     # {quiz: [submissions, perfect]}
+        self.lock = threading.Lock()
+
+    def record(self, quiz, outcomes):
+        """outcomes: [(question id, answered correctly), ...] of one submission."""
+        with self.lock:
+            for question_id, correct in outcomes:
+                counts = self.questions.setdefault(question_id, [0, 0])
+                counts[0] += 1
+                counts[1] += bool(correct)
+            totals = self.quizzes.setdefault(quiz, [0, 0])
+            totals[0] += 1
+            totals[1] += all(correct for _, correct in outcomes)
+
+    def correct_rate(self, question_id):
+        with self.lock:
+            attempts, correct = self.questions.get(question_id, (0, 0))
+        return correct / attempts if attempts else None
+
+    def stats(self, quiz):
+        with self.lock:
+            submissions, perfect = self.quizzes.get(quiz, (0, 0))
+        return {'submissions': submissions, 'perfect_rate': perfect / submissions if submissions else 0.0}
+
+@st.cache_resource
+def get_quiz_counters():
+    return QuizCounters()
+
+
+# --- 3.20 CONSULT ADMIN INDEX (Columnar Consult Queue for Experts) ---
+
+EXPERT_EMAILS_ENV = 'SKINOVA_EXPERT_EMAILS'
+EXPERT_EMAILS = {email.strip().lower() for email in os.environ.get(EXPERT_EMAILS_ENV, '').split(',') if email.strip()}
+CONSULT_TYPES = ['Routine Review & Optimization (30 min)', 'Advanced Acne Management (45 min)',
+                 'Deep Anti-Aging Strategies (60 min)', 'Product Allergy & Patch Test Guidance (30 min)']
+CONSULT_STATUSES = ('Pending Review', 'Confirmed', 'Completed', 'Declined', 'Cancelled')
+# Allowed moves; Completed, Declined and Cancelled are final
+CONSULT_STATUS_TRANSITIONS = {
+    'Pending Review': ('Confirmed', 'Declined', 'Cancelled'),
+    'Confirmed': ('Completed', 'Cancelled'),
+}
+CONSULT_PAGE_SIZE = 50
+CONSULT_INDEX_CHUNK = 20000     # Log rows decoded per step while the index catches up
+
+class ConsultIndex:
+    """Columnar copy of the consult log: one array slot per log position.
+
+    Consult_Type and Status are categorical codes and timestamps are int64 seconds, so a filter
+    is a few vectorized comparisons instead of a scan over dicts. The log is append-only, so
+    sync() only decodes new rows, and status changes are applied in place. Rows normally arrive
+    in time order; the timestamp order is kept as the identity until an import breaks it, and a
+    date window is a binary search over it.
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.types = list(CONSULT_TYPES)            # Category labels; codes index into these lists
+        self.statuses = list(CONSULT_STATUSES)
+        self.type_codes = np.zeros(0, dtype=np.int16)
+        self.status_codes = np.zeros(0, dtype=np.int8)
+        self.timestamps = np.zeros(0, dtype=np.int64)
+        self.attachments = np.zeros(0, dtype=bool)  # Whether the request has an Image_File on disk
+        self.order = None                           # Positions in timestamp order (None = identity)
+        self.sorted_timestamps = None
+        self.foreign_status_changes = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _code(labels, value):
+        try:
+            return labels.index(value)
+        except ValueError:
+            labels.append(value)
+            return len(labels) - 1
+
+    def _grow(self, rows):
+        if rows <= len(self.timestamps):
+            return
+        capacity = max(rows, 2 * len(self.timestamps), 1024)
+        for name in ('type_codes', 'status_codes', 'timestamps', 'attachments'):
+            column = getattr(self, name)
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:self.rows] = column[:self.rows]
+            setattr(self, name, grown)
+
+    def sync(self, store):
+        """Catches up with the store's consult log (new rows only, unless another replica rewrote statuses)."""
+        log = store.consult_requests
+        total = len(log)
+        foreign = getattr(store, 'foreign_status_changes', 0)
+        with self.lock:
+            if foreign != self.foreign_status_changes or total < self.rows:
+                self.rows, self.order, self.sorted_timestamps = 0, None, None
+                self.foreign_status_changes = foreign
+            start = self.rows
+            if total == start:
+                return
+            self._grow(total)
+            # The shared store streams from an offset; in-memory lists are sliced lazily
+            rows = log.iter_from(start) if hasattr(log, 'iter_from') else islice(log, start, None)
+            while self.rows < total:
+                chunk = list(islice(rows, min(CONSULT_INDEX_CHUNK, total - self.rows)))
+                if not chunk:
+                    break
+                end = self.rows + len(chunk)
+                self.type_codes[self.rows:end] = [self._code(self.types, consult.get('Consult_Type', '')) for consult in chunk]
+                self.status_codes[self.rows:end] = [self._code(self.statuses, consult.get('Status', CONSULT_STATUSES[0])) for consult in chunk]
+                stamps = pd.to_datetime([consult.get('Timestamp') for consult in chunk], format="%Y-%m-%d %H:%M:%S", errors='coerce')
+                self.timestamps[self.rows:end] = np.where(stamps.isna(), 0, stamps.values.astype('datetime64[s]').astype(np.int64))
+                self.attachments[self.rows:end] = [bool(consult.get('Image_File')) for consult in chunk]
+                self.rows = end
+
+            appended = self.timestamps[start:self.rows]
+            in_order = self.order is None and not (np.diff(appended) < 0).any() and (
+                start == 0 or not len(appended) or appended[0] >= self.timestamps[start - 1])
+            if in_order:
+                self.sorted_timestamps = None
+            else:
+                self.order = np.argsort(self.timestamps[:self.rows], kind='stable')
+                self.sorted_timestamps = self.timestamps[self.order]
+
+    def status_counts(self):
+        with self.lock:
+            counts = np.bincount(self.status_codes[:self.rows], minlength=len(self.statuses))
+        return dict(zip(self.statuses, counts.tolist()))
+
+    def query(self, types=(), statuses=(), since=None, until=None, newest_first=True):
+        """Log positions matching every given filter, in timestamp order. since/until are dates (inclusive)."""
+        with self.lock:
+            rows = self.rows
+            ordered = self.timestamps[:rows] if self.order is None else self.sorted_timestamps
+            # Same naive-seconds scale as the stored timestamps
+            low = np.searchsorted(ordered, np.datetime64(since, 's').astype(np.int64), 'left') if since else 0
+            high = np.searchsorted(ordered, np.datetime64(until + timedelta(days=1), 's').astype(np.int64), 'left') if until else rows
+            if self.order is None:
+                positions = np.arange(low, high)
+                type_codes, status_codes = self.type_codes[low:high], self.status_codes[low:high]
+            else:
+                positions = self.order[low:high]
+                type_codes, status_codes = self.type_codes[positions], self.status_codes[positions]
+            mask = None
+            for labels, wanted, codes in ((self.types, types, type_codes), (self.statuses, statuses, status_codes)):
+                if wanted:
+                    # One lookup per row through a per-category table (cheaper than np.isin)
+                    keep = np.isin(labels, list(wanted))[codes]
+                    mask = keep if mask is None else mask & keep
+        if mask is not None:
+            positions = positions[mask]
+        return positions[::-1] if newest_first else positions
+
+    def movable(self, positions, status):
+        """The subset of positions whose current status may move to `status`."""
+        sources = [self.statuses.index(source) for source, targets in CONSULT_STATUS_TRANSITIONS.items()
+                   if status in targets and source in self.statuses]
+        positions = np.asarray(positions, dtype=np.int64)
+        with self.lock:
+            allowed = np.zeros(len(self.statuses), dtype=bool)
+            allowed[sources] = True
+            return positions[allowed[self.status_codes[positions]]]
+
+    def set_status(self, positions, status):
+        with self.lock:
+            self.status_codes[np.asarray(positions, dtype=np.int64)] = self._code(self.statuses, status)
+
+    def with_attachments(self, positions):
+        positions = np.asarray(positions, dtype=np.int64)
+        with self.lock:
+            return positions[self.attachments[positions]]
+
+def get_consult_index():
+    """Returns the store's consult index, creating it on first use and catching it up with the log."""
+    store = get_data_store()
+    with store.lock:
+        index = getattr(store, 'consult_index', None)
+        if index is None:
+            index = ConsultIndex()
+            store.consult_index = index
+    index.sync(store)
+    return index
+
+def transition_consults(positions, status):
+    """Bulk status change. Only requests whose current status allows it move; returns (moved, skipped)."""
+    store = get_data_store()
+    index = get_consult_index()
+    with store.lock:
+        movable = index.movable(positions, status)
+        if len(movable):
+            store.set_consult_status(movable.tolist(), status)
+            index.set_status(movable, status)
+    if status not in CONSULT_STATUS_TRANSITIONS:
+        # Final status: nobody will open the request's attachment again
+        for position in index.with_attachments(movable):
+            remove_spill_file(store.consult_requests[int(position)]['Image_File'])
+    return len(movable), len(positions) - len(movable)
+
+def is_expert(email):
+    return bool(email) and email.lower() in EXPERT_EMAILS
+
+def has_expert_access():
+    """An allow-listed expert account that has also unlocked the 'expert' staff role this session."""
+    return is_expert(st.session_state.user_email) and has_staff_access('expert')
+
+
+# --- 4. PAGE NAVIGATION & AUTH (Single-Rerun State Machine) ---
+
+# Pages reachable from the sidebar once onboarding is complete
+NAV_PAGES = {
+    'Dashboard': '📊 Dashboard',
+    'My Routine': '✅ My Daily Ritual',
+    'Skin Analyzer': '🔬 Hyper-Analyzer',
+    'Personalized Kit': '🎁 Personalized Kit',
+    'Product Marketplace': '🛍️ Marketplace',
+    'Skincare Academy': '👩‍🎓 Skincare Academy',
+    'Community Forum': '💬 Community Forum',
+    'Consult an Expert': '👩‍⚕️ Consult an Expert',
+    'Cohort Analytics': '🌍 Cohort Analytics',
+    'What-If Simulator': '🧪 What-If Simulator',
+    'Leaderboard': '🏆 Leaderboard',
+    'Scan History': '🕰️ Scan History',
+    'Expert Console': '🩺 Expert Console',
+    'Data Backup': '💾 Data Backup'
+}
+
+def navigate_to(page):
+    """Queues a page transition. Queued transitions are applied once, before anything renders."""
+    st.session_state.pending_page = page
+
+def apply_pending_transitions():
+    """Resolves the auth/navigation state machine for this run (called once, before the sidebar).
+
+    States: logged out -> 'Login/Signup'; logged in but not onboarded -> 'Onboarding';
+    onboarded -> any page in NAV_PAGES (defaults to 'Dashboard').
+    """
+    requested = st.session_state.pop('pending_page', None) or st.session_state.current_page
+
+    if not st.session_state.logged_in:
+        page = 'Login/Signup'
+    elif not st.session_state.onboarding_complete:
+        page = 'Onboarding'
+    else:
+        page = requested if requested in NAV_PAGES else 'Dashboard'
+
+    st.session_state.current_page = page
+    if page in NAV_PAGES:
+        # Keep the sidebar radio in sync (allowed here because the widget is not rendered yet)
+        st.session_state.nav_choice = page
+
+def on_nav_change():
+    """Sidebar radio callback: the new selection becomes a queued transition."""
+    navigate_to(st.session_state.nav_choice)
+
+# Staff tools are unlocked per session with a token from the environment. Login is by email
+# alone, so an account never grants them by itself. Unset token: the tools are disabled.
+OPERATOR_TOKEN_ENV = 'SKINOVA_OPERATOR_TOKEN'   # Data Backup page and process-wide maintenance jobs
+EXPERT_TOKEN_ENV = 'SKINOVA_EXPERT_TOKEN'       # Expert Console, for accounts listed in SKINOVA_EXPERT_EMAILS
+STAFF_TOKEN_ENVS = {'operator': OPERATOR_TOKEN_ENV, 'expert': EXPERT_TOKEN_ENV}
+
+def has_staff_access(role):
+    """True when this logged-in session has unlocked `role` and its token is still configured."""
+    return (st.session_state.logged_in and bool(os.environ.get(STAFF_TOKEN_ENVS[role]))
+            and role in st.session_state.get('staff_roles', ()))
+
+def unlock_staff_role(role):
+    """Unlock form callback: grants `role` to this session when the typed token matches."""
+    expected = os.environ.get(STAFF_TOKEN_ENVS[role], '')
+    candidate = st.session_state.get(f'staff_token_{role}', '')
+    if st.session_state.logged_in and expected and hmac.compare_digest(expected.encode(), candidate.encode()):
+        st.session_state.staff_roles = set(st.session_state.get('staff_roles', ())) | {role}
+    else:
+        st.session_state.staff_flash = "❌ Token not accepted."
+
+def staff_gate(role, title):
+    """Renders the unlock form unless this session holds `role`. Returns True when access is granted."""
+    if has_staff_access(role):
+        return True
+    env_name = STAFF_TOKEN_ENVS[role]
+    if not os.environ.get(env_name):
+        st.warning(f"{title} is disabled on this server (set `{env_name}` to enable it).")
+        return False
+    if 'staff_flash' in st.session_state:
+        st.error(st.session_state.pop('staff_flash'))
+    with st.form(f"staff_unlock_{role}", clear_on_submit=True):
+        st.text_input(f"{title} token", type='password', key=f'staff_token_{role}')
+        st.form_submit_button("🔓 Unlock", on_click=unlock_staff_role, args=(role,))
+    return False
+
+def set_auth_flash(level, message):
+    """Stores a message for the login or onboarding page to show after the callback-driven rerun."""
+    st.session_state.auth_flash = (level, message)
+
+def logout():
+    """Resets session state and returns to login page (used as a button callback, no extra rerun)."""
+    # Commit any buffered writes, then reset only ephemeral session flags (keep the DB intact)
+    get_write_buffer().flush()
+    st.session_state.logged_in = False
+    st.session_state.user_email = None
+    st.session_state.user_data_profile = {}
+    st.session_state.pop('staff_roles', None)
+    with session_heavy_state() as heavy:
+        heavy.clear()
+    navigate_to('Login/Signup')
+
+def handle_signup():
+    """Signup form callback: validates, creates the user and queues the Onboarding transition."""
+    new_name = st.session_state.s_name
+    new_email = st.session_state.s_email
+
+    if new_email in st.session_state.user_db:
+        set_auth_flash('error', "🚫 Duplicate email entry. An account with this email already exists. Please log in.")
+    elif not new_name or not new_email or '@' not in new_email:
+        set_auth_flash('warning', "Please enter a valid Name and Email.")
+    else:
+        user_data = create_new_user(new_name, new_email)
+        st.toast("🎉 Account created successfully! Starting hyper-onboarding...", icon='🚀')
+        initialize_user_session(new_email, user_data)
+        navigate_to('Onboarding')
+
+def handle_login():
+    """Login form callback: loads the session and queues the landing page transition."""
+    login_email = st.session_state.l_email
+
+    if login_email in st.session_state.user_db:
+        # Initialization handles score/streak updates on login
+        initialize_user_session(login_email, get_user_data(login_email))
+        # The state machine redirects to Onboarding if the profile is incomplete
+        navigate_to('Dashboard')
+    else:
+        set_auth_flash('error', "❌ Email not found. Please check your email or sign up.")
+
+def initialize_user_session(email, user_data):
+    """Initializes session state with hyper-user data upon login/signup."""
+    st.session_state.logged_in = True
+    st.session_state.user_email = email
+    
+    # Load all persistent data into the ephemeral session state. The session works on its own
+    # copy so the stored record only changes when the write-behind buffer commits.
+    user_data = copy.deepcopy(user_data)
+    st.session_state.user_data_profile = user_data
+    get_profile_cache().invalidate(email, names=('dashboard',))
+    st.session_state.onboarding_complete = user_data.get('Onboarding_Complete', False)
+    st.session_state.daily_progress = user_data.get('Routine_Progress', {})
+    st.session_state.routine_streak = user_data.get('Streak', 0)
+    st.session_state.skin_score = user_data.get('Skin Score', 75)
+    st.session_state.skin_score_history = user_data.get('Score_History', [75] * 30)
+    
+    
+    # --- HYPER-LOGIN STREAK CHECK & DAILY SCORE UPDATE ---
+    last_login_str = user_data.get('Last Login', datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    last_login_dt = datetime.strptime(last_login_str, "%Y-%m-%d %H:%M:%S").date()
+    today = date.today()
+    
+    score_change = 0
+    
+    if last_login_dt < today:
+        # Check if they completed their routine yesterday (Hypothetical full completion check)
+        yesterday_key = (today - timedelta(days=1)).strftime("%Y-%m-%d")
+        yesterday_progress = st.session_state.daily_progress.get(yesterday_key, {'AM': [False, False], 'PM': [False, False]})
+        
+        total_steps_yesterday = sum(len(v) for v in yesterday_progress.values())
+        completed_steps_yesterday = sum(v.count(True) for v in yesterday_progress.values())
+        
+        if completed_steps_yesterday >= (total_steps_yesterday * 0.8): # 80% compliance
+            st.session_state.routine_streak = st.session_state.routine_streak + 1 if last_login_dt == today - timedelta(days=1) else 1
+            score_change += 2 # Small passive reward for consistency
+            st.toast(f"🔥 Streak maintained! Now at {st.session_state.routine_streak} days. (+2 Score)", icon='🏆')
+            get_notification_outbox().enqueue(
+                'streak_maintained', email, f"🔥 {st.session_state.routine_streak}-day streak on SkinovaAI!",
+                f"Great work! You completed yesterday's routine and your streak is now {st.session_state.routine_streak} days (+2 Skin Score).",
+                dedupe_key=f"streak:{email}:{today.isoformat()}")
+        else:
+            if st.session_state.routine_streak > 0 and last_login_dt == today - timedelta(days=1):
+                st.toast(f"😔 Yesterday's routine compliance was low. Streak lost ({st.session_state.routine_streak} days).", icon='💔')
+                get_notification_outbox().enqueue(
+                    'streak_lost', email, "💔 Your SkinovaAI streak was reset",
+                    f"Yesterday's routine compliance was below 80%, so your {st.session_state.routine_streak}-day streak was reset. "
+                    "Complete today's ritual to start a new one!",
+                    dedupe_key=f"streak:{email}:{today.isoformat()}")
+            st.session_state.routine_streak = 1 # Start new streak regardless
+            score_change -= 1 # Small penalty for low compliance
+
+        # Append today's score to history and cap at 30 days
+        st.session_state.skin_score += score_change
+        st.session_state.skin_score = max(50, min(99, st.session_state.skin_score)) 
+        st.session_state.skin_score_history.append(st.session_state.skin_score)
+        st.session_state.skin_score_history = st.session_state.skin_score_history[-30:]
+        
+        # Save all changes back to the internal database
+        save_user_data(email, {
+            'Last Login': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'Streak': st.session_state.routine_streak,
+            'Skin Score': st.session_state.skin_score,
+            'Score_History': st.session_state.skin_score_history
+        })
+
+
+# --- 5. CORE FEATURE FUNCTIONS (PAGES) ---
+
+## 1. Login & Signup (Detailed UI/UX)
+def login_signup_page():
+    st.title("Welcome to SkinovaAI 🧴")
+    st.subheader("Your Hyper-Personalized Skincare Journey Starts Here")
+    st.markdown("---")
+
+    # Messages queued by the signup/login callbacks
+    if 'auth_flash' in st.session_state:
+        level, message = st.session_state.pop('auth_flash')
+        getattr(st, level)(message)
+
+    col1, col2 = st.columns(2)
+
+    with col1:
+        st.markdown(f'<div class="skinova-card"><h3>Create Your Account (Signup)</h3></div>', unsafe_allow_html=True)
+        with st.form("signup_form"):
+            st.text_input("Full Name *", key="s_name")
+            st.text_input("Email Address *", key="s_email")
+            st.markdown("_Your email will be your unique identifier. **No passwords needed!**_", help="We simulate a secure token-based login for simplicity.")
+            
+            # Transitions are applied in the callback, so the submit costs a single rerun
+            st.form_submit_button("🚀 Create Account & Start Onboarding", on_click=handle_signup)
+
+    with col2:
+        st.markdown(f'<div class="skinova-card"><h3>Existing User (Login)</h3></div>', unsafe_allow_html=True)
+        with st.form("login_form"):
+            st.text_input("Email Address *", key="l_email")
+            
+            st.form_submit_button("➡️ Login to Dashboard", on_click=handle_login)
+
+### ---
+## 2. Onboarding (Multi-Step Hyper-Setup)
+def handle_onboarding():
+    """Onboarding form callback: scores the profile, builds the routine and queues the Dashboard transition."""
+    user_age = st.session_state.ob_age
+    user_ethnicity = st.session_state.ob_fitzpatrick
+    user_location = st.session_state.ob_location
+    user_skin_type = st.session_state.ob_skin_type
+    concerns = st.session_state.ob_concerns
+    allergy = st.session_state.ob_allergy
+    sensitivity_level = st.session_state.ob_sensitivity
+    history_products = st.session_state.ob_history_products
+    goal = st.session_state.ob_goal
+    sleep_hours = st.session_state.ob_sleep
+    budget = st.session_state.ob_budget
+
+    if len(concerns) < 2 or not goal:
+        set_auth_flash('error', "Please select at least 2 Primary Concerns and your Primary Skincare Goal.")
+    else:
+        # --- HYPER-SCORE INITIAL CALCULATION LOGIC (Complex Formula) ---
+        base_score = 95 
+
+        # 1. Age Penalty (More penalty for age > 40)
+        base_score -= (user_age / 10) * 0.5
+
+        # 2. Concern Penalty (Severe concerns drop score more)
+        if any('Melasma' in c or 'Wrinkles' in c for c in concerns): base_score -= 8
+        if any('Acne' in c for c in concerns): base_score -= 5
+
+        # 3. Sensitivity & Fitzpatrick Penalty
+        if sensitivity_level in ['High/Reactive']: base_score -= 7
+        if user_ethnicity in ['Type IV', 'Type V', 'Type VI'] and 'Pigmentation' in concerns: base_score -= 4 # Higher risk for PIH
+
+        # 4. Lifestyle Bonus/Penalty
+        if sleep_hours < 6.0: base_score -= 3
+        if history_products: base_score += 2 # Experienced user bonus
+
+        initial_score = max(55, min(90, int(base_score + random.uniform(-3, 3))))
+
+        # --- DYNAMIC ROUTINE GENERATION (Based on Input) ---
+
+        # Morning Routine (Focus: Antioxidant + Protection)
+        am_steps = ['Cleanser (Low pH)']
+        if 'Pigmentation' in concerns or 'Brightening' in goal:
+            am_steps.append('Vitamin C Serum (L-Ascorbic)')
+        am_steps.append('Hydrating Moisturizer')
+        am_steps.append('Broad Spectrum SPF 50+')
+
+        # Evening Routine (Focus: Treatment + Repair)
+        pm_steps = ['Oil-Based Makeup Remover', 'Water-Based Cleanser']
+        if any('Acne' in c for c in concerns):
+            pm_steps.append('Targeted BHA or Azelaic Acid Treatment')
+        elif any('Wrinkles' in c or 'Firmness' in c for c in concerns) and history_products:
+            pm_steps.append('High-Potency Retinoid/Retinal')
+        else:
+            pm_steps.append('Hydrating/Peptide Serum')
+        pm_steps.append('Occlusive Repair Cream')
+
+        routine_steps_dict = {'Morning': am_steps, 'Evening': pm_steps}
+
+        update_dict = {
+            'Age': user_age,
+            'Location': user_location,
+            'Skin_Type': user_skin_type,
+            'Fitzpatrick_Type': user_ethnicity,
+            'Concerns': concerns,
+            'Allergies': allergy,
+            'Sensitivity': sensitivity_level,
+            'Goal': goal,
+            'Budget': budget,
+            'Sleep_Hours': sleep_hours,
+            'Skin Score': initial_score,
+            'Routine': routine_steps_dict, 
+            'Score_History': st.session_state.skin_score_history, # Use existing history, update last score
+            'Last Login': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'Onboarding_Complete': True
+        }
+
+        # Update the score history with the calculated initial score
+        update_dict['Score_History'][-1] = initial_score
+
+        if save_user_data(st.session_state.user_email, update_dict):
+            st.session_state.onboarding_complete = True
+            st.session_state.skin_score = initial_score
+            st.toast("✅ Hyper-Setup complete! Welcome to your Dashboard.", icon='🧬')
+            navigate_to('Dashboard')
+        else:
+            set_auth_flash('error', "Failed to save data. User session error.")
+
+def onboarding_page():
+    st.title("Hyper-Onboarding: 2-Minute Skin Setup 🧬")
+    st.markdown("---")
+    
+    st.subheader("We need comprehensive data for the ultimate personalized routine.")
+    if 'auth_flash' in st.session_state:
+        level, message = st.session_state.pop('auth_flash')
+        getattr(st, level)(message)
+    
+    # --- FIX START: Moved st.tabs INSIDE st.form context ---
+    with st.form("onboarding_form", clear_on_submit=False):
+        tab1, tab2, tab3 = st.tabs(["Personal Info", "Concerns & History", "Lifestyle & Goals"])
+
+        # --- TAB 1: Baseline Data (Enhanced Detail) ---
+        with tab1:
+            st.markdown("### Step 1: Baseline Data")
+            st.slider("1. Age", min_value=12, max_value=80, value=25, key='ob_age')
+            st.selectbox("2. Biological Gender", ['Female', 'Male', 'Non-Binary', 'Prefer not to say'], key='ob_gender')
+            st.selectbox("3. Fitzpatrick Skin Type (Determines Pigmentation Risk)", FITZPATRICK_OPTIONS, key='ob_fitzpatrick')
+            st.selectbox("4. Current Climate/Location Type", 
+                                          ['Tropical/Humid', 'Arid/Dry Desert', 'Temperate/Seasonal', 'Cold/Northern', 'Urban/Polluted'], key='ob_location')
+            st.radio("5. Self-Assessed Skin Type (Basic)", SKIN_TYPE_OPTIONS, key='ob_skin_type')
+        
+        # --- TAB 2: Skin History (Enhanced Detail) ---
+        with tab2:
+            st.markdown("### Step 2: Skin History & Concerns")
+            st.multiselect("6. Primary Skin Concerns (Select 2-4)", CONCERN_OPTIONS, key='ob_concerns',
+                                         default=['Acne & Breakouts (Hormonal)', 'Oil Control/Excess Sebum'], max_selections=4)
+            st.text_input("7. Known Product Allergies (e.g., Lanolin, fragrance, harsh surfactants)", "None", key='ob_allergy')
+            st.select_slider("8. Skin Sensitivity Level (How easily does your skin react?)", options=list(SENSITIVITY_POTENCY_PENALTY), value='Moderate', key='ob_sensitivity')
+            st.checkbox("9. Have you used prescription-strength actives (Retinoids/AHAs > 10%) before?", key='ob_history_products')
+        
+        # --- TAB 3: Goals & Habits (Enhanced Detail) ---
+        with tab3:
+            st.markdown("### Step 3: Goals & Habits")
+            st.selectbox("10. Primary Skincare Goal", list(GOAL_CONCERN_WEIGHTS), key='ob_goal')
+            st.slider("11. Average Nightly Sleep (Hours)", min_value=4.0, max_value=10.0, value=7.0, step=0.5, key='ob_sleep')
+            st.select_slider("12. Expected Monthly Budget (USD)", options=list(BUDGET_BANDS), key='ob_budget')
             
-            # Update the score history with the calculated initial score
-            update_dict['Score_History'][-1] = initial_score
-
-            if save_user_data(st.session_state.user_email, update_dict):
-                st.session_state.onboarding_complete = True
-                st.session_state.skin_score = initial_score
-                st.success("✅ Hyper-Setup complete! Redirecting to Dashboard...")
-                navigate_to('Dashboard')
-                st.experimental_rerun()
-            else:
-                st.error("Failed to save data. User session error.")
+            st.markdown("---")
+            st.form_submit_button("✅ Finalize Personalized Profile", on_click=handle_onboarding)
+    # --- FIX END: Form ends here, submitted logic runs in handle_onboarding() ---
 
 ### ---
 ## 3. Dashboard (Metric-Rich Hyper-View)
@@ -449,17 +4898,12 @@ def dashboard_page():
     st.markdown("---")
     
     user_data = st.session_state.user_data_profile
-    today_key = get_today_key()
     
-    # Calculate Routine Progress % (Detailed AM/PM compliance)
-    routine_steps = user_data.get('Routine', {})
-    total_steps = sum(len(steps) for steps in routine_steps.values())
-    
-    # Get today's progress log
-    today_progress = st.session_state.daily_progress.get(today_key, {'AM': [], 'PM': []})
-    completed_steps = sum(v.count(True) for v in today_progress.values())
-
-    routine_completion_percent = int((completed_steps / total_steps) * 100) if total_steps > 0 else 0
+    # Routine Progress % (Detailed AM/PM compliance) and 24h change, served from the profile cache
+    aggregates = get_dashboard_aggregates(st.session_state.user_email)
+    total_steps = aggregates['total_steps']
+    completed_steps = aggregates['completed_steps']
+    routine_completion_percent = aggregates['completion_percent']
 
     st.subheader(f"Welcome back, **{user_data.get('Name', 'User')}**!")
     
@@ -471,7 +4915,7 @@ def dashboard_page():
         <div class="skinova-card" style="border-left: 6px solid #FFC300;">
             <p style='font-size: 16px; margin-bottom: 5px; font-weight: 600;'>Current Skin Score 🌟</p>
             <p class="score-display">{st.session_state.skin_score}</p>
-            <p style='font-size: 12px; font-style: italic;'>Recent 24h Change: {'+' if st.session_state.skin_score_history[-1] >= st.session_state.skin_score_history[-2] else ''}{st.session_state.skin_score_history[-1] - st.session_state.skin_score_history[-2] if len(st.session_state.skin_score_history) > 1 else 0} pts</p>
+            <p style='font-size: 12px; font-style: italic;'>Recent 24h Change: {'+' if aggregates['score_change_24h'] >= 0 else ''}{aggregates['score_change_24h']} pts</p>
         </div>
         """, unsafe_allow_html=True)
 
@@ -497,38 +4941,44 @@ def dashboard_page():
     st.markdown("---")
     st.markdown("## 30-Day Skin Health Trend 📈")
     
-    # Matplotlib Graph (30-Day Hyper-Trend with Projection)
-    fig, ax = plt.subplots(figsize=(12, 5))
-    
     scores = st.session_state.skin_score_history
-    days = list(range(1, len(scores) + 1))
     
-    # 1. Actual Historical Data
-    ax.plot(days, scores, marker='o', linestyle='-', color=SOFT_BLUE, linewidth=3, markersize=6, alpha=0.7, label='Actual Score')
+    # Server-side figure rendering is admission-controlled; under load fall back to a client-rendered chart
+    with admission('chart', max_wait=2.0) as admitted:
+        if not admitted:
+            st.line_chart(pd.DataFrame({'Actual Score': scores}, index=range(1, len(scores) + 1)))
+        else:
+            # Matplotlib Graph (30-Day Hyper-Trend with Projection)
+            fig, ax = plt.subplots(figsize=(12, 5))
+    
+            days = list(range(1, len(scores) + 1))
     
-    # 2. Score Projection (Hyper-Detail)
-    if len(scores) >= 7:
-        # Simple linear projection based on the last 7 days' average change
-        recent_change = scores[-1] - scores[-7]
-        avg_daily_change = recent_change / 6
-        
-        projection_days = list(range(len(scores), len(scores) + 7))
-        projected_scores = [scores[-1] + (avg_daily_change * i) for i in range(1, 8)]
-        
-        ax.plot([days[-1]] + projection_days, [scores[-1]] + projected_scores, 
-                linestyle='--', color='grey', alpha=0.6, label='7-Day Projection')
+            # 1. Actual Historical Data
+            ax.plot(days, scores, marker='o', linestyle='-', color=SOFT_BLUE, linewidth=3, markersize=6, alpha=0.7, label='Actual Score')
+    
+            # 2. Score Forecast (EWMA level + robust trend, precomputed overnight and cached per history)
+            forecast = get_score_forecast(st.session_state.user_email, scores)
+            forecast_days = [days[-1] + step for step in range(1, FORECAST_HORIZON + 1)]
+    
+            ax.fill_between([days[-1]] + forecast_days, [scores[-1]] + list(forecast['lower']), [scores[-1]] + list(forecast['upper']),
+                            color='grey', alpha=0.15, label='95% Prediction Interval')
+            ax.plot([days[-1]] + forecast_days, [scores[-1]] + list(forecast['point']), 
+                    linestyle='--', color='grey', alpha=0.6, label=f'{FORECAST_HORIZON}-Day Forecast')
 
-    # Add target line
-    ax.axhline(90, color='red', linestyle=':', alpha=0.7, label='Target Score (90)')
+            # Add target line
+            ax.axhline(90, color='red', linestyle=':', alpha=0.7, label='Target Score (90)')
     
-    ax.set_title('30-Day Skin Score Trend & 7-Day Projection', fontsize=18, fontweight='bold', color=TEXT_COLOR)
-    ax.set_xlabel('Day (Last 30)', fontsize=14)
-    ax.set_ylabel('Skin Score (50-100)', fontsize=14)
-    ax.set_ylim(min(scores) - 5, max(scores) + 5 if max(scores) < 95 else 100)
-    ax.grid(axis='y', linestyle=':', alpha=0.6)
-    ax.legend()
+            ax.set_title(f'30-Day Skin Score Trend & {FORECAST_HORIZON}-Day Forecast', fontsize=18, fontweight='bold', color=TEXT_COLOR)
+            ax.set_xlabel('Day (Last 30)', fontsize=14)
+            ax.set_ylabel('Skin Score (50-100)', fontsize=14)
+            y_low = min(min(scores), float(forecast['lower'].min()))
+            y_high = max(max(scores), float(forecast['upper'].max()))
+            ax.set_ylim(y_low - 5, y_high + 5 if y_high < 95 else 100)
+            ax.grid(axis='y', linestyle=':', alpha=0.6)
+            ax.legend()
     
-    st.pyplot(fig)
+            st.pyplot(fig)
+            plt.close(fig)  # Free the figure; pyplot otherwise keeps every figure alive for the whole process
     
     st.markdown("---")
     st.markdown("## Hyper-Insight: Your Profile Summary")
@@ -540,13 +4990,46 @@ def dashboard_page():
 
 ### ---
 ## 4. Skin Analyzer (Multi-Parameter AI Simulation)
+def apply_suggested_routine(suggested_routine_change):
+    """Button callback: swaps the evening treatment step for the suggestion and queues the My Routine transition."""
+    current_routine = st.session_state.user_data_profile.get('Routine', {})
+
+    # Simple Update Logic (Modifying Evening Treatment Step)
+    if 'Retinoid' in suggested_routine_change or 'Benzoyl Peroxide' in suggested_routine_change:
+        current_routine['Evening'] = [step for step in current_routine.get('Evening', []) if 'Treatment' not in step]
+        current_routine['Evening'].insert(2, 'New: Potent Acne/Anti-Aging Treatment Applied')
+    elif 'Hydroquinone' in suggested_routine_change or 'Arbutin' in suggested_routine_change:
+         current_routine['Evening'] = [step for step in current_routine.get('Evening', []) if 'Treatment' not in step]
+         current_routine['Evening'].insert(2, 'New: Pigmentation Fading Treatment Applied')
+    elif 'Ceramide' in suggested_routine_change:
+        current_routine['Evening'] = [step for step in current_routine.get('Evening', []) if 'Treatment' not in step]
+        current_routine['Evening'].insert(2, 'New: Barrier Repair Focus Serum/Cream')
+
+    # Score bonus for taking immediate action
+    new_score = st.session_state.skin_score + random.randint(1, 3) 
+    st.session_state.skin_score = max(50, min(99, new_score))
+    st.session_state.skin_score_history[-1] = st.session_state.skin_score # Update today's score
+
+    save_user_data(st.session_state.user_email, {
+        'Routine': current_routine,
+        'Skin Score': st.session_state.skin_score,
+        'Score_History': st.session_state.skin_score_history
+    })
+    st.toast("Routine successfully updated! Showing 'My Routine'.", icon='✅')
+    navigate_to('My Routine')
+
+
 def skin_analyzer_page():
     st.title("Skin Analyzer: AI-Powered Deep Scan 🔬")
     st.markdown("---")
     
     st.info("💡 **Hyper-Warning**: This is a simulated analysis based on visual data interpretation algorithms and self-reported metrics.")
     
-    uploaded_file = st.file_uploader("1. Apne focus area ki high-resolution photo upload karein (Jaise: Cheeks ya T-zone).", type=["jpg", "jpeg", "png"])
+    # The upload is spilled to disk by the callback and the widget is reset, so no image bytes stay in session memory
+    uploaded_file = spilled_uploader("1. Apne focus area ki high-resolution photo upload karein (Jaise: Cheeks ya T-zone).",
+                                     'analyzer_upload', type=["jpg", "jpeg", "png"])
+    if uploaded_file is not None:
+        st.caption(f"📎 **{uploaded_file['name']}** ({uploaded_file['size'] / 1024:.0f} KB) ready for the scan. Upload another photo to replace it.")
     
     st.markdown("---")
     st.subheader("2. Vistrit Jeevanशैली (Lifestyle) & Internal Factors Questionnaire 📝")
@@ -554,7 +5037,6 @@ def skin_analyzer_page():
     # Initialize state for questionnaire submission
     if 'analyzer_submitted' not in st.session_state:
         st.session_state.analyzer_submitted = False
-        st.session_state.analyzer_inputs = {}
 
     with st.form("deep_analyzer_form"):
         col_q1, col_q2, col_q3 = st.columns(3)
@@ -586,6 +5068,10 @@ def skin_analyzer_page():
             hormonal_changes = st.radio("2.14. Kya aap hormonal changes face kar rahe hain? (e.g., Pregnancy, PCOS, Menopause)", ['Yes', 'No', 'N/A'])
             product_changes = st.text_area("2.15. Pichle 1 mahine mein use kiye naye products/medicines?", "N/A")
             
+        scan_mode = st.radio("Scan Mode", ['Whole Image', 'Regional Map (Tiled)', 'Progressive (Preview + Refine)'], horizontal=True,
+                             help="Regional Map scores forehead, T-zone, cheeks and chin separately, tile by tile, at full resolution. "
+                                  "Progressive shows preliminary indicators from a small preview first and refines them in place.")
+
         # Submit Button
         submitted = st.form_submit_button("🔬 Run Hyper-AI Deep Scan & Generate Report")
 
@@ -604,72 +5090,134 @@ def skin_analyzer_page():
             'recent_travel': recent_travel, 'acne_location': acne_location, 'texture_concern': texture_concern,
             'flushing': flushing, 'hormonal_changes': hormonal_changes, 'product_changes': product_changes
         }
-        st.session_state.analyzer_inputs = q_inputs
+        with session_heavy_state() as heavy:
+            heavy.put('analyzer_inputs', q_inputs)
         st.session_state.analyzer_submitted = True
         
-        image = Image.open(uploaded_file)
-        
-        st.markdown("---")
-        
-        col_img, col_proc = st.columns([1, 2])
-        
-        with col_img:
-            st.image(image, caption='Image Submitted (Visual Data)', use_column_width=True)
+        # Image decode + analysis is CPU-heavy: it runs only once admitted (fair-queued across users)
+        with admission('analysis') as admitted:
+            if not admitted:
+                st.session_state.analyzer_submitted = False
+                return
+                
+            region_result = None
+            image_metrics = None    # Whole-image TILE_METRICS once a measured (tiled) pass has run
+            indicator_slot = None   # Progressive mode renders the indicator cards early and updates them in place
+            if scan_mode == 'Progressive (Preview + Refine)':
+                started = time.monotonic()
+                image, image_metrics = preview_scan(uploaded_file)
+                st.markdown("---")
+                col_img, col_proc = st.columns([1, 2])
+                with col_img:
+                    st.image(image, caption='Image Submitted (Visual Data)', use_column_width=True)
+                with col_proc:
+                    st.markdown("### Progressive Scan with SkinovaNet 2.0 🤖")
+                    scan_status = st.empty()
+                    progress_bar = st.progress(0)
+
+                st.markdown("## 🔬 Hyper-Professional Analysis Report (Visual + Internal Data)")
+                st.subheader("1. Clinical Biometric Indicators (AI Visual Scan) 🖼️")
+                indicator_slot = st.empty()
+                if image_metrics is not None:
+                    with indicator_slot.container():
+                        render_card_grid('indicator', indicator_cards(scan_indicators(image_metrics)), num_cols=5)
+                first_result = time.monotonic() - started
+                scan_status.markdown(f"_Preview ready in {first_result * 1000:.0f} ms. Refining at full resolution..._")
+
+                last_update = [time.monotonic()]
+                def stream_refinement(fraction, grid, skin):
+                    progress_bar.progress(fraction)
+                    if time.monotonic() - last_update[0] >= PROGRESSIVE_UPDATE_SECONDS:
+                        partial = summarize_tiles(grid, skin)
+                        if partial is not None:
+                            with indicator_slot.container():
+                                render_card_grid('indicator', indicator_cards(scan_indicators(partial)), num_cols=5)
+                        last_update[0] = time.monotonic()
+
+                # Navigating away interrupts the refinement; analyze_regions then cancels the pending tiles
+                with decoded_raster(uploaded_file) as (raster, _):
+                    region_result = analyze_regions(raster, on_progress=stream_refinement)
+                refined = summarize_tiles(region_result['grid'], region_result['skin'])
+                if refined is not None:
+                    image_metrics = refined
+                final_result = time.monotonic() - started
+                get_scan_timings().record(first_result, final_result)
+                progress_bar.empty()
+                scan_status.success(f"✅ Preview in {first_result * 1000:.0f} ms, final result in {final_result:.2f}s "
+                                    f"({region_result['tiles']} full-resolution tiles).")
+            elif scan_mode == 'Regional Map (Tiled)':
+                # Full resolution, but only a tile per worker is ever resident
+                with decoded_raster(uploaded_file) as (raster, image):
+                    st.markdown("---")
+                    col_img, col_proc = st.columns([1, 2])
+                    with col_img:
+                        st.image(image, caption='Image Submitted (Visual Data)', use_column_width=True)
+                    with col_proc:
+                        st.markdown("### Regional Scan with SkinovaNet 2.0 🤖")
+                        st.markdown(f"_Splitting the {raster.shape[1]}×{raster.shape[0]} photo into overlapping {TILE_SIZE}px tiles across {TILE_WORKERS} workers..._")
+                        progress_bar = st.progress(0)
+                        region_result = analyze_regions(raster, on_progress=lambda fraction, *_: progress_bar.progress(fraction))
+                        progress_bar.empty()
+                        st.success(f"✅ {region_result['tiles']} tiles analyzed in {region_result['seconds']:.2f}s. Generating Professional Report.")
+                image_metrics = summarize_tiles(region_result['grid'], region_result['skin'])
+            else:
+                # Decode straight from the mmap and keep only a display-sized copy
+                with open_spilled(uploaded_file) as image_bytes:
+                    image = Image.open(image_bytes)
+                    image.thumbnail((800, 800))
+                    image.load()
+            
+                st.markdown("---")
+            
+                col_img, col_proc = st.columns([1, 2])
             
-        with col_proc:
-            st.markdown("### Processing Image with SkinovaNet 2.0 🤖")
-            st.markdown("_Running 12-layer Convolutional Analysis to detect subtle skin conditions... Aur aapke self-reported data ko merge kiya jaa raha hai..._")
-            with st.spinner('Analyzing texture, color mapping, and subsurface artifacts...'):
-                import time
-                progress_bar = st.progress(0)
-                for i in range(100):
-                    time.sleep(0.02)
-                    progress_bar.progress(i + 1)
-            progress_bar.empty()
-            st.success("✅ Analysis Complete! Generating Professional Report.")
+                with col_img:
+                    st.image(image, caption='Image Submitted (Visual Data)', use_column_width=True)
+                
+                with col_proc:
+                    st.markdown("### Processing Image with SkinovaNet 2.0 🤖")
+                    st.markdown("_Running 12-layer Convolutional Analysis to detect subtle skin conditions... Aur aapke self-reported data ko merge kiya jaa raha hai..._")
+                    # No simulated progress: the admission units are held only for the decode
+                    st.success("✅ Analysis Complete! Generating Professional Report.")
 
         
         # --- ENHANCED HYPER-PROFESSIONAL REPORT GENERATION ---
         
-        # 1. AI Visual Assessment (Existing Dummy Logic)
-        dummy_results = {
-            "Acne Index (P. Acnes Activity)": random.choice(["Low", "Mild (Localized)", "Moderate (Diffuse)", "High (Severe)"]),
-            "Pigmentation Index (Melanin Density)": random.choice(["Low", "Mild (Freckling)", "Moderate (Sun Damage)", "High (Melasma)"]),
-            "Wrinkle Depth (Simulated)": random.choice(["Low (Dynamic only)", "Minimal (Fine Lines)", "Moderate (Static lines)", "Significant (Deep creases)"]),
-            "Hydration Level (TEWL Metric)": random.choice(["Optimal (Level 5)", "Good (Level 4)", "Fair (Level 3)", "Poor (Level 2)"]),
-            "Redness/Inflammation Index": random.choice(["Minimal", "Localized (Around acne)", "Diffuse (General sensitivity)"]),
-        }
+        # 1. AI Visual Assessment (measured from the photo in the tiled modes, simulated otherwise)
+        if image_metrics is not None:
+            indicator_results = scan_indicators(image_metrics)
+        else:
+            indicator_results = {name: random.choice(options) for name, options in ANALYZER_INDICATORS.items()}
         
         # 2. Score Deduction/Addition based on Questionnaire (New Logic)
-        internal_risk_score = 0
-        
-        if q_inputs['stress_level'] >= 7: internal_risk_score += 5
-        if q_inputs['water_intake'] <= 1.5: internal_risk_score += 4
-        if q_inputs['sleep_quality'] == 'Poor': internal_risk_score += 5
-        if q_inputs['diet_type'] in ['High Sugar/Processed', 'High Dairy & Gluten']: internal_risk_score += 6
-        if q_inputs['gut_health'] == 'Poor (Bloating/Irregular)': internal_risk_score += 5
-        if q_inputs['sun_exposure'] > 30: internal_risk_score += 8
-        if q_inputs['flushing'] == 'Often (Heat/Spicy food)': internal_risk_score += 4
+        internal_risk_score = compute_internal_risk_score(q_inputs)
         
+        if indicator_slot is None:
+            st.markdown("## 🔬 Hyper-Professional Analysis Report (Visual + Internal Data)")
+            
+            # --- SECTION 1: CORE BIOMETRIC INDICATORS (From Image Scan) ---
+            st.subheader("1. Clinical Biometric Indicators (AI Visual Scan) 🖼️")
+            indicator_slot = st.empty()
         
-        st.markdown("## 🔬 Hyper-Professional Analysis Report (Visual + Internal Data)")
-        
-        # --- SECTION 1: CORE BIOMETRIC INDICATORS (From Image Scan) ---
-        st.subheader("1. Clinical Biometric Indicators (AI Visual Scan) 🖼️")
-        
-        res_cols = st.columns(5)
-        indicator_data = list(dummy_results.items())
-        
-        for i, (key, value) in enumerate(indicator_data):
-            # Simple color logic based on the rating word
-            color = "#4CAF50" if value.startswith(("Low", "Minimal", "Optimal", "Good")) else ("#FFC300" if value.startswith(("Mild", "Moderate", "Fair", "Localized")) else "#FF4B4B")
-            with res_cols[i % 5]:
-                 st.markdown(f"""
-                <div class="skinova-card" style="padding: 15px; border-left: 5px solid {color}; min-height: 120px;">
-                    <p style='font-size: 14px; margin-bottom: 0; color: #777;'>{key.split('(')[0].strip()}</p>
-                    <p style='font-size: 18px; font-weight: bold; color: {color}; margin-top: 5px;'>{value}</p>
-                </div>
-                """, unsafe_allow_html=True)
+        indicator_data = list(indicator_results.items())
+        with indicator_slot.container():
+            render_card_grid('indicator', indicator_cards(indicator_results), num_cols=5)
+
+        heatmaps = {}   # {metric: PNG bytes}, kept with the report
+        if region_result is not None:
+            st.markdown("#### Regional Map 🗺️")
+            if region_result['regions']:
+                st.dataframe(pd.DataFrame.from_dict(
+                    {name: {metric: f"{value * 100:.1f}%" for metric, value in zip(TILE_METRICS, values)}
+                     for name, values in region_result['regions'].items()}, orient='index'), use_container_width=True)
+                for metric, tab in zip(TILE_METRICS, st.tabs(list(TILE_METRICS))):
+                    with tab:
+                        heatmaps[metric] = figure_png(region_heatmap_figure(region_result, image, metric))
+                        st.image(heatmaps[metric], use_column_width=True)
+                st.caption(f"{region_result['tiles']} tiles of {region_result['tile']}px (stride {region_result['stride']}px). "
+                           "Tiles that are mostly background are left blank.")
+            else:
+                st.warning("No skin-toned area was found in the photo. Try a well-lit, face-centred picture.")
 
         st.markdown("---")
         
@@ -722,13 +5270,13 @@ def skin_analyzer_page():
         suggested_routine_change = ""
         
         # Complex logic to recommend the main active
-        if "High (Severe)" in dummy_results["Acne Index (P. Acnes Activity)"]:
+        if "High (Severe)" in indicator_results["Acne Index (P. Acnes Activity)"]:
             suggested_routine_change = "Evening mein **Prescription-Grade Retinoid** (Tretinoin, agar tolerance ho) ya **Benzoyl Peroxide** (Spot Treatment) shuru karein."
-        elif "High (Melasma)" in dummy_results["Pigmentation Index (Melanin Density)"]:
+        elif "High (Melasma)" in indicator_results["Pigmentation Index (Melanin Density)"]:
             suggested_routine_change = "AM routine mein **15%+ L-Ascorbic Acid** serum ko shamil karein aur PM mein **Hydroquinone/Kojic Acid** (Derm-guided) ya **Alpha-Arbutin** use karein. **SPF ko 4 ghante mein re-apply karein.**"
-        elif "Significant (Deep creases)" in dummy_results["Wrinkle Depth (Simulated)"]:
+        elif "Significant (Deep creases)" in indicator_results["Wrinkle Depth (Simulated)"]:
             suggested_routine_change = "PM routine mein **Peptide Rich Serum** ko **Retinaldehyde** se pehle use karein (Sandwich Method) for dermal matrix support."
-        elif "Poor (Level 2)" in dummy_results["Hydration Level (TEWL Metric)"]:
+        elif "Poor (Level 2)" in indicator_results["Hydration Level (TEWL Metric)"]:
             suggested_routine_change = "Turant saare **harsh foaming cleansers** aur **alcohol-based toners** band karein. **Ceramide, Cholesterol, Hyaluronic Acid** waale products ko priority dein."
         else:
             suggested_routine_change = "Aapki skin balanced hai. **Aapki current routine sahi hai**, bas **hydration** aur **antioxidant support** ko maintain rakhein."
@@ -736,51 +5284,126 @@ def skin_analyzer_page():
         st.markdown(f"""
             <div class="skinova-card" style="margin-top: 20px; background-color: {SOFT_BLUE}10;">
                 <h4 style='margin-top:0; color:{DARK_ACCENT}'>Hyper-Action Recommendation:</h4>
-                <p style='font-size: 16px; font-weight: 500;'>**Primary Focus Area:** {max(dummy_results, key=lambda k: indicator_data.index((k, dummy_results[k]))).split('(')[0].strip()} </p>
+                <p style='font-size: 16px; font-weight: 500;'>**Primary Focus Area:** {max(indicator_results, key=lambda k: indicator_data.index((k, indicator_results[k]))).split('(')[0].strip()} </p>
                 <p style='font-size: 16px;'>**Main Topical Change:** *{suggested_routine_change}*</p>
                 <p style='font-size: 14px; font-style: italic;'>**Next Re-scan:** 6 Weeks mein.</p>
             </div>
             """, unsafe_allow_html=True)
             
-        # Button to automatically update the routine
-        if st.button("Apply Suggested Routine Change and Update Profile Score", key='apply_routine'):
-            
-            current_routine = st.session_state.user_data_profile.get('Routine', {})
-            
-            # Simple Update Logic (Modifying Evening Treatment Step)
-            if 'Retinoid' in suggested_routine_change or 'Benzoyl Peroxide' in suggested_routine_change:
-                current_routine['Evening'] = [step for step in current_routine.get('Evening', []) if 'Treatment' not in step]
-                current_routine['Evening'].insert(2, 'New: Potent Acne/Anti-Aging Treatment Applied')
-            elif 'Hydroquinone' in suggested_routine_change or 'Arbutin' in suggested_routine_change:
-                 current_routine['Evening'] = [step for step in current_routine.get('Evening', []) if 'Treatment' not in step]
-                 current_routine['Evening'].insert(2, 'New: Pigmentation Fading Treatment Applied')
-            elif 'Ceramide' in suggested_routine_change:
-                current_routine['Evening'] = [step for step in current_routine.get('Evening', []) if 'Treatment' not in step]
-                current_routine['Evening'].insert(2, 'New: Barrier Repair Focus Serum/Cream')
-            
-            # Score bonus for taking immediate action
-            new_score = st.session_state.skin_score + random.randint(1, 3) 
-            st.session_state.skin_score = max(50, min(99, new_score))
-            st.session_state.skin_score_history[-1] = st.session_state.skin_score # Update today's score
-
-            save_user_data(st.session_state.user_email, {
-                'Routine': current_routine,
-                'Skin Score': st.session_state.skin_score,
-                'Score_History': st.session_state.skin_score_history
+        # --- SECTION 4: SKIN TWINS (Nearest Neighbours over Scan Vectors) ---
+        st.subheader("4. Your Skin Twins 👯")
+        user_email = st.session_state.user_email
+        twin_vector = scan_feature_vector(indicator_results, q_inputs, st.session_state.user_data_profile)
+        twin_index = get_twin_index()
+        twins = [(twin_email, similarity) for twin_email, similarity in twin_index.search(twin_vector, TWIN_TOP_K * 2, exclude_email=user_email)
+                 if twin_email in st.session_state.user_db][:TWIN_TOP_K]
+        if image_metrics is not None:
+            # Whole Image results are simulated; indexing or recording them would mix noise into
+            # other users' matches and into this user's comparisons and trend lines
+            twin_index.add(user_email, twin_vector)
+            record_scan(user_email, scan_history_entry(indicator_results, image_metrics, twin_vector, image, internal_risk_score, scan_mode))
+        with session_heavy_state() as heavy:
+            # Counted at its pickled size: the report and its figures are what a session actually holds on to
+            heavy.put('analyzer_report', {
+                'at': datetime.now().strftime("%Y-%m-%d %H:%M"), 'mode': scan_mode, 'image': image_png(image),
+                'indicators': indicator_results, 'risk': internal_risk_score, 'heatmaps': heatmaps,
             })
-            st.success("Routine successfully updated! Check 'My Routine' page.")
-            navigate_to('My Routine')
-            st.experimental_rerun()
-            
+
+        if twins:
+            st.markdown("Users whose latest scans look most like yours, and what has been working for them:")
+            twin_cards = []
+            for i, (twin_email, similarity) in enumerate(twins):
+                twin = st.session_state.user_db[twin_email]
+                history = twin.get('Score_History') or [twin.get('Skin Score', 0)]
+                routine = twin.get('Routine') or {}
+                twin_cards.append({
+                    'label': f"TWIN #{i + 1} - {similarity * 100:.0f}% MATCH",
+                    'score': f"Skin Score {twin.get('Skin Score', 0)} ({history[-1] - history[0]:+} over {len(history)} days)",
+                    'profile': f"{twin.get('Skin_Type') or 'Not set'} skin, {twin.get('Streak', 0)}-day streak",
+                    'routine': " → ".join(routine.get('Evening', [])) or "No routine yet",
+                })
+            render_card_grid('twin', twin_cards, num_cols=3)
+        else:
+            st.info("No skin twins yet. Matches appear as more users complete their scans.")
+        st.caption(f"Matched against {len(twin_index):,} scans.")
+        if image_metrics is None:
+            st.caption("Whole Image results are simulated, so this scan is not saved to your Scan History. "
+                       "Use a tiled mode to track your skin over time.")
+
+        # Button to automatically update the routine (a callback: the report is gone by the next run)
+        st.button("Apply Suggested Routine Change and Update Profile Score", key='apply_routine',
+                  on_click=apply_suggested_routine, args=(suggested_routine_change,))
+
     # Display the last generated report data if it exists and the form wasn't just submitted
     elif st.session_state.analyzer_submitted:
+        with session_heavy_state() as heavy:
+            report = heavy.get('analyzer_report')
         st.info("Last scan data is available. Click 'Run Hyper-AI Deep Scan' again to analyze new data.")
-        # If the user revisits the page, we can show their last inputs/results summary here if desired, 
-        # but for simplicity, we just prompt them to re-run the form.
+        if report is not None:
+            st.markdown(f"## Last Scan Report ({report['at']}, {report['mode']})")
+            col_img, col_risk = st.columns([1, 2])
+            col_img.image(report['image'], caption='Image Submitted (Visual Data)', use_column_width=True)
+            col_risk.metric("Internal Risk Score", report['risk'])
+            render_card_grid('indicator', indicator_cards(report['indicators']), num_cols=5)
+            if report['heatmaps']:
+                for metric, tab in zip(report['heatmaps'], st.tabs(list(report['heatmaps']))):
+                    tab.image(report['heatmaps'][metric], use_column_width=True)
 
 
 ### ---
 ## 5. My Routine (Dynamic & Streak-Driven Tracking)
+@fragment
+def routine_checklist(routine_steps_dict, today_key, on_toggle):
+    """AM/PM checkbox grid. Runs as a fragment, so a toggle reruns only this block."""
+    col_m, col_e = st.columns(2)
+
+    with col_m:
+        st.subheader("☀️ Morning Routine (Protection Focus)")
+        st.markdown("_Ensuring environmental defense and hydration._")
+        for i, step in enumerate(routine_steps_dict.get('Morning', [])):
+            st.checkbox(f"**Step {i+1}**: {step}", 
+                        value=st.session_state.daily_progress[today_key]['AM'][i],
+                        key=f"m_step_{i}", 
+                        on_change=on_toggle, 
+                        args=('AM', i))
+
+    with col_e:
+        st.subheader("🌙 Evening Routine (Treatment Focus)")
+        st.markdown("_Targeting concerns and facilitating overnight repair._")
+        for i, step in enumerate(routine_steps_dict.get('Evening', [])):
+            st.checkbox(f"**Step {i+1}**: {step}", 
+                        value=st.session_state.daily_progress[today_key]['PM'][i],
+                        key=f"e_step_{i}", 
+                        on_change=on_toggle, 
+                        args=('PM', i))
+
+    # Only today's cells repaint on a toggle; the year view below renders on full runs
+    calendar = get_compliance_calendar(st.session_state.user_email)
+    st.markdown(f"<p style='margin-top: 8px;'><b>Today</b>{calendar.render_today()}</p>", unsafe_allow_html=True)
+
+
+def compliance_year_view():
+    st.markdown("---")
+    st.markdown("## Your Year in Rituals 📅")
+    calendar = get_compliance_calendar(st.session_state.user_email)
+    weekday_frame, monthly_frame, tracked_days = calendar.breakdowns()
+    st.markdown(f"""
+    <div class="skinova-card">
+        <p style='font-weight: 600; margin-bottom: 4px;'>☀️ Morning compliance</p>{calendar.render_svg('AM')}
+        <p style='font-weight: 600; margin: 12px 0 4px;'>🌙 Evening compliance</p>{calendar.render_svg('PM')}
+        <p style='font-size: 12px; font-style: italic; color: #777;'>Last {COMPLIANCE_CALENDAR_DAYS} days, {tracked_days} tracked. Darker = more steps completed; grey = no record.</p>
+    </div>
+    """, unsafe_allow_html=True)
+
+    col_week, col_month = st.columns(2)
+    with col_week:
+        st.markdown("#### By Weekday")
+        st.bar_chart(weekday_frame * 100)
+    with col_month:
+        st.markdown("#### By Month")
+        st.line_chart(monthly_frame * 100)
+
+
 def my_routine_page():
     st.title("My Daily Ritual Tracker ✅")
     st.markdown("---")
@@ -851,9 +5474,9 @@ def my_routine_page():
         if st.session_state.skin_score_history:
             st.session_state.skin_score_history[-1] = st.session_state.skin_score
         
-        # Step 4: Save all complex data back to the internal DB
+        # Step 4: Save back to the internal DB (only today's progress row, not the full history)
+        save_progress_row(st.session_state.user_email, today_key, st.session_state.daily_progress[today_key])
         save_user_data(st.session_state.user_email, {
-            'Routine_Progress': st.session_state.daily_progress, # Save detailed progress history
             'Skin Score': st.session_state.skin_score,
             'Score_History': st.session_state.skin_score_history
         })
@@ -867,27 +5490,9 @@ def my_routine_page():
     </div>
     """, unsafe_allow_html=True)
     
-    col_m, col_e = st.columns(2)
-
-    with col_m:
-        st.subheader("☀️ Morning Routine (Protection Focus)")
-        st.markdown("_Ensuring environmental defense and hydration._")
-        for i, step in enumerate(routine_steps_dict.get('Morning', [])):
-            st.checkbox(f"**Step {i+1}**: {step}", 
-                        value=st.session_state.daily_progress[today_key]['AM'][i],
-                        key=f"m_step_{i}", 
-                        on_change=update_progress, 
-                        args=('AM', i))
-
-    with col_e:
-        st.subheader("🌙 Evening Routine (Treatment Focus)")
-        st.markdown("_Targeting concerns and facilitating overnight repair._")
-        for i, step in enumerate(routine_steps_dict.get('Evening', [])):
-            st.checkbox(f"**Step {i+1}**: {step}", 
-                        value=st.session_state.daily_progress[today_key]['PM'][i],
-                        key=f"e_step_{i}", 
-                        on_change=update_progress, 
-                        args=('PM', i))
+    # Only this fragment re-executes when a checkbox is toggled
+    routine_checklist(routine_steps_dict, today_key, update_progress)
+    compliance_year_view()
 
     st.markdown("---")
     st.info("Check/Uncheck a box to instantly save and update your progress.")
@@ -895,30 +5500,9 @@ def my_routine_page():
 
 ### ---
 ## 6. Product Marketplace (Detailed Filtering and Cards)
-def product_marketplace_page():
-    st.title("Hyper-Marketplace: Curated Skincare Solutions 🛍️")
-    st.markdown("---")
-    
-    # Hyper-Extension: Expanded product list (20+ items)
-    products = [
-        {"Name": "Barrier Repair Cleanser", "Price": "$25", "Concern": "Dryness & Dehydration (Barrier)", "Link": "#", "Type": "Cleanser", "Key_Ingredients": "Ceramides, Glycerin, Cholesterol"},
-        {"Name": "BHA Pimple Serum (2%)", "Price": "$35", "Concern": "Acne & Breakouts (Fungal/Bacterial)", "Link": "#", "Type": "Treatment", "Key_Ingredients": "Salicylic Acid, Niacinamide, Green Tea"},
-        {"Name": "Pro-Retinol 0.5% Cream", "Price": "$50", "Concern": "Fine Lines & Wrinkles (Static)", "Link": "#", "Type": "Treatment", "Key_Ingredients": "Encapsulated Retinol, Peptides, Bisabolol"},
-        {"Name": "Calm-Cica Gel", "Price": "$30", "Concern": "Redness & Sensitivity (Rosacea)", "Link": "#", "Type": "Moisturizer", "Key_Ingredients": "Centella Asiatica, Allantoin, Panthenol"},
-        {"Name": "Ascorbic Acid 15% Serum", "Price": "$45", "Concern": "Dark Spots/Melasma/Pigmentation", "Link": "#", "Type": "Serum", "Key_Ingredients": "L-Ascorbic Acid, Ferulic Acid, Vitamin E"},
-        {"Name": "Multi-Weight HA Booster", "Price": "$28", "Concern": "Dryness & Dehydration (Barrier)", "Link": "#", "Type": "Serum", "Key_Ingredients": "Hyaluronic Acid (3 Weights), B5, Trehalose"},
-        {"Name": "A-Zinc Oil Control Serum", "Price": "$30", "Concern": "Oil Control/Excess Sebum", "Link": "#", "Type": "Serum", "Key_Ingredients": "Niacinamide (10%), Zinc PCA, Licorice Root"},
-        {"Name": "Mineral Defense SPF 50", "Price": "$35", "Concern": "All", "Link": "#", "Type": "Sunscreen", "Key_Ingredients": "Zinc Oxide, Titanium Dioxide, Iron Oxides"},
-        {"Name": "Hydro-Repair Eye Cream", "Price": "$40", "Concern": "Fine Lines & Wrinkles (Static)", "Link": "#", "Type": "Eye Care", "Key_Ingredients": "Argireline Peptide, Caffeine, Retinal"},
-        {"Name": "Deep Hydrating Toner", "Price": "$20", "Concern": "Dryness & Dehydration (Barrier)", "Link": "#", "Type": "Toner", "Key_Ingredients": "Rose Water, Snail Mucin, Galactomyces Ferment"},
-        {"Name": "Azelaic Acid Suspension", "Price": "$22", "Concern": "Acne & Breakouts (Hormonal)", "Link": "#", "Type": "Treatment", "Key_Ingredients": "Azelaic Acid (10%), Squalane"},
-        {"Name": "PM Occlusive Balm", "Price": "$38", "Concern": "Loss of Firmness/Elasticity", "Link": "#", "Type": "Moisturizer", "Key_Ingredients": "Petrolatum, Shea Butter, Peptides"},
-        {"Name": "Glycolic Acid Toning Pads", "Price": "$32", "Concern": "Loss of Firmness/Elasticity", "Link": "#", "Type": "Exfoliant", "Key_Ingredients": "Glycolic Acid (8%), Aloe Vera"}
-    ]
-    
-    concern_options = ["All", 'Acne & Breakouts (Hormonal)', 'Acne & Breakouts (Fungal/Bacterial)', 'Dryness & Dehydration (Barrier)', 'Redness & Sensitivity (Rosacea)', 'Dark Spots/Melasma/Pigmentation', 'Fine Lines & Wrinkles (Static)', 'Oil Control/Excess Sebum']
-    type_options = ["All", "Cleanser", "Toner", "Serum", "Moisturizer", "Treatment", "Sunscreen", "Eye Care", "Exfoliant"]
-
+@fragment
+def marketplace_grid(products, concern_options, type_options):
+    """Filter controls plus the product card grid, isolated as a fragment."""
     # Filtering UI
     st.subheader("Filter Your Hyper-Search")
     filter_col1, filter_col2, filter_col3 = st.columns(3)
@@ -945,28 +5529,23 @@ def product_marketplace_page():
     st.subheader(f"Showing {len(filtered_products)} Curated Products (Within Your ${price_limit} Budget)")
     
     # Display products in a 3-column grid
-    num_cols = 3
+    render_card_grid('product', [
+        {'name': product['Name'], 'price': product['Price'], 'type': product['Type'],
+         'target': product['Concern'].split('(')[0].strip(), 'ingredients': product['Key_Ingredients'], 'link': product['Link']}
+        for product in filtered_products
+    ], num_cols=3)
+
+
+def product_marketplace_page():
+    st.title("Hyper-Marketplace: Curated Skincare Solutions 🛍️")
+    st.markdown("---")
     
-    for i in range(0, len(filtered_products), num_cols):
-        cols = st.columns(num_cols)
-        for j in range(num_cols):
-            if i + j < len(filtered_products):
-                product = filtered_products[i + j]
-                with cols[j]:
-                    st.markdown(f"""
-                    <div class="skinova-card" style="min-height: 320px; border-left: 6px solid {DARK_ACCENT};">
-                        <h4 style='color:{SOFT_BLUE}; margin-top:0;'>{product['Name']}</h4>
-                        <p style='color: #4CAF50; font-weight: bold; font-size: 22px;'>{product['Price']}</p>
-                        <p><strong>Type:</strong> {product['Type']}</p>
-                        <p><strong>Target:</strong> {product['Concern'].split('(')[0].strip()}</p>
-                        <p style='font-size: 14px;'>**Key Ingredients:** {product['Key_Ingredients']}</p>
-                        <a href="{product['Link']}" target="_blank">
-                            <button style="background-color: #FFC300; color: {TEXT_COLOR}; padding: 8px 15px; border: none; border-radius: 4px; cursor: pointer; margin-top: 10px;">
-                                View & Buy (Affiliate Link)
-                            </button>
-                        </a>
-                    </div>
-                    """, unsafe_allow_html=True)
+    
+    concern_options = ["All", 'Acne & Breakouts (Hormonal)', 'Acne & Breakouts (Fungal/Bacterial)', 'Dryness & Dehydration (Barrier)', 'Redness & Sensitivity (Rosacea)', 'Dark Spots/Melasma/Pigmentation', 'Fine Lines & Wrinkles (Static)', 'Oil Control/Excess Sebum']
+    type_options = ["All", "Cleanser", "Toner", "Serum", "Moisturizer", "Treatment", "Sunscreen", "Eye Care", "Exfoliant"]
+
+    # Filters and grid run as a fragment: changing a filter re-executes only the grid
+    marketplace_grid(PRODUCT_CATALOG, concern_options, type_options)
 
 
 ### ---
@@ -977,7 +5556,6 @@ def personalized_kit_page():
 
     user_data = st.session_state.user_data_profile
     concerns = user_data.get('Concerns', [])
-    sensitivity = user_data.get('Sensitivity', 'Mild')
     skin_type = user_data.get('Skin_Type', 'Combination')
     score = st.session_state.skin_score
     goal = user_data.get('Goal', '')
@@ -988,71 +5566,35 @@ def personalized_kit_page():
 
     st.subheader(f"Analyzing {skin_type} skin (Score: {score}) with goal: **{goal}**")
     
-    # HYPER-KIT GENERATION LOGIC (More conditional complexity)
-    kit = {}
-
-    # 1. Cleanser (Conditioned by Skin Type/Acne/Sensitivity)
-    if 'Oily' in skin_type or any('Acne' in c for c in concerns):
-        kit['Cleanser'] = ('Gel-to-Foam Clarifying Cleanser', 'Salicylic Acid, Willow Bark', 'Targets oil and congestion.')
-    elif 'Dry' in skin_type or sensitivity == 'High/Reactive':
-        kit['Cleanser'] = ('Creamy Hydrating Cleansing Balm', 'Ceramides, Oat Extract', 'Soothes and protects barrier.')
-    else:
-        kit['Cleanser'] = ('Gentle pH-Balanced Cleanser', 'Glycerin, Niacinamide', 'Maintains skin harmony.')
+    # HYPER-KIT GENERATION: the whole catalog is scored against the profile, then the best
+    # product per slot is picked within budget and allergy constraints (cached per profile signature)
+    kit = recommend_kit(user_data, score)
+    allergies = parse_allergies(user_data.get('Allergies'))
 
-    # 2. AM Serum (Conditioned by Pigmentation/Anti-Aging)
-    if 'Brightening' in goal or any('Pigmentation' in c for c in concerns):
-        kit['AM_Serum'] = ('15% L-Ascorbic Acid Serum', 'Vitamin C, Ferulic Acid', 'Provides strong antioxidant and brightening defense.')
-    elif 'Anti-Aging' in goal or score < 80:
-        kit['AM_Serum'] = ('Peptide & Copper Complex Serum', 'Copper Peptides, Hyaluronic Acid', 'Supports firmness and hydration.')
-    else:
-        kit['AM_Serum'] = ('Niacinamide 10% Barrier Serum', 'Niacinamide, Zinc PCA', 'Minimizes pores and controls redness.')
+    st.markdown(f"Based on your **profile**, **score**, and **goals**, here is your {len(kit)}-step optimized kit:")
+    if allergies:
+        st.caption(f"Excluding products containing: {', '.join(allergies)}")
 
-    # 3. Moisturizer (Conditioned by Skin Type and Hydration score)
-    hydration_score = score # Using skin score as proxy for hydration
-    if 'Oily' in skin_type or hydration_score > 90:
-        kit['Moisturizer'] = ('Oil-Free Water Gel Moisturizer', 'Hyaluronic Acid, Amino Acids', 'Lightweight, non-comedogenic hydration.')
-    else:
-        kit['Moisturizer'] = ('Ceramide-Rich Repair Cream', 'Ceramides, Squalane, Cholesterol', 'Deep repair and moisture seal.')
-
-    # 4. Sun Protection (Mandatory & Enhanced)
-    kit['Sunscreen'] = ('Broad Spectrum Mineral SPF 50+', 'Zinc Oxide, Titanium Dioxide, Iron Oxides', 'Essential daily defense against UV and Blue Light.')
-
-    # 5. PM Treatment (The 'Heavy Lifter' - Most Conditional Step)
-    if any('Acne' in c for c in concerns) and score < 70:
-        kit['PM_Treatment'] = ('Benzoyl Peroxide Spot Treatment', 'Benzoyl Peroxide 5%', 'Aggressively targets inflammatory acne.')
-    elif 'Wrinkles' in concerns or 'Anti-Aging' in goal:
-        kit['PM_Treatment'] = ('Time-Release Retinaldehyde Cream', 'Retinaldehyde, Bakuchiol', 'Powerful anti-aging with minimized irritation.')
-    elif 'Sensitivity' in concerns or sensitivity == 'High/Reactive':
-        kit['PM_Treatment'] = ('Kojic Acid & Arbutin Mask (Weekly)', 'Alpha-Arbutin, Kojic Acid', 'Gentle brightening and barrier boost.')
-    else:
-        kit['PM_Treatment'] = ('PHA/BHA Gentle Exfoliator', 'PHA, Lactic Acid', 'Mild nightly resurfacing.')
-        
-    st.markdown("Based on your **profile**, **score**, and **goals**, here is your 5-step optimized kit:")
-    
-    kit_cols = st.columns(3)
-    
-    items = list(kit.items())
-    for i, (key, (product_name, ingredients, rationale)) in enumerate(items):
-        with kit_cols[i % 3]:
-            st.markdown(f"""
-            <div class="skinova-card" style="min-height: 250px; background-color: {LIGHT_BG};">
-                <h5 style='color:{SOFT_BLUE}; margin-bottom: 5px;'>{key.replace('_', ' ').upper()}</h5>
-                <p style='font-weight: bold; font-size: 18px;'>{product_name}</p>
-                <p style='font-size: 14px;'>**Key Ingredients:** {ingredients}</p>
-                <p style='font-size: 12px; font-style: italic; color: #777;'>**Rationale:** {rationale}</p>
-            </div>
-            """, unsafe_allow_html=True)
+    render_card_grid('kit', [
+        {'step': item['slot'].replace('_', ' ').upper(), 'product': f"{item['name']} ({item['price']})",
+         'ingredients': item['ingredients'],
+         'rationale': item['rationale'] + (" Above your per-product budget: nothing cheaper fits this step." if item['over_budget'] else "")}
+        for item in kit
+    ], num_cols=3)
+    if len(kit) < len(KIT_SLOTS):
+        st.warning("Some steps were left out because every matching product contains one of your listed allergens.")
             
     st.markdown("---")
     
     # Buy Now Section
     st.subheader("Ready to Check Out?")
-    st.markdown("This hyper-kit is valued at **$220 USD**. Get a bundle discount today.")
+    kit_value = sum(float(item['price'].replace('$', '')) for item in kit)
+    st.markdown(f"This hyper-kit is valued at **${kit_value:.0f} USD**. Get a bundle discount today.")
     affiliate_link = "#" # Dummy Link
     st.markdown(f"""
         <a href="{affiliate_link}" target="_blank">
             <button style="background-color: #FF4B4B; color: white; padding: 15px 30px; border: none; border-radius: 10px; cursor: pointer; font-size: 20px; font-weight: bold; margin-top: 10px;">
-                🛒 Secure Your 5-Piece Hyper-Kit Now for $199!
+                🛒 Secure Your {len(kit)}-Piece Hyper-Kit Now for ${kit_value * 0.9:.0f}!
             </button>
         </a>
     """, unsafe_allow_html=True)
@@ -1062,62 +5604,52 @@ def personalized_kit_page():
 ## 8. Skincare Academy (Comprehensive Learning Module)
 def skincare_academy_page():
     st.title("Skincare Academy: Hyper-Learning Module 🎓")
+    academy = get_academy_store(academy_content_signature())
+    st.caption(f"Content version {academy.version} · {len(academy.articles)} articles · "
+               f"{len(academy.videos)} videos · {len(academy.questions)} quiz questions")
     st.markdown("---")
-    
+
+    filter_cols = st.columns(2)
+    topic = filter_cols[0].selectbox("Topic", ['All Topics'] + academy.topics, key='academy_topic')
+    difficulty = filter_cols[1].selectbox("Difficulty", ('All Levels',) + ACADEMY_DIFFICULTIES, key='academy_difficulty')
+    topic = None if topic == 'All Topics' else topic
+    difficulty = None if difficulty == 'All Levels' else difficulty
+
     tab_vid, tab_art, tab_quiz = st.tabs(["📺 Deep-Dive Videos", "📚 Advanced Articles", "🧠 Certification Quiz"])
     
     with tab_vid:
         st.header("Video Tutorials: Beyond the Basics")
-        
-        col_v1, col_v2 = st.columns(2)
-        
-        with col_v1:
-            st.subheader("1. Decoding TEWL (Water Loss)")
-            st.components.v1.iframe("https://youtube.com/shorts/UJANPbD8eQg?si=5wGaUexK3-z_DFJy", height=250)
-            st.markdown("Understand Trans-Epidermal Water Loss and how to combat it with occlusives and humectants.")
-            
-        with col_v2:
-            st.subheader("2. Barrier Function & Ceramides")
-            st.components.v1.iframe("https://youtube.com/shorts/osaExOh7geI?si=gNGFZnyj-FmXIazG", height=250)
-            st.markdown("The science of skin barrier repair and the essential role of Ceramides and Essential Fatty Acids.")
-
-        st.subheader("3. P. Acnes, Sebum, and Inflammation")
-        st.components.v1.iframe("https://youtube.com/shorts/osaExOh7geI?si=cj1yyiAaBvgavbpI", height=250)
-        st.markdown("A deep dive into the complex pathogenesis of acne vulgaris and modern treatment modalities (BHA, BP, Azelaic Acid).")
+        videos = [video for video in academy.videos
+                  if topic in (None, video['topic']) and difficulty in (None, video['difficulty'])]
+        if not videos:
+            st.info("No videos match this topic and difficulty yet.")
+        video_cols = st.columns(2)
+        for i, video in enumerate(videos):
+            with video_cols[i % 2]:
+                st.subheader(f"{i + 1}. {video['title']}")
+                st.components.v1.iframe(video['url'], height=250)
+                st.markdown(video['summary'])
 
     with tab_art:
         st.header("Advanced Skincare Articles (Hyper-Content)")
         st.markdown("---")
-        st.subheader("Article 1: The 'Sandwich Method' for Retinoid Introduction")
-        st.markdown("""
-        **Technique:** Apply a thin layer of moisturizing cream, then the retinoid, and finish with another layer of moisturizer. 
-        **Rationale:** This buffers the retinoid, allowing for controlled, slow-release absorption, dramatically reducing the common side effects 
-        of redness, peeling, and irritation, making the ingredient accessible even for sensitive skin types.
-        """)
-        st.markdown("---")
-        st.subheader("Article 2: Niacinamide: Beyond Pore Size Reduction")
-        st.markdown("""
-        While known for its oil-regulating properties, Niacinamide's true hyper-power lies in its ability to **increase ceramide synthesis**
-        in the stratum corneum, effectively fortifying the skin's defense against pollutants and transepidermal water loss. This makes it a multi-functional hero for almost all skin conditions.
-        """)
-        st.markdown("---")
-        st.subheader("Article 3: The Importance of Post-Cleansing pH")
-        st.markdown("""
-        The skin's natural pH is slightly acidic (around 5.5). Using highly alkaline cleansers (pH 8+) can disrupt the **acid mantle**, 
-        leading to increased vulnerability to bacteria (like P. acnes) and environmental damage. Always choose a cleanser marketed as pH-balanced or low-pH.
-        """)
+        positions = academy.find_articles(topic, difficulty)
+        if not positions:
+            st.info("No articles match this topic and difficulty yet.")
+        else:
+            pages = (len(positions) - 1) // ACADEMY_ARTICLES_PER_PAGE + 1
+            page = st.number_input(f"Page (of {pages})", min_value=1, max_value=pages, value=1, key='academy_page') if pages > 1 else 1
+            start = (page - 1) * ACADEMY_ARTICLES_PER_PAGE
+            st.markdown(academy.render_articles(positions[start:start + ACADEMY_ARTICLES_PER_PAGE]))
 
     with tab_quiz:
-        st.header("Skinova Master Quiz (5 Questions)")
+        quiz_questions = academy.quizzes.get('master', [])
+        counters = get_quiz_counters()
+        st.header(f"Skinova Master Quiz ({len(quiz_questions)} Questions)")
         st.markdown("Answer correctly to receive a **+5 Skin Score bonus**!")
-        
-        quiz_questions = [
-            ("Which ingredient is a humectant and can hold up to 1000 times its weight in water?", ["Ceramides", "Hyaluronic Acid", "Retinoids", "Lactic Acid"], "Hyaluronic Acid"),
-            ("The skin's lipid barrier is primarily composed of:", ["Water, Salt, and Sugar", "Ceramides, Cholesterol, and Fatty Acids", "AHA, BHA, and PHA", "Melanin, Keratin, and Water"], "Ceramides, Cholesterol, and Fatty Acids"),
-            ("Which type of acid is oil-soluble and penetrates pores to dissolve sebum and dead skin?", ["Glycolic Acid (AHA)", "Salicylic Acid (BHA)", "Lactic Acid (AHA)"], "Salicylic Acid (BHA)"),
-            ("What is the maximum effective concentration of Niacinamide often recommended to avoid irritation?", ["25%", "5%", "15%", "1%"], "5%"),
-            ("Which UV ray is responsible for premature aging and penetrates deeper into the dermis?", ["UVB", "UVA"], "UVA")
-        ]
+        quiz_stats = counters.stats('master')
+        if quiz_stats['submissions']:
+            st.caption(f"{quiz_stats['submissions']} submissions so far · {quiz_stats['perfect_rate'] * 100:.0f}% perfect scores")
         
         # State to store answers and score
         if 'quiz_score' not in st.session_state:
@@ -1126,19 +5658,17 @@ def skincare_academy_page():
 
         with st.form("master_quiz_form"):
             user_answers = {}
-            for i, (q, options, _) in enumerate(quiz_questions):
-                user_answers[f'q{i+1}'] = st.radio(f"**{i+1}.** {q}", options, key=f"quiz_q{i+1}")
+            for i, question in enumerate(quiz_questions):
+                user_answers[f'q{i+1}'] = st.radio(f"**{i+1}.** {question['question']}", question['options'], key=f"quiz_q{i+1}")
             
             quiz_submitted = st.form_submit_button("Submit Master Quiz")
             
             if quiz_submitted:
-                final_score = 0
                 st.session_state.quiz_answers = user_answers
-                
-                for i, (_, _, correct_answer) in enumerate(quiz_questions):
-                    q_key = f'q{i+1}'
-                    if st.session_state.quiz_answers.get(q_key) == correct_answer:
-                        final_score += 1
+                outcomes = [(question['id'], st.session_state.quiz_answers.get(f'q{i+1}') == question['answer'])
+                            for i, question in enumerate(quiz_questions)]
+                counters.record('master', outcomes)
+                final_score = sum(correct for _, correct in outcomes)
 
                 st.session_state.quiz_score = final_score
                 
@@ -1164,23 +5694,22 @@ def skincare_academy_page():
                     st.error(f"Needs Improvement. Score: {final_score}. Review the academy and try again!")
                 
                 # Show Detailed Feedback
-                for i, (q, _, correct_answer) in enumerate(quiz_questions):
-                    q_key = f'q{i+1}'
-                    user_ans = st.session_state.quiz_answers.get(q_key)
-                    is_correct = user_ans == correct_answer
-                    feedback_icon = "✅" if is_correct else "❌"
-                    st.markdown(f"**{feedback_icon} Q{i+1}:** {q} | *Your Answer:* **{user_ans}** | *Correct:* **{correct_answer}**")
+                for i, question in enumerate(quiz_questions):
+                    user_ans = st.session_state.quiz_answers.get(f'q{i+1}')
+                    feedback_icon = "✅" if user_ans == question['answer'] else "❌"
+                    st.markdown(f"**{feedback_icon} Q{i+1}:** {question['question']} | *Your Answer:* **{user_ans}** | "
+                                f"*Correct:* **{question['answer']}** | *{counters.correct_rate(question['id']) * 100:.0f}% of learners got this right*")
 
 
 ### ---
 ## 9. Community Forum (Basic CRUD Simulation)
-def community_forum_page():
-    st.title("Community Forum: Connect & Share 💬")
-    st.markdown("---")
-    
+@fragment
+def forum_board():
+    """Post form plus the latest-posts list. Posting reruns only this fragment."""
     st.subheader("Post a Question for Peer Review")
     
-    with st.form("post_question_form"):
+    # clear_on_submit resets the inputs without a full-script rerun
+    with st.form("post_question_form", clear_on_submit=True):
         # Use unique keys to avoid conflict
         post_title = st.text_input("Title of your question (e.g., Retinol Purge - Day 5?)", max_chars=100, key="forum_title_input")
         post_content = st.text_area("Your full question/concern (Max 500 chars)", height=150, max_chars=500, key="forum_content_input")
@@ -1198,15 +5727,9 @@ def community_forum_page():
                     'Post_ID': random.getrandbits(32) # Simple unique ID
                 }
                 
-                st.session_state.forum_posts.append(new_post)
-                st.session_state.forum_posts.sort(key=lambda x: x['Timestamp'], reverse=True)
+                get_data_store().add_forum_post(new_post)
                 st.success("✅ Your question has been posted to the hyper-forum!")
                 
-                # Clear form inputs after successful submission
-                st.session_state["forum_title_input"] = ""
-                st.session_state["forum_content_input"] = ""
-                st.experimental_rerun()
-                
     st.markdown("---")
     
     st.subheader("🔥 Latest Community Questions")
@@ -1214,17 +5737,23 @@ def community_forum_page():
     if st.session_state.forum_posts:
         recent_posts = st.session_state.forum_posts[:8] # Show top 8 recent posts
         
-        for post in recent_posts:
-            # Use user_email or first part of email for display
-            display_user = post['User_Email'].split('@')[0]
-            with st.expander(f"**{post['Post_Title']}** - *Posted by {display_user} on {post['Timestamp'][:10]}*"):
-                st.markdown(f"**Concern:** {post['Post_Content']}")
-                st.markdown("---")
-                st.markdown(f"_Hyper-Simulation: Dummy Replies: {random.randint(2, 7)}, Last Activity: {random.choice(['Just Now', '1 hour ago', '4 hours ago'])}_")
+        render_card_grid('forum_post', [
+            {'title': post['Post_Title'], 'author': post['User_Email'].split('@')[0], # First part of email for display
+             'posted': post['Timestamp'][:10], 'content': post['Post_Content'],
+             'replies': random.randint(2, 7), 'activity': random.choice(['Just Now', '1 hour ago', '4 hours ago'])}
+            for post in recent_posts
+        ])
     else:
         st.info("No questions posted yet. Be the first to start the conversation!")
 
 
+def community_forum_page():
+    st.title("Community Forum: Connect & Share 💬")
+    st.markdown("---")
+    
+    forum_board()
+
+
 ### ---
 ## 10. Consult an Expert (Enhanced Form)
 def consult_expert_page():
@@ -1236,6 +5765,13 @@ def consult_expert_page():
 
     user_data = st.session_state.user_data_profile
 
+    # Outside the form so the upload can be spilled to disk (and the widget reset) as soon as it arrives
+    st.markdown("### Optional: Provide Visual Context")
+    attachment = spilled_uploader("Upload a high-res image of the area (Optional)", 'consult_attachment',
+                                  subdir='consult-attachments', type=["jpg", "jpeg", "png"])
+    if attachment is not None:
+        st.caption(f"📎 **{attachment['name']}** ({attachment['size'] / 1024:.0f} KB) will be sent with your request.")
+
     with st.form("consult_form"):
         st.markdown("### Your Details")
         con_name = st.text_input("Your Full Name", value=user_data.get('Name', ''), disabled=True)
@@ -1245,23 +5781,24 @@ def consult_expert_page():
         
         col_type, col_time = st.columns(2)
         with col_type:
-            concern_type = st.selectbox("Type of Consultation", ['Routine Review & Optimization (30 min)', 'Advanced Acne Management (45 min)', 'Deep Anti-Aging Strategies (60 min)', 'Product Allergy & Patch Test Guidance (30 min)'])
+            concern_type = st.selectbox("Type of Consultation", CONSULT_TYPES)
         with col_time:
             preferred_slot = st.selectbox("Preferred Time Slot (Simulated Availability)", 
                                           [f"Tomorrow, {t}:00 PM" for t in [10, 11, 2, 3, 5]])
 
         con_concern = st.text_area("Describe your concern/question in detail (Max 800 chars)", height=200, max_chars=800)
         
-        st.markdown("### Optional: Provide Visual Context")
-        uploaded_image = st.file_uploader("Upload a high-res image of the area (Optional)", type=["jpg", "jpeg", "png"])
-        
         consult_submitted = st.form_submit_button("Submit Consultation Request")
 
         if consult_submitted:
             if not con_concern:
                 st.warning("Please describe your concern.")
             else:
-                image_status = "Image attached" if uploaded_image else "No image attached"
+                # The request takes over the spilled file; it is removed once the request is closed
+                with session_heavy_state() as heavy:
+                    attachment = heavy.take('consult_attachment')
+                image_status = "Image attached" if attachment else "No image attached"
+                image_file = attachment['spill_path'] if attachment else None
                 
                 new_consult = {
                     'Name': con_name,
@@ -1270,11 +5807,17 @@ def consult_expert_page():
                     'Consult_Type': concern_type,
                     'Concern_Detail': con_concern,
                     'Image_Status': image_status,
+                    'Image_File': image_file,
                     'Preferred_Slot': preferred_slot,
                     'Status': 'Pending Review'
                 }
                 
-                st.session_state.consult_requests.append(new_consult)
+                get_data_store().add_consult_request(new_consult)
+                get_notification_outbox().enqueue(
+                    'consult_confirmation', con_email, f"SkinovaAI consult request received: {concern_type.split('(')[0].strip()}",
+                    f"Hi {con_name},\n\nWe received your consultation request ({concern_type}). We will confirm your "
+                    f"{preferred_slot} slot and send a secure video link to this address within 4 hours.\n\n- The Skinova Expert Team",
+                    dedupe_key=f"consult:{con_email}:{new_consult['Timestamp']}")
                 
                 st.success("✅ Your consultation request has been submitted!")
                 st.markdown(f"""
@@ -1287,15 +5830,468 @@ def consult_expert_page():
                 """, unsafe_allow_html=True)
 
 
+### ---
+## 11. Data Backup & Migration (Streaming NDJSON)
+def data_backup_page():
+    st.title("Data Backup & Migration 💾")
+    st.markdown("---")
+    # Exports cover every account and imports overwrite them, so this page is operator-only
+    if not staff_gate('operator', "Data Backup"):
+        return
+
+    st.subheader("Export the Full Database")
+    st.markdown("Users, score history, routine progress, forum posts and consults are streamed row by row as **NDJSON**.")
+    compress = st.checkbox("Gzip-compress the export (.ndjson.gz)", value=True)
+
+    if st.button("📦 Build Export File"):
+        with admission('export') as admitted:
+            if admitted:
+                suffix = '.ndjson.gz' if compress else '.ndjson'
+                export_dir = os.path.join(SESSION_SPILL_DIR, 'exports')
+                os.makedirs(export_dir, exist_ok=True)
+                with tempfile.NamedTemporaryFile(dir=export_dir, prefix='skinova-export-', suffix=suffix, delete=False) as tmp:
+                    export_path = tmp.name
+                with st.spinner("Streaming records to disk..."):
+                    rows = export_database(export_path, st.session_state.user_db, st.session_state.forum_posts,
+                                           st.session_state.consult_requests, compress=compress)
+                # A spill handle: the file goes with the next export, logout or session expiry
+                with session_heavy_state() as heavy:
+                    heavy.put('export', {'spill_path': export_path, 'name': os.path.basename(export_path),
+                                         'size': os.path.getsize(export_path), 'rows': rows}, size=0)
+
+    with session_heavy_state() as heavy:
+        export = heavy.get('export')
+    if export and os.path.exists(export['spill_path']):
+        st.success(f"✅ Exported {export['rows']} rows ({export['size'] / 1024:.1f} KB).")
+        with open(export['spill_path'], 'rb') as export_file:
+            st.download_button("⬇️ Download Export", export_file, file_name=export['name'])
+
+    st.markdown("---")
+    st.subheader("Import an Export File")
+    st.markdown("Rows are validated and committed in batches of "
+                f"**{IMPORT_BATCH_ROWS}**. Existing users with the same email are overwritten.")
+    import_file = st.file_uploader("Upload a .ndjson or .ndjson.gz export", type=["ndjson", "gz", "jsonl"])
+
+    if import_file is not None and st.button("📥 Run Import"):
+        with admission('export') as admitted:
+            if admitted:
+                progress_text = st.empty()
+                store = get_data_store()
+                with store.lock:
+                    report = import_ndjson(import_file, store.user_db, store.forum_posts, store.consult_requests,
+                                           on_progress=lambda rows_read: progress_text.markdown(f"_Processed {rows_read} rows..._"))
+                progress_text.empty()
+                store.notify_bulk_change()
+                if store.journal is not None:
+                    # Imports bypass the event log, so snapshot right away to make them durable
+                    store.checkpoint()
+                st.success(f"✅ Imported {report['imported']} rows. Rejected {report['rejected']}.")
+                if report['errors']:
+                    with st.expander("Rejected rows (first errors)"):
+                        for error in report['errors']:
+                            st.markdown(f"• {error}")
+
+    st.markdown("---")
+    st.subheader("Profile Cache Metrics")
+    cache_stats = get_profile_cache().stats()
+    metric_cols = st.columns(4)
+    metric_cols[0].metric("Hit Rate", f"{cache_stats['hit_rate'] * 100:.1f}%")
+    metric_cols[1].metric("Cached Entries", cache_stats['entries'])
+    metric_cols[2].metric("Evictions (LRU / TTL)", f"{cache_stats['evictions']} / {cache_stats['expirations']}")
+    metric_cols[3].metric("Invalidations", cache_stats['invalidations'])
+
+    st.subheader("Admission Control (Heavy Operations)")
+    admission_stats = get_admission_controller().stats()
+    admission_cols = st.columns(4)
+    admission_cols[0].metric("Capacity In Use", f"{admission_stats['in_use']} / {admission_stats['capacity']}")
+    admission_cols[1].metric("Queued", admission_stats['queued'])
+    admission_cols[2].metric("Admitted", admission_stats['admitted'])
+    admission_cols[3].metric("Rejected / Timed Out", f"{admission_stats['rejected']} / {admission_stats['timed_out']}")
+
+    st.subheader("Kit Recommender")
+    rules_hash = kit_rules_hash()
+    recommender = get_kit_recommender(rules_hash)
+    if st.button("🎁 Precompute Kits for All Users", help="Score every onboarded profile in batched matrix products"):
+        with admission('export') as admitted:
+            if admitted:
+                recommender.precompute(st.session_state.user_db)
+    kit_stats = recommender.stats()
+    kit_cols = st.columns(3)
+    kit_cols[0].metric("Cached Profile Signatures", kit_stats['entries'])
+    kit_cols[1].metric("Cache Hit Rate", f"{kit_stats['hit_rate'] * 100:.1f}%")
+    if kit_stats['last_batch']:
+        kit_cols[2].metric("Last Batch", f"{kit_stats['last_batch']['signatures']} in {kit_stats['last_batch']['seconds']:.2f}s",
+                           help=f"Finished {kit_stats['last_batch']['finished_at']}")
+    table_stats = get_kit_segment_table(rules_hash).stats()
+    table_cols = st.columns(3)
+    table_cols[0].metric("Segment Table", f"{table_stats['segments']:,} kits" if table_stats['ready']
+                         else ("Building..." if table_stats['building'] else "Not built"), help=f"Rules version {rules_hash}")
+    table_cols[1].metric("Table Hit Rate", f"{table_stats['hit_rate'] * 100:.1f}%",
+                         help="Kit renders served by one table row (the rest are scored on demand)")
+    if table_stats['build_seconds'] is not None:
+        table_cols[2].metric("Last Table Build", f"{table_stats['build_seconds']:.1f}s")
+
+    st.subheader("Analyzer Latency (Progressive Scans)")
+    timing_stats = get_scan_timings().stats()
+    timing_cols = st.columns(3)
+    timing_cols[0].metric("Scans Sampled", timing_stats['scans'])
+    if timing_stats['scans']:
+        timing_cols[1].metric("Time to Preview (p50 / p95)", f"{timing_stats['first_p50'] * 1000:.0f} / {timing_stats['first_p95'] * 1000:.0f} ms")
+        timing_cols[2].metric("Time to Final (p50 / p95)", f"{timing_stats['final_p50']:.2f} / {timing_stats['final_p95']:.2f} s")
+
+    st.subheader("Notification Outbox")
+    outbox_stats = get_notification_outbox().stats()
+    outbox_cols = st.columns(4)
+    outbox_cols[0].metric("Pending", outbox_stats['pending'])
+    outbox_cols[1].metric("In Flight", outbox_stats['sending'])
+    outbox_cols[2].metric("Delivered", outbox_stats['sent'])
+    outbox_cols[3].metric("Dead (Gave Up)", outbox_stats['dead'])
+    if get_notification_outbox().transport is None:
+        st.caption(f"No mail transport is configured, so messages stay pending. Set `{SMTP_HOST_ENV}` for delivery "
+                   f"(or `{SMTP_STANDIN_ENV}=1` for the local stand-in in development).")
+
+    st.subheader("Session Traces (Record & Replay)")
+    if not SESSION_RECORD_DIR:
+        st.caption(f"Recording is off. Set `{RECORD_DIR_ENV}` to a directory to record every session as a replayable trace.")
+    else:
+        traces = sorted(entry for entry in os.listdir(SESSION_RECORD_DIR) if entry.endswith('.ndjson')) if os.path.isdir(SESSION_RECORD_DIR) else []
+        trace_cols = st.columns(2)
+        trace_cols[0].metric("Recorded Sessions", len(traces))
+        trace_cols[1].metric("This Session", f"{st.session_state.get('session_trace', {}).get('step', 0)} runs")
+        if traces:
+            latest = os.path.join(SESSION_RECORD_DIR, traces[-1])
+            st.caption(f"Replay headlessly with per-step latency and state diffs: `python app.py --replay {latest}`")
+
+
+### ---
+## 12. Cohort Analytics (Population-Level Insight)
+def cohort_analytics_page():
+    st.title("Cohort Analytics: Population Insight 🌍")
+    st.markdown("---")
+
+    # A full rebuild walks every user, so only an operator session may start one
+    force_rebuild = has_staff_access('operator') and st.button("🔄 Full Rebuild (Vectorized)",
+                                                               help="Recompute every aggregate from the full user DB")
+    aggregates = get_cohort_aggregates(force_rebuild=force_rebuild)
+    summary = aggregates.summary()
+
+    if summary['users'] == 0:
+        st.info("No onboarded users yet. Cohort insight appears once profiles are completed.")
+        return
+
+    kpi_cols = st.columns(4)
+    kpi_cols[0].metric("Onboarded Users", f"{summary['users']:,}")
+    kpi_cols[1].metric("Avg Skin Score", f"{summary['avg_score']:.1f}")
+    kpi_cols[2].metric("Avg Compliance (Today)", f"{summary['avg_compliance'] * 100:.0f}%")
+    kpi_cols[3].metric(f"≥{int(COMPLIANT_THRESHOLD * 100)}% Compliant Today", f"{summary['compliant_share'] * 100:.0f}%")
+
+    st.caption(f"Aggregates update incrementally on every save. Last full rebuild: {aggregates.rebuilt_at} "
+               f"({aggregates.rebuild_seconds * 1000:.0f} ms).")
+    st.markdown("---")
+
+    dimension_tabs = st.tabs([f"By {dimension.replace('_', ' ')}" for dimension in COHORT_DIMENSIONS])
+    for tab, dimension in zip(dimension_tabs, COHORT_DIMENSIONS):
+        with tab:
+            frame = aggregates.by_dimension(dimension)
+            st.bar_chart(frame['Avg Skin Score'])
+            st.dataframe(frame.style.format({'Avg Skin Score': '{:.1f}', 'Avg Compliance': '{:.0%}'}))
+
+    st.markdown("## Streak Distribution 🔥")
+    st.bar_chart(aggregates.streak_distribution())
+
+
+### ---
+## 13. What-If Simulator (Monte Carlo Habit Explorer)
+@fragment
+def what_if_explorer():
+    """Habit sliders plus the simulated score bands. Dragging a slider reruns only this fragment."""
+    with session_heavy_state() as heavy:
+        baseline = heavy.get('analyzer_inputs') or {}
+    col_habits, col_chart = st.columns([1, 2])
+
+    with col_habits:
+        st.markdown("#### **Habits to Test**")
+        compliance = st.slider("Routine completion (% of days)", 0, 100, 80, 5, key="sim_compliance") / 100
+        q_inputs = {
+            'stress_level': st.slider("Stress Level (1=Low, 10=High)", 1, 10, baseline.get('stress_level', 5), key="sim_stress"),
+            'water_intake': st.slider("Daily Water Intake (Liters)", 0.5, 4.0, float(baseline.get('water_intake', 2.0)), 0.5, key="sim_water"),
+            'sleep_quality': st.select_slider("Sleep Quality", options=['Poor', 'Average', 'Good', 'Excellent'],
+                                              value=baseline.get('sleep_quality', 'Average'), key="sim_sleep"),
+            'diet_type': st.selectbox("Diet", SIM_DIET_OPTIONS,
+                                      index=SIM_DIET_OPTIONS.index(baseline.get('diet_type', SIM_DIET_OPTIONS[0])), key="sim_diet"),
+            'gut_health': st.selectbox("Gut Health", SIM_GUT_OPTIONS,
+                                       index=SIM_GUT_OPTIONS.index(baseline.get('gut_health', SIM_GUT_OPTIONS[0])), key="sim_gut"),
+            'sun_exposure': st.slider("Daily Sun Exposure (Minutes, without SPF)", 0, 120, baseline.get('sun_exposure', 15), key="sim_sun"),
+            'flushing': st.selectbox("Flushing", SIM_FLUSHING_OPTIONS,
+                                     index=SIM_FLUSHING_OPTIONS.index(baseline.get('flushing', SIM_FLUSHING_OPTIONS[0])), key="sim_flushing"),
+        }
+        risk_score = compute_internal_risk_score(q_inputs)
+        st.caption(f"Internal risk points: **{risk_score}**" + ("" if baseline else " (run the Hyper-Analyzer to prefill your own habits)"))
+
+    with col_chart, admission('chart', max_wait=2.0) as admitted:
+        if not admitted:
+            return
+        started = time.perf_counter()
+        paths = simulate_score_trajectories(st.session_state.skin_score, risk_score, compliance)
+        result = summarize_trajectories(paths)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        bands = result['bands']
+        days = np.arange(SIM_DAYS + 1)
+        fig, ax = plt.subplots(figsize=(10, 5))
+        ax.fill_between(days, bands[10], bands[90], color=SOFT_BLUE, alpha=0.15, label='10th-90th Percentile')
+        ax.fill_between(days, bands[25], bands[75], color=SOFT_BLUE, alpha=0.3, label='25th-75th Percentile')
+        ax.plot(days, bands[50], color=SOFT_BLUE, linewidth=3, label='Median Trajectory')
+        ax.axhline(90, color='red', linestyle=':', alpha=0.7, label='Target Score (90)')
+        ax.set_title(f'{SIM_DAYS}-Day Outlook ({SIM_TRAJECTORIES:,} Simulations)', fontsize=16, fontweight='bold', color=TEXT_COLOR)
+        ax.set_xlabel('Day', fontsize=12)
+        ax.set_ylabel('Skin Score (50-100)', fontsize=12)
+        ax.set_ylim(50, 100)
+        ax.legend(loc='lower right')
+        ax.grid(axis='y', linestyle='--', alpha=0.5)
+        st.pyplot(fig)
+        plt.close(fig)
+
+        kpi_cols = st.columns(3)
+        kpi_cols[0].metric(f"Median Score (Day {SIM_DAYS})", f"{result['median_final']:.1f}",
+                           delta=f"{result['median_final'] - st.session_state.skin_score:+.1f}")
+        kpi_cols[1].metric("Chance of Reaching 90", f"{result['target_probability'] * 100:.0f}%")
+        kpi_cols[2].metric("Simulation Time", f"{elapsed_ms:.0f} ms")
+
+
+def what_if_simulator_page():
+    st.title("What-If Simulator: Explore Your Habits 🧪")
+    st.markdown("Change a habit and see how the range of likely skin-score outcomes shifts over the next 90 days.")
+    st.markdown("---")
+
+    what_if_explorer()
+
+
+### ---
+## 14. Leaderboard (Community Streak & Score Rankings)
+def public_name(user):
+    """What other users see of someone: first name and last initial, never the email."""
+    parts = (user.get('Name') or '').split()
+    if not parts:
+        return "Anonymous member"
+    return parts[0] + (f" {parts[-1][0]}." if len(parts) > 1 else "")
+
+def leaderboard_page():
+    st.title("Leaderboard: How Do You Compare? 🏆")
+    st.markdown("---")
+
+    email = st.session_state.user_email
+    get_write_buffer().flush(email) # Rank against your latest committed streak/score
+    leaderboard = get_leaderboard()
+
+    col_metric, col_segment = st.columns(2)
+    with col_metric:
+        metric = st.radio("Rank by", LEADERBOARD_METRICS, horizontal=True, key="leaderboard_metric")
+    with col_segment:
+        segment_labels = {None: "Whole community", 'Skin_Type': "My skin type", 'Location': "My location"}
+        dimension = st.selectbox("Compare against", list(segment_labels), format_func=segment_labels.get, key="leaderboard_segment")
+
+    standing = leaderboard.rank(metric, email, dimension)
+    if standing is None:
+        st.info("Complete onboarding to join the leaderboard.")
+        return
+
+    rank, population, value = standing
+    segment_value = st.session_state.user_data_profile.get(dimension) if dimension else None
+    kpi_cols = st.columns(3)
+    kpi_cols[0].metric("Your Rank", f"#{rank}", help=f"Among {population:,} users" + (f" ({segment_value})" if segment_value else ""))
+    kpi_cols[1].metric(f"Your {metric}", value)
+    kpi_cols[2].metric("Top", f"{rank / population * 100:.0f}%")
+
+    st.subheader(f"Top {LEADERBOARD_TOP_K} by {metric}" + (f" - {segment_value}" if segment_value else ""))
+    leaders = leaderboard.top(metric, email, dimension)
+    user_db = st.session_state.user_db
+    frame = pd.DataFrame([(f"#{position}", public_name(user_db.get(member) or {}) + (" (you)" if member == email else ""), score)
+                          for position, member, score in leaders], columns=['Rank', 'User', metric])
+    st.dataframe(frame, hide_index=True, use_container_width=True)
+
+
+## 15. Scan History (Before/After Comparison)
+@fragment
+def scan_comparison(history):
+    """Before/after picker and the indicator diff table, isolated as a fragment (reads cached arrays only)."""
+    labels = [f"#{i + 1} · {at[:16]} · {mode}" for i, (at, mode) in enumerate(zip(history['at'], history['mode']))]
+    col_before, col_after = st.columns(2)
+    with col_before:
+        before = st.selectbox("Before", range(len(labels)), index=0, format_func=labels.__getitem__, key="scan_before")
+    with col_after:
+        after = st.selectbox("After", range(len(labels)), index=len(labels) - 1, format_func=labels.__getitem__, key="scan_after")
+
+    rows = []
+    for column, (name, options) in enumerate(ANALYZER_INDICATORS.items()):
+        old_level, new_level = int(history['levels'][before, column]), int(history['levels'][after, column])
+        trend = "➖ Same" if new_level == old_level else ("🟢 Better" if new_level < old_level else "🔴 Worse")
+        rows.append({'Indicator': name.split('(')[0].strip(), 'Before': options[old_level], 'After': options[new_level], 'Change': trend})
+    st.dataframe(pd.DataFrame(rows), hide_index=True, use_container_width=True)
+
+    similarity = float(history['vectors'][before] @ history['vectors'][after])
+    risk_change = int(history['risk'][after]) - int(history['risk'][before])
+    kpi_cols = st.columns(3)
+    kpi_cols[0].metric("Overall Scan Similarity", f"{similarity * 100:.0f}%")
+    kpi_cols[1].metric("Internal Risk Score", int(history['risk'][after]), delta=risk_change, delta_color="inverse")
+    improved = int((history['levels'][after] < history['levels'][before]).sum())
+    kpi_cols[2].metric("Indicators Improved", f"{improved} / {len(ANALYZER_INDICATORS)}")
+    if before != after and hash_distance(history['hash'][before], history['hash'][after]) <= SCAN_SAME_PHOTO_BITS:
+        st.warning("These two scans appear to use the same photo, so differences come from the scan mode or questionnaire rather than your skin.")
+
+def scan_history_page():
+    st.title("Scan History: Before & After 🕰️")
+    st.markdown("---")
+
+    history = get_scan_history(st.session_state.user_email)
+    if len(history['at']) == 0:
+        st.info("No scans yet. Run a Deep Scan in the Skin Analyzer to start your history.")
+        return
+
+    st.subheader(f"Trends Across {len(history['at'])} Scans")
+    st.markdown("Severity level per indicator (0 = best). Lower is better.")
+    trend_frame = pd.DataFrame(history['levels'], columns=[name.split('(')[0].strip() for name in ANALYZER_INDICATORS],
+                               index=pd.to_datetime(history['at']))
+    st.line_chart(trend_frame)
+    measured = ~np.isnan(history['metrics'][:, 0])
+    if measured.any():
+        st.markdown("Measured image metrics (tiled and progressive scans only):")
+        st.line_chart(pd.DataFrame(history['metrics'][measured] * 100, columns=list(TILE_METRICS),
+                                   index=pd.to_datetime([at for at, keep in zip(history['at'], measured) if keep])))
+
+    st.markdown("---")
+    st.subheader("Compare Two Scans")
+    scan_comparison(history)
+
+
+### ---
+## 16. Expert Console (Indexed Consult Queue)
+def consult_console_filters():
+    """Positions matching the console's filter widgets (also used by the bulk-action callback)."""
+    window = st.session_state.get('consult_dates') or ()
+    since, until = (window[0], window[-1]) if window else (None, None)
+    return get_consult_index().query(types=st.session_state.get('consult_types', []),
+                                     statuses=st.session_state.get('consult_statuses', []),
+                                     since=since, until=until,
+                                     newest_first=st.session_state.get('consult_sort', 'Newest first') == 'Newest first')
+
+def on_consult_bulk_action():
+    """Bulk form callback: runs before the rerun renders, so the table already shows the new statuses."""
+    # Re-checked here: the form may have been rendered before access was revoked (logout, token rotated)
+    if not has_expert_access():
+        st.session_state.consult_flash = ('error', "You are not authorized to change consult requests.")
+        return
+    target = st.session_state.consult_target
+    if st.session_state.consult_scope == 'All matching requests':
+        positions = consult_console_filters()
+    else:
+        positions = np.array(st.session_state.consult_selected, dtype=np.int64)
+    if not len(positions):
+        st.session_state.consult_flash = ('warning', "No requests selected.")
+        return
+    moved, skipped = transition_consults(positions, target)
+    message = f"Moved {moved} request(s) to **{target}**."
+    if skipped:
+        message += f" Skipped {skipped} whose status cannot move to {target}."
+    st.session_state.consult_flash = ('success' if moved else 'warning', message)
+
+def expert_console_page():
+    st.title("Expert Console: Consult Queue 🩺")
+    st.markdown("---")
+    if not is_expert(st.session_state.user_email):
+        st.warning(f"The consult queue is only available to expert accounts (set `{EXPERT_EMAILS_ENV}`).")
+        return
+    # Login is by email alone, so the allow-list is not enough: the session must also hold the expert token
+    if not staff_gate('expert', "Expert Console"):
+        return
+    # The queue lives in the data store: a session-only store holds just this session's own requests
+    if get_data_store().session_only:
+        st.info(f"The consult queue needs shared storage. Set `{DATA_DIR_ENV}` (one server process) or "
+                f"`{SHARED_DB_ENV}` (several replicas) so requests from every user reach the console.")
+        return
+
+    index = get_consult_index()
+    counts = index.status_counts()
+    count_cols = st.columns(len(counts))
+    for col, (status, count) in zip(count_cols, counts.items()):
+        col.metric(status, count)
+
+    filter_cols = st.columns([3, 3, 2, 2])
+    filter_cols[0].multiselect("Consultation Type", index.types, key='consult_types')
+    filter_cols[1].multiselect("Status", index.statuses, default=[CONSULT_STATUSES[0]], key='consult_statuses')
+    filter_cols[2].date_input("Submitted Between", value=(), key='consult_dates')
+    filter_cols[3].radio("Sort", ['Newest first', 'Oldest first'], key='consult_sort')
+
+    started = time.perf_counter()
+    positions = consult_console_filters()
+    st.caption(f"{len(positions)} matching requests (filtered in {(time.perf_counter() - started) * 1000:.1f} ms)")
+
+    flash = st.session_state.pop('consult_flash', None)
+    if flash:
+        getattr(st, flash[0])(flash[1])
+
+    if len(positions):
+        pages = (len(positions) - 1) // CONSULT_PAGE_SIZE + 1
+        page = st.number_input(f"Page (of {pages})", min_value=1, max_value=pages, value=1, key='consult_page') if pages > 1 else 1
+        page_positions = positions[(page - 1) * CONSULT_PAGE_SIZE:page * CONSULT_PAGE_SIZE]
+        # Only the visible page is read back from the log
+        rows, labels = [], {}
+        for position in page_positions.tolist():
+            consult = st.session_state.consult_requests[position]
+            rows.append({'#': position + 1, 'Submitted': consult.get('Timestamp'), 'Name': consult.get('Name'),
+                         'Email': consult.get('Email'), 'Type': consult.get('Consult_Type'), 'Status': consult.get('Status'),
+                         'Slot': consult.get('Preferred_Slot'), 'Image': consult.get('Image_Status')})
+            labels[position] = f"#{position + 1} · {consult.get('Name', '')} · {consult.get('Consult_Type', '').split('(')[0].strip()}"
+        st.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)
+    else:
+        labels = {}
+        st.info("No consult requests match these filters.")
+
+    st.subheader("Bulk Status Change")
+    with st.form("consult_bulk_form"):
+        st.multiselect("Requests on this page", list(labels), format_func=labels.__getitem__, key='consult_selected')
+        action_cols = st.columns(2)
+        action_cols[0].radio("Apply to", ['Selected requests', 'All matching requests'], key='consult_scope')
+        action_cols[1].selectbox("New Status", CONSULT_STATUSES[1:], key='consult_target')
+        st.caption("Only allowed moves are applied: " + "; ".join(
+            f"{source} → {', '.join(targets)}" for source, targets in CONSULT_STATUS_TRANSITIONS.items()))
+        st.form_submit_button("Apply Status Change", on_click=on_consult_bulk_action)
+
+
 # --- 7. MAIN APP ROUTER ---
 
+PAGE_RENDERERS = {
+    'Login/Signup': login_signup_page,
+    'Onboarding': onboarding_page,
+    'Dashboard': dashboard_page,
+    'My Routine': my_routine_page,
+    'Skin Analyzer': skin_analyzer_page,
+    'Personalized Kit': personalized_kit_page,
+    'Product Marketplace': product_marketplace_page,
+    'Skincare Academy': skincare_academy_page,
+    'Community Forum': community_forum_page,
+    'Consult an Expert': consult_expert_page,
+    'Cohort Analytics': cohort_analytics_page,
+    'What-If Simulator': what_if_simulator_page,
+    'Leaderboard': leaderboard_page,
+    'Scan History': scan_history_page,
+    'Expert Console': expert_console_page,
+    'Data Backup': data_backup_page
+}
+
+# Session trace: the interaction that triggered this run, read before any widget renders
+trace_changes = open_session_step() if SESSION_RECORD_DIR else None
+
+# Apply every queued auth/navigation transition before rendering anything
+apply_pending_transitions()
+
 # Sidebar Navigation (Always Visible)
 with st.sidebar:
     st.markdown(f"""
     <div style="text-align: center; padding: 20px 0;">
         <h2 style="color: white; margin: 0;">SKINOVAAI (V2)</h2>
         <p style="color: #FFFFFF90; font-size: 14px;">SESSION-BASED HYPER-PLATFORM</p>
-        <p style="color: #FFD700; font-size: 12px; font-weight: bold;">(Data is saved only during this session)</p>
+        <p style="color: #FFD700; font-size: 12px; font-weight: bold;">{get_data_store().storage_note}</p>
     </div>
     <hr style="border-top: 1px solid #FFFFFF50;"/>
     """, unsafe_allow_html=True)
@@ -1305,61 +6301,34 @@ with st.sidebar:
         st.markdown(f"**Score:** {st.session_state.skin_score} | **Streak:** {st.session_state.routine_streak} days 🔥", unsafe_allow_html=True)
         st.markdown("---")
         
-        pages = {
-            'Dashboard': '📊 Dashboard',
-            'My Routine': '✅ My Daily Ritual',
-            'Skin Analyzer': '🔬 Hyper-Analyzer',
-            'Personalized Kit': '🎁 Personalized Kit',
-            'Product Marketplace': '🛍️ Marketplace',
-            'Skincare Academy': '👩‍🎓 Skincare Academy',
-            'Community Forum': '💬 Community Forum',
-            'Consult an Expert': '👩‍⚕️ Consult an Expert'
-        }
-        
         if not st.session_state.onboarding_complete:
             st.warning("⚠️ Complete Onboarding!")
-            selected_page = 'Onboarding'
         else:
-            selected_page = st.radio(
+            # The radio only queues a transition; its value is kept in sync by apply_pending_transitions()
+            st.radio(
                 "Navigation Menu", 
-                options=list(pages.keys()), 
-                format_func=lambda x: pages[x],
-                index=list(pages.keys()).index(st.session_state.current_page) if st.session_state.current_page in pages else 0
+                options=list(NAV_PAGES.keys()), 
+                format_func=lambda x: NAV_PAGES[x],
+                key='nav_choice',
+                on_change=on_nav_change
             )
         
-        navigate_to(selected_page)
-        
         st.markdown("---")
-        if st.button("🚪 Logout & Reset Session", help="Log out of the application"):
-            logout()
+        st.button("🚪 Logout & Reset Session", help="Log out of the application", on_click=logout)
             
     else:
         st.info("Please Login or Signup to access the Hyper-Platform.")
-        if st.button("Start My Journey"):
-            navigate_to('Login/Signup')
+        st.button("Start My Journey", on_click=navigate_to, args=('Login/Signup',))
 
 
 # Main Content Display (Router Logic)
-if st.session_state.logged_in:
-    if not st.session_state.onboarding_complete and st.session_state.current_page != 'Onboarding':
-        onboarding_page() # Force redirect to onboarding
-    elif st.session_state.current_page == 'Onboarding':
-        onboarding_page()
-    elif st.session_state.current_page == 'Dashboard':
-        dashboard_page()
-    elif st.session_state.current_page == 'My Routine':
-        my_routine_page()
-    elif st.session_state.current_page == 'Skin Analyzer':
-        skin_analyzer_page()
-    elif st.session_state.current_page == 'Personalized Kit':
-        personalized_kit_page()
-    elif st.session_state.current_page == 'Product Marketplace':
-        product_marketplace_page()
-    elif st.session_state.current_page == 'Skincare Academy':
-        skincare_academy_page()
-    elif st.session_state.current_page == 'Community Forum':
-        community_forum_page()
-    elif st.session_state.current_page == 'Consult an Expert':
-        consult_expert_page()
-else:
-    login_signup_page()
+try:
+    PAGE_RENDERERS[st.session_state.current_page]()
+finally:
+    # Also runs when a page reruns or stops early, so every run lands in the session trace
+    if SESSION_RECORD_DIR:
+        close_session_step(SCRIPT_RUN_STARTED, trace_changes)
+
+# Commit staged writes that have waited long enough (fragment reruns commit from save_user_data)
+if get_write_buffer().is_due():
+    get_write_buffer().flush()
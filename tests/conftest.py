@@ -0,0 +1,179 @@
+"""Shared AppTest fixtures: a fresh app session, a script-run recorder and the signup/onboarding flow."""
+
+import importlib.util
+import os
+import time
+import uuid
+
+import pytest
+from streamlit import delta_generator
+from streamlit.runtime.fragment import MemoryFragmentStorage
+from streamlit.runtime.scriptrunner import script_runner
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.testing.v1 import AppTest, app_test, local_script_runner
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app.py')
+APP_TIMEOUT = 60
+BENCHMARK_RESULTS = []   # (interaction, kind, median wall ms, median CPU ms), printed after the run
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'benchmark: per-interaction latency benchmark (run with -m benchmark)')
+
+
+def pytest_terminal_summary(terminalreporter):
+    if BENCHMARK_RESULTS:
+        terminalreporter.section('interaction benchmark (median per click)')
+        for interaction, kind, wall_ms, cpu_ms in BENCHMARK_RESULTS:
+            terminalreporter.write_line(f"{interaction:<28} {kind:<9} {wall_ms:8.1f} ms wall {cpu_ms:8.1f} ms CPU")
+
+
+class ScriptRunLog:
+    """Every script execution in the session: ('full' | 'fragment', wall seconds, CPU seconds of the script thread)."""
+
+    def __init__(self):
+        self.runs = []
+
+    def clear(self):
+        self.runs.clear()
+
+    def count(self, kind='full'):
+        return sum(1 for run in self.runs if run[0] == kind)
+
+    def last(self):
+        return self.runs[-1]
+
+
+class RepaintingScriptRunner(local_script_runner.LocalScriptRunner):
+    """Keeps only the elements of the latest full pass, as the browser does.
+
+    AppTest's message queue coalesces deltas by position across the st.rerun() passes of one
+    run, so elements the last pass no longer draws (e.g. the onboarding form) would stay in
+    the tree. Fragment passes patch the page and keep it."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        def clear_on_full_pass(sender, event, **event_kwargs):
+            if event == script_runner.ScriptRunnerEvent.SCRIPT_STARTED and not event_kwargs.get('fragment_ids_this_run'):
+                self.forward_msg_queue.clear()
+
+        self.on_event.connect(clear_on_full_pass, weak=False)
+
+
+def open_app(monkeypatch, **env):
+    """Starts a logged-out app session. Storage and recording are off unless set through `env`
+    (e.g. SKINOVA_DATA_DIR=...); the session binds its data store on this first run.
+
+    The compiled script is kept across runs, as the server does; AppTest would recompile it per run."""
+    for name in ('SKINOVA_DATA_DIR', 'SKINOVA_SHARED_DB', 'SKINOVA_RECORD_DIR'):
+        monkeypatch.delenv(name, raising=False)
+    for name, value in env.items():
+        monkeypatch.setenv(name, value)
+    script_cache = ScriptCache()
+    monkeypatch.setattr(local_script_runner, 'ScriptCache', lambda: script_cache)
+    monkeypatch.setattr(app_test, 'LocalScriptRunner', RepaintingScriptRunner)
+    at = AppTest.from_file(APP_PATH, default_timeout=APP_TIMEOUT)
+    at.run()
+    assert not at.exception, at.exception
+    return at
+
+
+@pytest.fixture
+def app(monkeypatch):
+    """A logged-out app session with in-memory storage (no data dir, shared DB or session recording)."""
+    return open_app(monkeypatch)
+
+
+@pytest.fixture
+def member(app):
+    """A signed-up, onboarded session on the dashboard."""
+    sign_up(app, unique_email())
+    onboard(app)
+    return app
+
+
+@pytest.fixture(scope='session')
+def app_module():
+    """app.py imported as a plain module (bare mode), for testing its helpers directly.
+
+    The import renders the login page outside a script run, where st.form() marks the global
+    root containers as a form instead of opening a block. That mark is cleared afterwards so
+    later AppTest runs do not see every widget as inside a form."""
+    spec = importlib.util.spec_from_file_location('skinova_app', APP_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    for root in (delta_generator.main_dg, delta_generator.sidebar_dg, delta_generator.event_dg, delta_generator.bottom_dg):
+        root._form_data = None
+    return module
+
+
+@pytest.fixture
+def script_runs(monkeypatch):
+    """Records each full or fragment execution, st.rerun() continuations included (one entry per pass)."""
+    log = ScriptRunLog()
+    run_script = script_runner.ScriptRunner._run_script
+    on_script_finished = local_script_runner.LocalScriptRunner._on_script_finished
+    clock = {}
+
+    def timed_run_script(self, rerun_data):
+        clock.update(wall=time.perf_counter(), cpu=time.thread_time())
+        return run_script(self, rerun_data)
+
+    def record_finished(self, ctx, event, premature_stop):
+        on_script_finished(self, ctx, event, premature_stop)
+        now, cpu_now = time.perf_counter(), time.thread_time()
+        kind = 'fragment' if event == script_runner.ScriptRunnerEvent.FRAGMENT_STOPPED_WITH_SUCCESS else 'full'
+        log.runs.append((kind, now - clock['wall'], cpu_now - clock['cpu']))
+        clock.update(wall=now, cpu=cpu_now)
+
+    monkeypatch.setattr(script_runner.ScriptRunner, '_run_script', timed_run_script)
+    monkeypatch.setattr(local_script_runner.LocalScriptRunner, '_on_script_finished', record_finished)
+    return log
+
+
+@pytest.fixture
+def fragment_runs(monkeypatch):
+    """Lets a test rerun only a fragment, the way the browser does after a widget inside it changes.
+
+    AppTest starts a new script runner (and fragment storage) per run and always reruns the whole
+    script. Here every runner shares one storage, and `rerun(at, fragment_id)` queues that fragment."""
+    storage = MemoryFragmentStorage()
+    queued = []
+    rerun_data = local_script_runner.RerunData
+    monkeypatch.setattr(local_script_runner, 'MemoryFragmentStorage', lambda: storage)
+    monkeypatch.setattr(local_script_runner, 'RerunData',
+                        lambda **kwargs: rerun_data(fragment_id_queue=list(queued), **kwargs))
+
+    class FragmentRunner:
+        def ids(self):
+            return list(storage._fragments)
+
+        def rerun(self, at, fragment_id):
+            queued[:] = [fragment_id]
+            try:
+                return at.run()
+            finally:
+                queued.clear()
+
+    return FragmentRunner()
+
+
+def click(at, label):
+    """Clicks the first button whose label contains `label` and runs the app."""
+    next(button for button in at.button if label in str(button.label)).click()
+    return at.run()
+
+
+def unique_email():
+    return f"user-{uuid.uuid4().hex[:10]}@example.com"
+
+
+def sign_up(at, email, name='Test User'):
+    at.text_input(key='s_name').input(name)
+    at.text_input(key='s_email').input(email)
+    return click(at, 'Create Account')
+
+
+def onboard(at):
+    return click(at, 'Finalize')
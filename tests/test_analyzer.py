@@ -0,0 +1,47 @@
+"""Skin analyzer: only scans measured from the photo reach the twin index and the scan history."""
+
+import io
+
+import pytest
+import streamlit
+from PIL import Image
+
+from conftest import click
+
+
+class FakeUpload(io.BytesIO):
+    name = 'face.png'
+    type = 'image/png'
+
+
+@pytest.fixture
+def scan(member, monkeypatch):
+    """Runs a deep scan of a plain photo in the given scan mode and returns the session."""
+    photo = io.BytesIO()
+    Image.new('RGB', (1200, 900), 'tan').save(photo, 'PNG')
+
+    def fake_uploader(label, key=None, on_change=None, args=(), **kwargs):
+        # Hand the photo over once, through the same spill callback a real upload triggers
+        if key and key.startswith('analyzer_upload_') and not streamlit.session_state.get('_photo_uploaded'):
+            streamlit.session_state['_photo_uploaded'] = True
+            streamlit.session_state[key] = FakeUpload(photo.getvalue())
+            on_change(*args)
+
+    monkeypatch.setattr(streamlit, 'file_uploader', fake_uploader)
+
+    def run(mode):
+        member.radio(key='nav_choice').set_value('Skin Analyzer').run()
+        next(radio for radio in member.radio if radio.label == 'Scan Mode').set_value(mode)
+        click(member, 'Deep Scan')
+        assert not member.exception, member.exception
+        return member
+
+    return run
+
+
+@pytest.mark.parametrize('mode, kept', [('Whole Image', 0), ('Regional Map (Tiled)', 1)])
+def test_only_measured_scans_are_kept(scan, mode, kept):
+    at = scan(mode)
+    store = at.session_state['data_store']
+    assert len(store.twin_index) == kept
+    assert len(store.user_db[at.session_state['user_email']]['Scan_History']) == kept
@@ -0,0 +1,114 @@
+"""Data Backup access control and NDJSON import validation."""
+
+import io
+import json
+import os
+
+import pytest
+
+from conftest import click
+
+TOKEN = 'correct horse battery staple'
+
+
+@pytest.fixture
+def operator_env(monkeypatch, tmp_path):
+    monkeypatch.setenv('SKINOVA_OPERATOR_TOKEN', TOKEN)
+    monkeypatch.setenv('SKINOVA_DATA_DIR', str(tmp_path))
+    return tmp_path
+
+
+def open_backup_page(at):
+    at.radio(key='nav_choice').set_value('Data Backup').run()
+    assert not at.exception, at.exception
+    return at
+
+
+def unlock(at, token):
+    at.text_input(key='staff_token_operator').input(token)
+    return click(at, 'Unlock')
+
+
+def button_labels(at):
+    return [str(button.label) for button in at.button]
+
+
+def test_backup_page_is_disabled_without_an_operator_token(member, monkeypatch):
+    monkeypatch.delenv('SKINOVA_OPERATOR_TOKEN', raising=False)
+    open_backup_page(member)
+    assert any('SKINOVA_OPERATOR_TOKEN' in warning.value for warning in member.warning)
+    assert not any('Export' in label or 'Precompute' in label for label in button_labels(member))
+
+
+def test_wrong_token_keeps_the_page_locked(member, operator_env):
+    open_backup_page(member)
+    unlock(member, 'guess')
+    assert any('not accepted' in error.value for error in member.error)
+    assert not any('Build Export' in label for label in button_labels(member))
+
+
+def test_operator_token_unlocks_exports_until_logout(member, operator_env):
+    open_backup_page(member)
+    unlock(member, TOKEN)
+    assert any('Build Export' in label for label in button_labels(member))
+
+    click(member, 'Build Export')
+    export_dir = operator_env / 'skinova-spill' / 'exports'
+    first = set(os.listdir(export_dir))
+    assert len(first) == 1
+    click(member, 'Build Export')
+    second = set(os.listdir(export_dir))
+    assert len(second) == 1 and second != first   # The previous export file is removed
+
+    click(member, 'Logout')
+    assert os.listdir(export_dir) == []
+    assert 'staff_roles' not in member.session_state
+
+
+def test_cohort_full_rebuild_needs_an_operator(member, operator_env):
+    member.radio(key='nav_choice').set_value('Cohort Analytics').run()
+    assert not any('Full Rebuild' in label for label in button_labels(member))
+    open_backup_page(member)
+    unlock(member, TOKEN)
+    member.radio(key='nav_choice').set_value('Cohort Analytics').run()
+    assert any('Full Rebuild' in label for label in button_labels(member))
+
+
+@pytest.mark.parametrize('row, message', [
+    ({'kind': 'meta', 'format': 'skinova-ndjson', 'version': '2'}, 'not an integer'),
+    ({'kind': 'meta', 'format': 'skinova-ndjson', 'version': None}, 'not an integer'),
+    ({'kind': 'score_history', 'email': 'a@b.co', 'scores': 80}, 'list of numbers'),
+    ({'kind': 'score_history', 'email': 'a@b.co', 'scores': {'a': 1}}, 'list of numbers'),
+    ({'kind': 'routine_progress', 'email': 'a@b.co', 'day': '2026-01-02', 'AM': 'yes', 'PM': []}, 'true/false'),
+    ({'kind': 'scan', 'email': 'a@b.co', 'scan': {'at': '2026-01-02 10:00:00', 'vector': []}}, 'missing hash, levels'),
+    ({'kind': 'scan', 'email': 'a@b.co', 'scan': {'at': '2026-01-02 10:00:00', 'hash': 'ab', 'levels': [9] * 5, 'vector': []}}, 'indicator levels'),
+    ({'kind': 'scan', 'email': 'a@b.co', 'scan': {'at': '2026-01-02 10:00:00', 'hash': 'ab', 'levels': [0] * 5, 'vector': [0.1]}}, 'vector must be'),
+])
+def test_malformed_rows_are_rejected_not_raised(app_module, row, message):
+    assert message in app_module.validate_import_row(row, lambda email: True)
+
+
+def test_reimported_scans_are_not_duplicated(app_module):
+    scan = {'at': '2026-01-02 10:00:00', 'hash': 'ab12', 'mode': 'Whole Image', 'metrics': None, 'risk': 3,
+            'levels': [0] * len(app_module.ANALYZER_INDICATORS), 'vector': [0.1] * app_module.TWIN_DIM}
+    scan_row = {'kind': 'scan', 'email': 'a@b.co', 'scan': scan}
+    user_db, posts, consults = {}, [], []
+    for lines in ([{'kind': 'user', 'email': 'a@b.co', 'profile': {'Name': 'A'}}, scan_row, scan_row], [scan_row]):
+        payload = io.BytesIO('\n'.join(json.dumps(line) for line in lines).encode())
+        app_module.import_ndjson(payload, user_db, posts, consults)
+    assert user_db['a@b.co']['Scan_History'] == [scan]
+    assert app_module.build_scan_history(user_db['a@b.co']['Scan_History'])['vectors'].shape == (1, app_module.TWIN_DIM)
+
+
+def test_import_reports_malformed_rows(app_module):
+    lines = [
+        {'kind': 'meta', 'format': 'skinova-ndjson', 'version': 'two'},
+        {'kind': 'user', 'email': 'a@b.co', 'profile': {'Name': 'A'}},
+        {'kind': 'score_history', 'email': 'a@b.co', 'scores': 7},
+        {'kind': 'score_history', 'email': 'a@b.co', 'scores': [70, 71]},
+    ]
+    user_db, posts, consults = {}, [], []
+    payload = io.BytesIO('\n'.join(json.dumps(line) for line in lines).encode())
+    report = app_module.import_ndjson(payload, user_db, posts, consults)
+    assert (report['imported'], report['rejected']) == (2, 2)
+    assert user_db['a@b.co']['Score_History'] == [70, 71]
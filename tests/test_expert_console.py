@@ -0,0 +1,67 @@
+"""Expert Console access: an allow-listed email is not enough, the session must unlock the expert token."""
+
+import pytest
+
+from conftest import click, onboard, open_app, sign_up, unique_email
+
+TOKEN = 'expert-token-for-tests'
+
+
+@pytest.fixture
+def expert(monkeypatch, tmp_path):
+    """An allow-listed expert who has filed one consult request, on the (locked) Expert Console.
+
+    The queue is only served from durable or shared storage, so the session uses a data dir."""
+    email = unique_email()
+    monkeypatch.setenv('SKINOVA_EXPERT_EMAILS', email)
+    monkeypatch.setenv('SKINOVA_EXPERT_TOKEN', TOKEN)
+    app = open_app(monkeypatch, SKINOVA_DATA_DIR=str(tmp_path))
+    sign_up(app, email)
+    onboard(app)
+    app.radio(key='nav_choice').set_value('Consult an Expert').run()
+    next(area for area in app.text_area if area.label.startswith('Describe your concern')).input('Itchy patch')
+    click(app, 'Submit Consultation Request')
+    app.radio(key='nav_choice').set_value('Expert Console').run()
+    assert not app.exception, app.exception
+    return app
+
+
+def queue_status(at):
+    return at.session_state['consult_requests'][0]['Status']
+
+
+def test_console_needs_the_expert_token(expert):
+    assert not expert.dataframe
+    expert.text_input(key='staff_token_expert').input('wrong')
+    click(expert, 'Unlock')
+    assert not expert.dataframe
+    expert.text_input(key='staff_token_expert').input(TOKEN)
+    click(expert, 'Unlock')
+    assert len(expert.dataframe) == 1
+
+
+def test_bulk_action_rechecks_access(expert, monkeypatch):
+    expert.text_input(key='staff_token_expert').input(TOKEN)
+    click(expert, 'Unlock')
+    expert.multiselect(key='consult_selected').set_value([0])
+    expert.selectbox(key='consult_target').set_value('Confirmed')
+    monkeypatch.delenv('SKINOVA_EXPERT_TOKEN')   # Revoked after the form was rendered
+    click(expert, 'Apply Status Change')
+    assert queue_status(expert) == 'Pending Review'
+
+    monkeypatch.setenv('SKINOVA_EXPERT_TOKEN', TOKEN)
+    expert.run()
+    expert.multiselect(key='consult_selected').set_value([0])
+    expert.selectbox(key='consult_target').set_value('Confirmed')
+    click(expert, 'Apply Status Change')
+    assert queue_status(expert) == 'Confirmed'
+
+
+def test_console_needs_shared_storage(member, monkeypatch):
+    monkeypatch.setenv('SKINOVA_EXPERT_EMAILS', member.session_state['user_email'])
+    monkeypatch.setenv('SKINOVA_EXPERT_TOKEN', TOKEN)
+    member.radio(key='nav_choice').set_value('Expert Console').run()
+    member.text_input(key='staff_token_expert').input(TOKEN)
+    click(member, 'Unlock')
+    assert any('SKINOVA_DATA_DIR' in info.value for info in member.info)
+    assert not member.dataframe and not member.multiselect
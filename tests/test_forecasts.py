@@ -0,0 +1,37 @@
+"""Score forecast cache: LRU bound and the nightly snapshot of score histories."""
+
+import threading
+
+
+def test_forecast_cache_is_lru_bounded(app_module):
+    cache = app_module.ForecastCache(max_entries=3)
+    history = [70, 71, 73, 72, 75]
+    cache.precompute([(f'u{i}@x.co', history) for i in range(3)])
+    cache.get('u0@x.co', history)                 # Most recently used now
+    cache.get('u3@x.co', history)                 # Evicts u1, the least recently used
+    assert list(cache.entries) == ['u2@x.co', 'u0@x.co', 'u3@x.co']
+    assert cache.get('u1@x.co', history)['point'].shape == (app_module.FORECAST_HORIZON,)
+
+
+def test_nightly_snapshot_blocks_signups_until_copied(app_module):
+    store = app_module.DataStore()
+    for i in range(3):
+        store.create_user(f'u{i}@x.co', {'Score_History': [60 + i, 65]})
+    signup = threading.Thread(target=store.create_user, args=('late@x.co', {'Score_History': [70]}))
+
+    class SignupMidIteration(dict):
+        def items(self):
+            for position, item in enumerate(dict.items(self)):
+                if position == 0:
+                    # Without the store lock this insert lands mid-iteration:
+                    # "dictionary changed size during iteration" would kill the nightly thread
+                    signup.start()
+                    signup.join(0.2)
+                yield item
+
+    store.user_db = SignupMidIteration(store.user_db)
+    histories = app_module.score_histories(store)
+    signup.join()
+    assert [email for email, _ in histories] == ['u0@x.co', 'u1@x.co', 'u2@x.co']
+    assert 'late@x.co' in store.user_db
+    assert app_module.ForecastCache().precompute(histories)['users'] == 3
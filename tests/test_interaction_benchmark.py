@@ -0,0 +1,74 @@
+"""Per-interaction cost of the fragment-isolated regions against a full-script rerun of the same click.
+
+Each interaction is replayed as a full rerun (what every click cost before the fragments) and as a
+fragment-only rerun (what the browser now requests). Medians land in the terminal summary."""
+
+import statistics
+
+import pytest
+
+from conftest import BENCHMARK_RESULTS
+
+ROUNDS = 5
+
+pytestmark = pytest.mark.benchmark
+
+
+def fragment_id(fragment_runs):
+    """The single fragment rendered by the current page."""
+    ids = fragment_runs.ids()
+    assert len(ids) == 1, ids
+    return ids[0]
+
+
+def benchmark(name, at, script_runs, fragment_runs, page, interact):
+    """Times `interact(at)` ROUNDS times as a full rerun and ROUNDS times as a fragment rerun."""
+    samples = {'full': [], 'fragment': []}
+    for round_index in range(ROUNDS):
+        for kind in samples:
+            at.radio(key='nav_choice').set_value(page).run()
+            fragment = fragment_id(fragment_runs)
+            interact(at, round_index)
+            if kind == 'full':
+                at.run()
+            else:
+                fragment_runs.rerun(at, fragment)
+            assert not at.exception, at.exception
+            run_kind, wall, cpu = script_runs.last()
+            assert run_kind == kind
+            samples[kind].append((wall, cpu))
+            if kind == 'fragment':
+                at.run()   # The test tree now holds only the fragment's elements; repaint the page
+
+    medians = {}
+    for kind, runs in samples.items():
+        medians[kind] = (statistics.median(wall for wall, _ in runs) * 1000, statistics.median(cpu for _, cpu in runs) * 1000)
+        BENCHMARK_RESULTS.append((name, kind, *medians[kind]))
+    return medians
+
+
+def test_routine_checkbox_toggle(member, script_runs, fragment_runs):
+    def toggle(at, round_index):
+        at.checkbox(key='m_step_0').set_value(round_index % 2 == 0)
+
+    medians = benchmark('routine checkbox toggle', member, script_runs, fragment_runs, 'My Routine', toggle)
+    assert medians['fragment'][1] < medians['full'][1]
+
+
+def test_marketplace_filter_change(member, script_runs, fragment_runs):
+    def filter_by_type(at, round_index):
+        selectbox = next(box for box in at.selectbox if box.label == 'Filter by Product Type')
+        selectbox.set_value(selectbox.options[1 + round_index % (len(selectbox.options) - 1)])
+
+    medians = benchmark('marketplace filter change', member, script_runs, fragment_runs, 'Product Marketplace', filter_by_type)
+    assert medians['fragment'][1] < medians['full'][1]
+
+
+def test_forum_post(member, script_runs, fragment_runs):
+    def post(at, round_index):
+        at.text_input(key='forum_title_input').input(f'Purging or breaking out? ({round_index})')
+        at.text_area(key='forum_content_input').input('Small bumps on my chin since starting retinol last week.')
+        next(button for button in at.button if 'Submit Question' in str(button.label)).click()
+
+    medians = benchmark('forum post', member, script_runs, fragment_runs, 'Community Forum', post)
+    assert medians['fragment'][1] < medians['full'][1]
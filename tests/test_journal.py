@@ -0,0 +1,111 @@
+"""Change journal recovery: torn log tails, interrupted checkpoints and lock-free snapshots."""
+
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def durable(app_module, tmp_path):
+    """Opens (or reopens, after a simulated crash) a journaled DataStore on tmp_path."""
+    opened = []
+
+    def open_store():
+        for journal in opened:
+            journal.close()
+        journal = app_module.ChangeJournal(str(tmp_path))
+        store = app_module.DataStore(journal)
+        journal.recover(store)
+        opened.append(journal)
+        return store
+
+    yield open_store
+    for journal in opened:
+        journal.close()
+
+
+def add_users(store, *emails):
+    for email in emails:
+        store.create_user(email, {'Email': email, 'Name': email.split('@')[0]})
+
+
+@pytest.mark.parametrize('torn_tail', [b'{"type":"user_create","ema', b'{"type":"user_update"}\n', b'\xff\xfe\n'])
+def test_events_written_after_a_torn_tail_survive_the_next_recovery(durable, torn_tail):
+    store = durable()
+    add_users(store, 'a@x.co', 'b@x.co')
+    store.journal.sync()
+    with open(store.journal.log_path, 'ab') as log:
+        log.write(torn_tail)   # Crash in the middle of an append
+
+    store = durable()
+    assert set(store.user_db) == {'a@x.co', 'b@x.co'}
+    add_users(store, 'c@x.co')
+    store.update_user('a@x.co', {'Name': 'Ann'})
+
+    store = durable()
+    assert set(store.user_db) == {'a@x.co', 'b@x.co', 'c@x.co'}
+    assert store.user_db['a@x.co']['Name'] == 'Ann'
+
+
+def test_checkpoint_interrupted_after_rotation_loses_nothing(durable):
+    store = durable()
+    add_users(store, 'a@x.co')
+    with store.lock:
+        store.journal.rotate()              # The snapshot is never written (crash)
+    add_users(store, 'b@x.co')
+
+    store = durable()
+    assert set(store.user_db) == {'a@x.co', 'b@x.co'}
+    add_users(store, 'c@x.co')
+    store.checkpoint()                      # Folds the leftover rotated log into the new snapshot
+    add_users(store, 'd@x.co')
+
+    store = durable()
+    assert set(store.user_db) == {'a@x.co', 'b@x.co', 'c@x.co', 'd@x.co'}
+    assert len(store.journal.snapshot_paths()) == 1
+
+
+def test_snapshot_export_runs_without_the_store_lock(app_module, durable, monkeypatch):
+    store = durable()
+    add_users(store, 'a@x.co')
+    export_database = app_module.export_database
+    observed = {}
+
+    def export_and_commit(path, user_db, *args, **kwargs):
+        # Another session commits while the snapshot is being written
+        writer = threading.Thread(target=add_users, args=(store, 'late@x.co'))
+        writer.start()
+        writer.join(timeout=5)
+        observed['commit_finished'] = not writer.is_alive()
+        observed['late_in_snapshot'] = 'late@x.co' in user_db
+        return export_database(path, user_db, *args, **kwargs)
+
+    monkeypatch.setattr(app_module, 'export_database', export_and_commit)
+    store.checkpoint()
+    assert observed == {'commit_finished': True, 'late_in_snapshot': False}
+
+    store = durable()
+    assert set(store.user_db) == {'a@x.co', 'late@x.co'}
+
+
+def test_snapshot_keeps_rows_the_importer_would_reject(durable):
+    store = durable()
+    add_users(store, 'a@x.co')
+    legacy_scan = {'at': '2024-01-01T00:00:00', 'hash': 'abc', 'levels': [0], 'vector': []}
+    store.add_scan('a@x.co', legacy_scan)  # Fails import validation (too few levels)
+    store.checkpoint()
+
+    store = durable()
+    assert store.user_db['a@x.co']['Scan_History'] == [legacy_scan]
+
+
+def test_corrupt_snapshot_fails_recovery(durable, tmp_path):
+    store = durable()
+    add_users(store, 'a@x.co')
+    store.checkpoint()
+    _, snapshot_path = store.journal.snapshot_paths()[-1]
+    with open(snapshot_path, 'wb') as snapshot:
+        snapshot.write(b'{"kind": "user", "email"\n')
+
+    with pytest.raises(ValueError, match='corrupt snapshot'):
+        durable()
@@ -0,0 +1,9 @@
+"""Leaderboard rows show a public name, never part of the member's email."""
+
+
+def test_leaderboard_hides_emails(member):
+    member.radio(key='nav_choice').set_value('Leaderboard').run()
+    assert not member.exception, member.exception
+    users = member.dataframe[0].value['User'].tolist()
+    assert "Test U. (you)" in users
+    assert not any('user-' in user or '@' in user for user in users)
@@ -0,0 +1,37 @@
+"""Notification outbox worker: a failing round is logged and retried instead of ending delivery."""
+
+import time
+
+
+class RecordingTransport:
+    def __init__(self):
+        self.sent = []
+
+    async def start(self):
+        pass
+
+    async def send_batch(self, messages):
+        self.sent.extend(message['recipient'] for message in messages)
+        return {message['id']: None for message in messages}
+
+
+def test_worker_survives_a_failed_round(app_module, monkeypatch, tmp_path):
+    monkeypatch.setattr(app_module, 'OUTBOX_BACKOFF_BASE', 0.05)
+    transport = RecordingTransport()
+    outbox = app_module.NotificationOutbox(str(tmp_path / 'outbox.sqlite3'), transport)
+    claim_batch = outbox._claim_batch
+    failures = []
+
+    def flaky_claim():
+        if not failures:
+            failures.append(1)
+            raise ValueError("database disk image is malformed")
+        return claim_batch()
+
+    outbox._claim_batch = flaky_claim
+    outbox.enqueue('test', 'a@example.com', 'Subject', 'Body', 'test-1')
+    outbox.start()
+    deadline = time.monotonic() + 10
+    while outbox.stats()['sent'] < 1 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert failures and transport.sent == ['a@example.com']
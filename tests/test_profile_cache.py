@@ -0,0 +1,40 @@
+"""Cached per-user data never crosses from one session's store into another's."""
+
+import re
+
+from streamlit.testing.v1 import AppTest
+
+from conftest import APP_PATH, APP_TIMEOUT, onboard, sign_up, unique_email
+
+
+def dashboard_completion(at):
+    at.radio(key='nav_choice').set_value('Dashboard').run()
+    assert not at.exception, at.exception
+    for block in at.markdown:
+        match = re.search(r"color: #4CAF50;'>(\d+)%</p>", block.value)
+        if match:
+            return int(match.group(1))
+    raise AssertionError("routine completion not on the dashboard")
+
+
+def test_sessions_with_the_same_email_do_not_share_cached_aggregates(app):
+    email = unique_email()
+    sign_up(app, email)
+    onboard(app)
+    # A second browser session: with the default (session-only) store it has its own database
+    other = AppTest.from_file(APP_PATH, default_timeout=APP_TIMEOUT).run()
+    sign_up(other, email)
+    onboard(other)
+
+    app.radio(key='nav_choice').set_value('My Routine').run()
+    app.checkbox(key='m_step_0').check().run()
+    assert dashboard_completion(app) > 0
+    # Only the first session checked a step; the second must not be served its cached aggregates
+    assert dashboard_completion(other) == 0
+    assert other.session_state.data_store.profile_cache is not app.session_state.data_store.profile_cache
+
+
+def test_session_stores_get_their_own_profile_cache(app_module):
+    assert app_module.DataStore().profile_cache is not app_module.DataStore().profile_cache
+    process_cache = app_module.ProfileCache()
+    assert app_module.DataStore(profile_cache=process_cache).profile_cache is process_cache
@@ -0,0 +1,15 @@
+"""A checklist toggle repaints today's cells only; the year heatmaps render with the page."""
+
+
+def test_toggle_repaints_only_todays_cells(member, fragment_runs):
+    member.radio(key='nav_choice').set_value('My Routine').run()
+    assert any('Your Year in Rituals' in md.value for md in member.markdown)
+    (fragment,) = fragment_runs.ids()
+
+    member.checkbox(key='m_step_0').check()
+    fragment_runs.rerun(member, fragment)
+    assert not member.exception, member.exception
+    rendered = [md.value for md in member.markdown]
+    assert not any('Your Year in Rituals' in value or '<svg' in value for value in rendered)
+    today = next(value for value in rendered if value.startswith("<p style='margin-top: 8px;'><b>Today</b>"))
+    assert 'Morning: 0%' not in today and 'Morning: no record' not in today
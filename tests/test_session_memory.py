@@ -0,0 +1,64 @@
+"""Per-session heavy state: sizes, per-session locking and attachment cleanup."""
+
+import threading
+import time
+
+
+def test_checkout_does_not_block_other_sessions(app_module, monkeypatch, tmp_path):
+    monkeypatch.setattr(app_module, 'SESSION_SPILL_DIR', str(tmp_path))
+    registry = app_module.SessionMemoryRegistry()
+    other_done = threading.Event()
+
+    def other_session():
+        with registry.checkout('b') as heavy:
+            heavy.put('report', b'x' * 1024)
+        other_done.set()
+
+    with registry.checkout('a'):
+        threading.Thread(target=other_session).start()
+        assert other_done.wait(5)
+    assert registry.resident_bytes() > 1024  # Counted at the pickled size
+
+
+def test_sweep_skips_busy_sessions(app_module, monkeypatch, tmp_path):
+    monkeypatch.setattr(app_module, 'SESSION_SPILL_DIR', str(tmp_path))
+    registry = app_module.SessionMemoryRegistry()
+    registry.last_sweep = time.monotonic()  # Only the explicit sweep below runs
+    for key in ('busy', 'idle'):
+        with registry.checkout(key) as heavy:
+            heavy.put('report', {'image': b'x' * 4096})
+            heavy.last_seen -= app_module.SESSION_IDLE_EVICT_SECONDS + 1
+
+    busy = registry.sessions['busy']
+    with busy.lock:
+        swept = threading.Thread(target=registry.sweep)
+        swept.start()
+        swept.join(5)
+        assert not swept.is_alive()
+    assert 'report' in busy.items
+    assert registry.sessions['idle'].spilled and not registry.sessions['idle'].items
+    assert registry.sessions['idle'].get('report') == {'image': b'x' * 4096}
+
+
+def test_take_hands_over_spilled_file(app_module, tmp_path):
+    upload = tmp_path / 'photo.png'
+    upload.write_bytes(b'png')
+    state = app_module.SessionHeavyState('s')
+    state.put('consult_attachment', {'spill_path': str(upload), 'name': 'photo.png', 'size': 3}, size=0)
+    assert state.take('consult_attachment')['spill_path'] == str(upload)
+    state.clear()
+    assert upload.exists()
+
+
+def test_closing_a_consult_removes_its_attachment(app_module, monkeypatch, tmp_path):
+    store = app_module.DataStore()
+    monkeypatch.setattr(app_module, 'get_data_store', lambda: store)
+    attachment = tmp_path / 'attachment.png'
+    attachment.write_bytes(b'png')
+    store.add_consult_request({'Email': 'a@example.com', 'Status': 'Pending Review', 'Image_File': str(attachment)})
+    store.add_consult_request({'Email': 'b@example.com', 'Status': 'Pending Review', 'Image_File': None})
+
+    assert app_module.transition_consults([0, 1], 'Confirmed') == (2, 0)
+    assert attachment.exists()
+    assert app_module.transition_consults([0, 1], 'Completed') == (2, 0)
+    assert not attachment.exists()
@@ -0,0 +1,60 @@
+"""Session traces: free text is pseudonymized, replays still match, and the replay CLI runs no app code."""
+
+import os
+import subprocess
+import sys
+
+from streamlit.testing.v1 import AppTest
+
+from conftest import APP_PATH, APP_TIMEOUT, onboard, sign_up, unique_email
+
+
+def test_trace_is_redacted_and_replays(app_module, monkeypatch, tmp_path):
+    for name in ('SKINOVA_DATA_DIR', 'SKINOVA_SHARED_DB'):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv('SKINOVA_RECORD_DIR', str(tmp_path))
+    at = AppTest.from_file(APP_PATH, default_timeout=APP_TIMEOUT)
+    at.run()
+    email = unique_email()
+    sign_up(at, email, name='Priya Sharma')
+    onboard(at)
+    assert not at.exception, at.exception
+
+    (trace_name,) = os.listdir(tmp_path)
+    with open(tmp_path / trace_name, encoding='utf-8') as trace_file:
+        trace = trace_file.read()
+    assert email.split('@')[0] not in trace and 'Priya' not in trace
+    assert '@redacted.invalid' in trace
+
+    monkeypatch.delenv('SKINOVA_RECORD_DIR')
+    report = app_module.replay_trace(str(tmp_path / trace_name), app_path=APP_PATH, speedup=0)
+    assert report and not any(row['error'] or row['skipped'] for row in report), report
+    # The signup's starting score is random; everything else, the pseudonymized login included, matches
+    assert all(set(row['state_diff']) <= {'skin_score'} for row in report), report
+
+
+def test_replay_cli_exits_before_app_side_effects(tmp_path):
+    trace = tmp_path / 'empty.ndjson'
+    trace.write_text('')
+    data_dir = tmp_path / 'data'
+    data_dir.mkdir()
+    env = dict(os.environ, SKINOVA_DATA_DIR=str(data_dir))
+    result = subprocess.run([sys.executable, APP_PATH, '--replay', str(trace)], env=env,
+                            capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr
+    assert '0 interactions replayed' in result.stdout
+    assert os.listdir(data_dir) == []
+
+
+def test_recorder_switches_off_without_private_widget_state(app_module, monkeypatch, caplog):
+    from streamlit.runtime import state as runtime_state
+    monkeypatch.setattr(runtime_state, 'get_session_state', lambda: object())   # A Streamlit without SessionState._state
+    status = {'disabled': False}
+    monkeypatch.setattr(app_module, '_session_recorder_status', lambda: status)  # Not cached in bare mode
+
+    with caplog.at_level('WARNING', logger='skinova'):
+        assert app_module.open_session_step() is None
+        assert app_module._widget_state() is None
+    assert status['disabled']
+    assert [record.message for record in caplog.records].count(caplog.records[0].message) == 1
+    assert 'Session recording disabled' in caplog.records[0].message
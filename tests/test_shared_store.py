@@ -0,0 +1,80 @@
+"""Shared SQLite store: bulk reads and change-feed retention."""
+
+from datetime import date
+
+import pytest
+
+
+@pytest.fixture
+def shared_store(app_module, tmp_path):
+    return app_module.SharedSQLiteStore(str(tmp_path / 'shared.sqlite3'), app_module.ProfileCache())
+
+
+def user(email, **progress):
+    return {'Email': email, 'Name': email.split('@')[0], 'Routine_Progress': progress}
+
+
+def test_items_merges_progress_without_per_user_queries(shared_store, monkeypatch):
+    shared_store.user_db.update({
+        'b@x.co': user('b@x.co', **{'2026-01-01': {'AM': [True], 'PM': [False]}}),
+        'a@x.co': user('a@x.co'),
+        'c@x.co': user('c@x.co', **{'2026-01-01': {'AM': [False], 'PM': [True]},
+                                   '2026-01-02': {'AM': [True], 'PM': [True]}}),
+    })
+    monkeypatch.setattr(shared_store, 'load_progress', lambda *args: pytest.fail("per-user progress query"))
+
+    records = dict(shared_store.user_db.items())
+    assert list(records) == ['a@x.co', 'b@x.co', 'c@x.co']
+    assert records['a@x.co']['Routine_Progress'] == {}
+    assert records['b@x.co']['Routine_Progress'] == {'2026-01-01': {'AM': [True], 'PM': [False]}}
+    assert sorted(records['c@x.co']['Routine_Progress']) == ['2026-01-01', '2026-01-02']
+
+
+def test_change_feed_stays_bounded_under_multi_row_writes(app_module, shared_store, monkeypatch):
+    monkeypatch.setattr(app_module, 'CHANGES_RETAINED', 50)
+    monkeypatch.setattr(app_module, 'CHANGES_PRUNE_EVERY', 20)
+    for batch in range(40):
+        # 7 rows per write: seq rarely lands on a multiple of the prune interval
+        shared_store.user_db.update({f'u{batch}-{i}@x.co': user(f'u{batch}-{i}@x.co') for i in range(7)})
+
+    conn = shared_store.connection()
+    retained = conn.execute("SELECT COUNT(*) FROM changes").fetchone()[0]
+    assert retained < 50 + 20 + 7
+
+
+def onboarded(email, score, done_today):
+    record = dict(user(email, **{str(date.today()): {'AM': [True] * done_today + [False] * (2 - done_today), 'PM': [False, False]}}),
+                  Onboarding_Complete=True, Skin_Type='Oily', Goal='Glow', Location='Urban/Polluted',
+                  Routine={'Morning': ['a', 'b'], 'Evening': ['c', 'd']})
+    record['Skin Score'] = score
+    return record
+
+
+def test_foreign_user_writes_apply_as_deltas(app_module, shared_store, tmp_path):
+    shared_store.user_db.update({'a@x.co': onboarded('a@x.co', 60, 0), 'b@x.co': onboarded('b@x.co', 80, 2)})
+    aggregates = app_module.CohortAggregates()
+    shared_store.user_observers.append(aggregates)
+    aggregates.rebuild(shared_store.user_db)
+
+    other_replica = app_module.SharedSQLiteStore(shared_store.path, app_module.ProfileCache())
+    other_replica.update_user('a@x.co', {'Skin Score': 70}, {str(date.today()): {'AM': [True, True], 'PM': [True, True]}})
+    other_replica.delete_user('b@x.co')
+    shared_store.poll_changes(force=True)
+
+    assert not aggregates.stale
+    assert aggregates.summary() == {'users': 1, 'avg_score': 70.0, 'avg_compliance': 1.0, 'compliant_share': 1.0}
+    rebuilt = app_module.CohortAggregates()
+    rebuilt.rebuild(shared_store.user_db)
+    assert rebuilt.contributions == aggregates.contributions
+
+
+def test_export_includes_scans(app_module, shared_store):
+    scan = {'at': '2026-01-01 10:00:00', 'hash': 'ab12', 'mode': 'Whole Image', 'metrics': None, 'risk': 3,
+            'levels': [0] * len(app_module.ANALYZER_INDICATORS), 'vector': [0.1] * app_module.TWIN_DIM}
+    shared_store.user_db.update({'a@x.co': user('a@x.co'), 'b@x.co': user('b@x.co')})
+    shared_store.add_scan('b@x.co', scan)
+
+    records = dict(shared_store.user_db.items())
+    assert records['a@x.co']['Scan_History'] == [] and records['b@x.co']['Scan_History'] == [scan]
+    rows = list(app_module.iter_export_records(shared_store.user_db, [], []))
+    assert [row['scan'] for row in rows if row['kind'] == 'scan'] == [scan]
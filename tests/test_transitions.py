@@ -0,0 +1,74 @@
+"""Auth and navigation flows each cost exactly one script run (see apply_pending_transitions)."""
+
+from conftest import click, onboard, sign_up, unique_email
+
+
+def test_signup_lands_on_onboarding_in_one_run(app, script_runs):
+    script_runs.clear()
+    sign_up(app, unique_email())
+    assert not app.exception, app.exception
+    assert app.session_state.current_page == 'Onboarding'
+    assert script_runs.count() == 1
+
+
+def test_onboarding_lands_on_dashboard_in_one_run(app, script_runs):
+    sign_up(app, unique_email())
+    script_runs.clear()
+    onboard(app)
+    assert not app.exception, app.exception
+    assert app.session_state.current_page == 'Dashboard'
+    assert app.session_state.onboarding_complete
+    assert script_runs.count() == 1
+
+
+def test_incomplete_onboarding_stays_with_an_error(app, script_runs):
+    sign_up(app, unique_email())
+    app.multiselect(key='ob_concerns').set_value(['Oil Control/Excess Sebum'])
+    script_runs.clear()
+    onboard(app)
+    assert app.session_state.current_page == 'Onboarding'
+    assert any('at least 2 Primary Concerns' in error.value for error in app.error)
+    assert script_runs.count() == 1
+
+
+def test_login_paints_dashboard_in_one_run(app, script_runs):
+    email = unique_email()
+    sign_up(app, email)
+    onboard(app)
+    click(app, 'Logout')
+    assert app.session_state.current_page == 'Login/Signup'
+
+    script_runs.clear()
+    app.text_input(key='l_email').input(email)
+    click(app, 'Login to Dashboard')
+    assert not app.exception, app.exception
+    assert app.session_state.current_page == 'Dashboard'
+    assert script_runs.count() == 1
+
+
+def test_logout_returns_to_login_in_one_run(app, script_runs):
+    sign_up(app, unique_email())
+    onboard(app)
+    script_runs.clear()
+    click(app, 'Logout')
+    assert app.session_state.current_page == 'Login/Signup'
+    assert not app.session_state.logged_in
+    assert script_runs.count() == 1
+
+
+def test_sidebar_navigation_is_one_run(app, script_runs):
+    sign_up(app, unique_email())
+    onboard(app)
+    script_runs.clear()
+    app.radio(key='nav_choice').set_value('My Routine').run()
+    assert app.session_state.current_page == 'My Routine'
+    assert script_runs.count() == 1
+
+
+def test_unknown_email_stays_on_login_with_an_error(app, script_runs):
+    script_runs.clear()
+    app.text_input(key='l_email').input(unique_email())
+    click(app, 'Login to Dashboard')
+    assert app.session_state.current_page == 'Login/Signup'
+    assert any('Email not found' in error.value for error in app.error)
+    assert script_runs.count() == 1
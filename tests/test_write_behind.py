@@ -0,0 +1,51 @@
+"""Write-behind buffers: staged writes outlive their session and are committed without a rerun."""
+
+import gc
+import time
+
+
+def staged_buffer(app_module, registry):
+    store = app_module.DataStore()
+    store.create_user('a@x.co', {'Email': 'a@x.co', 'Name': 'a'})
+    buffer = app_module.WriteBehindBuffer(store, registry)
+    buffer.stage_field('a@x.co', 'Goal', 'Hydration')
+    return store, buffer
+
+
+def test_dropped_buffer_is_still_flushed_when_due(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'WRITE_BEHIND_MAX_DELAY', 0.0)
+    registry = app_module.WriteBufferRegistry()
+    store, buffer = staged_buffer(app_module, registry)
+    del buffer   # The session state holding it is gone
+    gc.collect()
+
+    assert registry.flush_due() == 1
+    assert store.user_db['a@x.co']['Goal'] == 'Hydration'
+    assert not registry.buffers
+
+
+def test_flusher_thread_commits_without_a_rerun(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'WRITE_BEHIND_MAX_DELAY', 0.0)
+    monkeypatch.setattr(app_module, 'WRITE_BEHIND_FLUSH_INTERVAL', 0.01)
+    registry = app_module.WriteBufferRegistry()
+    store, buffer = staged_buffer(app_module, registry)
+    app_module.threading.Thread(target=registry.run, daemon=True).start()
+
+    deadline = time.monotonic() + 5
+    while store.user_db['a@x.co'].get('Goal') != 'Hydration' and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert store.user_db['a@x.co'].get('Goal') == 'Hydration'
+
+
+def test_expired_session_flushes_its_buffer(app_module, monkeypatch, tmp_path):
+    monkeypatch.setattr(app_module, 'SESSION_SPILL_DIR', str(tmp_path))
+    sessions = app_module.SessionMemoryRegistry()
+    sessions.last_sweep = time.monotonic()  # Only the explicit sweep below runs
+    store, buffer = staged_buffer(app_module, app_module.WriteBufferRegistry())
+    with sessions.checkout('gone') as heavy:
+        heavy.write_buffer = buffer
+        heavy.last_seen -= app_module.SESSION_EXPIRE_SECONDS + 1
+
+    sessions.sweep()
+    assert 'gone' not in sessions.sessions
+    assert store.user_db['a@x.co']['Goal'] == 'Hydration'